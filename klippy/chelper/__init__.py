@@ -18,7 +18,8 @@ COMPILE_ARGS = ("-Wall -g -O2 -shared -fPIC"
 SSE_FLAGS = "-mfpmath=sse -msse2"
 SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'itersolve.c', 'trapq.c',
-    'pollreactor.c', 'msgblock.c', 'trdispatch.c',
+    'pollreactor.c', 'msgblock.c', 'trdispatch.c', 'lookahead.c', 'stepgen.c',
+    'msgparse.c', 'msgring.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_deltesian.c', 'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c',
     'kin_extruder.c', 'kin_shaper.c', 'kin_idex.c',
@@ -26,7 +27,8 @@ SOURCE_FILES = [
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
     'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h',
-    'trapq.h', 'pollreactor.h', 'msgblock.h'
+    'trapq.h', 'pollreactor.h', 'msgblock.h', 'lookahead.h', 'stepgen.h',
+    'msgparse.h', 'msgring.h'
 ]
 
 defs_stepcompress = """
@@ -80,6 +82,13 @@ defs_itersolve = """
     double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
 """
 
+defs_stepgen = """
+    struct stepgen_pool *stepgen_pool_alloc(int num_threads);
+    void stepgen_pool_free(struct stepgen_pool *sp);
+    int32_t stepgen_pool_generate(struct stepgen_pool *sp
+        , struct stepper_kinematics **sks, int count, double flush_time);
+"""
+
 defs_trapq = """
     struct pull_move {
         double print_time, move_t;
@@ -88,6 +97,13 @@ defs_trapq = """
         double x_r, y_r, z_r;
     };
 
+    struct trapq_append_move {
+        double print_time, accel_t, cruise_t, decel_t;
+        double start_x, start_y, start_z;
+        double x_r, y_r, z_r;
+        double start_v, cruise_v, accel;
+    };
+
     struct trapq *trapq_alloc(void);
     void trapq_free(struct trapq *tq);
     void trapq_append(struct trapq *tq, double print_time
@@ -95,6 +111,9 @@ defs_trapq = """
         , double start_pos_x, double start_pos_y, double start_pos_z
         , double axes_r_x, double axes_r_y, double axes_r_z
         , double start_v, double cruise_v, double accel);
+    void trapq_append_batch(struct trapq *tq
+        , struct trapq_append_move *moves, int count, struct trapq *etq
+        , struct trapq_append_move *emoves, int ecount);
     void trapq_finalize_moves(struct trapq *tq, double print_time
         , double clear_history_time);
     void trapq_set_position(struct trapq *tq, double print_time
@@ -103,6 +122,24 @@ defs_trapq = """
         , double start_time, double end_time);
 """
 
+defs_lookahead = """
+    struct lookahead_move {
+        double max_start_v2, delta_v2, max_smoothed_v2, smooth_delta_v2;
+        double max_cruise_v2;
+    };
+    struct lookahead_junction {
+        double start_v2, cruise_v2, end_v2;
+    };
+    struct lookahead_delayed {
+        int index;
+        double start_v2, end_v2;
+    };
+
+    int lookahead_flush(struct lookahead_move *moves, int count, int lazy
+        , struct lookahead_junction *junctions
+        , struct lookahead_delayed *delayed);
+"""
+
 defs_kin_cartesian = """
     struct stepper_kinematics *cartesian_stepper_alloc(char axis);
 """
@@ -179,6 +216,8 @@ defs_serialqueue = """
     void serialqueue_free(struct serialqueue *sq);
     struct command_queue *serialqueue_alloc_commandqueue(void);
     void serialqueue_free_commandqueue(struct command_queue *cq);
+    void serialqueue_set_commandqueue_priority(struct command_queue *cq
+        , int priority);
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock
         , uint64_t notify_id);
@@ -195,6 +234,46 @@ defs_serialqueue = """
         , struct pull_queue_message *q, int max);
 """
 
+defs_msgparse = """
+    #define MSGPARSE_MAX_PARAMS 16
+    struct msgparse_format {
+        int num_params;
+        char types[MSGPARSE_MAX_PARAMS];
+    };
+    struct msgparse_result {
+        int msgid, num_params;
+        int64_t params[MSGPARSE_MAX_PARAMS];
+    };
+
+    int msgparse_format_init(struct msgparse_format *mf, const char *types);
+    int msgparse_parse_format(struct msgparse_format *mf, uint8_t *data
+        , int len, int pos, int64_t *params);
+    int msgparse_encode_format(struct msgparse_format *mf, int msgid
+        , int64_t *params, uint8_t *bufdata, uint8_t *out, int maxlen);
+    int msgparse_send(struct serialqueue *sq, struct command_queue *cq
+        , struct msgparse_format *mf, int msgid, int64_t *params
+        , uint8_t *bufdata, uint64_t min_clock, uint64_t req_clock
+        , uint64_t notify_id);
+
+    struct msgparser *msgparse_alloc(void);
+    void msgparse_free(struct msgparser *mp);
+    int msgparse_add_format(struct msgparser *mp, int msgid
+        , const char *types);
+    int msgparse_decode(struct msgparser *mp, uint8_t *msg, int len
+        , struct msgparse_result *res);
+    void msgparse_pull(struct msgparser *mp, struct serialqueue *sq
+        , struct pull_queue_message *pqm, struct msgparse_result *res);
+"""
+
+defs_msgring = """
+    struct msgring *msgring_alloc(struct serialqueue *sq, uint32_t msgtag
+        , uint32_t oid, const char *types, int buf_size, int max_records);
+    void msgring_free(struct msgring *mr);
+    int msgring_get_record_size(struct msgring *mr);
+    int msgring_pull(struct msgring *mr, uint8_t *buf, int max_records);
+    uint32_t msgring_get_overflows(struct msgring *mr);
+"""
+
 defs_trdispatch = """
     void trdispatch_start(struct trdispatch *td, uint32_t dispatch_reason);
     void trdispatch_stop(struct trdispatch *td);
@@ -219,7 +298,8 @@ defs_std = """
 
 defs_all = [
     defs_pyhelper, defs_serialqueue, defs_std, defs_stepcompress,
-    defs_itersolve, defs_trapq, defs_trdispatch,
+    defs_itersolve, defs_stepgen, defs_trapq, defs_trdispatch, defs_lookahead,
+    defs_msgparse, defs_msgring,
     defs_kin_cartesian, defs_kin_corexy, defs_kin_corexz, defs_kin_delta,
     defs_kin_deltesian, defs_kin_polar, defs_kin_rotary_delta, defs_kin_winch,
     defs_kin_extruder, defs_kin_shaper, defs_kin_idex,
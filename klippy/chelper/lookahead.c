@@ -0,0 +1,100 @@
+// Look-ahead junction velocity planning
+//
+// Copyright (C) 2026  The Klipper developers
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// This is a C implementation of the backward pass in
+// toolhead.py:MoveQueue.flush().  It must produce results that are
+// bit-for-bit identical to the Python code, so the order of the
+// floating point operations below intentionally mirrors that code.
+
+#include "compiler.h" // __visible
+#include "lookahead.h" // lookahead_flush
+
+// Same semantics as Python's min() (returns first argument on a tie)
+static inline double
+la_min(double a, double b)
+{
+    return b < a ? b : a;
+}
+
+// Store the junction velocities for a move
+static inline void
+la_set(struct lookahead_junction *j, double start_v2, double cruise_v2
+       , double end_v2)
+{
+    j->start_v2 = start_v2;
+    j->cruise_v2 = cruise_v2;
+    j->end_v2 = end_v2;
+}
+
+// Traverse the moves from last to first and determine the junction
+// velocities of each move assuming the toolhead comes to a complete
+// stop after the last move.  Results are stored in 'junctions' for
+// all moves ready to be flushed.  Returns the number of moves that
+// may be flushed (or zero if no moves should be flushed).  The
+// 'delayed' array must have space for 'count' entries.
+int __visible
+lookahead_flush(struct lookahead_move *moves, int count, int lazy
+                , struct lookahead_junction *junctions
+                , struct lookahead_delayed *delayed)
+{
+    int update_flush_count = lazy, flush_count = count, num_delayed = 0, i;
+    double next_end_v2 = 0., next_smoothed_v2 = 0., peak_cruise_v2 = 0.;
+    for (i = count - 1; i >= 0; i--) {
+        struct lookahead_move *m = &moves[i];
+        double reachable_start_v2 = next_end_v2 + m->delta_v2;
+        double start_v2 = la_min(m->max_start_v2, reachable_start_v2);
+        double reachable_smoothed_v2 = next_smoothed_v2 + m->smooth_delta_v2;
+        double smoothed_v2 = la_min(m->max_smoothed_v2, reachable_smoothed_v2);
+        if (smoothed_v2 < reachable_smoothed_v2) {
+            // It's possible for this move to accelerate
+            if (smoothed_v2 + m->smooth_delta_v2 > next_smoothed_v2
+                || num_delayed) {
+                // This move can decelerate or this is a full accel
+                // move after a full decel move
+                if (update_flush_count && peak_cruise_v2) {
+                    flush_count = i;
+                    update_flush_count = 0;
+                }
+                peak_cruise_v2 = la_min(
+                    m->max_cruise_v2
+                    , (smoothed_v2 + reachable_smoothed_v2) * .5);
+                if (num_delayed) {
+                    // Propagate peak_cruise_v2 to any delayed moves
+                    if (!update_flush_count && i < flush_count) {
+                        double mc_v2 = peak_cruise_v2;
+                        while (num_delayed) {
+                            struct lookahead_delayed *d
+                                = &delayed[--num_delayed];
+                            mc_v2 = la_min(mc_v2, d->start_v2);
+                            la_set(&junctions[d->index]
+                                   , la_min(d->start_v2, mc_v2), mc_v2
+                                   , la_min(d->end_v2, mc_v2));
+                        }
+                    }
+                    num_delayed = 0;
+                }
+            }
+            if (!update_flush_count && i < flush_count) {
+                double cruise_v2 = la_min(la_min(
+                    (start_v2 + reachable_start_v2) * .5, m->max_cruise_v2)
+                                          , peak_cruise_v2);
+                la_set(&junctions[i], la_min(start_v2, cruise_v2), cruise_v2
+                       , la_min(next_end_v2, cruise_v2));
+            }
+        } else {
+            // Delay calculating this move until peak_cruise_v2 is known
+            struct lookahead_delayed *d = &delayed[num_delayed++];
+            d->index = i;
+            d->start_v2 = start_v2;
+            d->end_v2 = next_end_v2;
+        }
+        next_end_v2 = start_v2;
+        next_smoothed_v2 = smoothed_v2;
+    }
+    if (update_flush_count)
+        return 0;
+    return flush_count;
+}
@@ -0,0 +1,22 @@
+#ifndef LOOKAHEAD_H
+#define LOOKAHEAD_H
+
+struct lookahead_move {
+    double max_start_v2, delta_v2, max_smoothed_v2, smooth_delta_v2;
+    double max_cruise_v2;
+};
+
+struct lookahead_junction {
+    double start_v2, cruise_v2, end_v2;
+};
+
+struct lookahead_delayed {
+    int index;
+    double start_v2, end_v2;
+};
+
+int lookahead_flush(struct lookahead_move *moves, int count, int lazy
+                    , struct lookahead_junction *junctions
+                    , struct lookahead_delayed *delayed);
+
+#endif // lookahead.h
@@ -24,6 +24,7 @@ struct queue_message {
         // Filled when on a command queue
         struct {
             uint64_t min_clock, req_clock;
+            double ready_time;
         };
         // Filled when in sent/receive queues
         struct {
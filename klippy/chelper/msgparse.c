@@ -0,0 +1,253 @@
+// Encoding and decoding of mcu messages using the data dictionary
+//
+// Copyright (C) 2026  The Klipper developers
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// The host code registers the parameter types of each response
+// message (as found in the mcu data dictionary) and can then decode
+// incoming message blocks without parsing each vlq in python.  The
+// msgproto.MessageFormat class also uses this code to encode and
+// parse individual messages.
+
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "msgblock.h" // MESSAGE_HEADER_SIZE
+#include "msgparse.h" // msgparse_decode
+#include "serialqueue.h" // serialqueue_pull
+
+struct msgparser {
+    struct msgparse_format *formats[MSGPARSE_MAX_ID];
+};
+
+// Parse a "variable length quantity" without reading past 'end'.
+// Values are decoded the same way as msgproto.PT_uint32.parse() -
+// encodings longer than five bytes are rejected.
+static int
+parse_vlq(uint8_t **pp, uint8_t *end, int64_t *pv)
+{
+    uint8_t *p = *pp;
+    if (p >= end)
+        return -1;
+    uint8_t c = *p++;
+    uint64_t v = c & 0x7f;
+    if ((c & 0x60) == 0x60)
+        v |= -0x20;
+    int count = 1;
+    while (c & 0x80) {
+        if (p >= end || ++count > 5)
+            return -1;
+        c = *p++;
+        v = (v<<7) | (c & 0x7f);
+    }
+    *pp = p;
+    *pv = v;
+    return 0;
+}
+
+// Encode a "variable length quantity" (the same as
+// msgproto.PT_uint32.encode())
+static uint8_t *
+encode_vlq(uint8_t *p, int64_t v)
+{
+    if (v >= 0xc000000 || v < -0x4000000) *p++ = ((v>>28) & 0x7f) | 0x80;
+    if (v >= 0x180000 || v < -0x80000)    *p++ = ((v>>21) & 0x7f) | 0x80;
+    if (v >= 0x3000 || v < -0x1000)       *p++ = ((v>>14) & 0x7f) | 0x80;
+    if (v >= 0x60 || v < -0x20)           *p++ = ((v>>7) & 0x7f) | 0x80;
+    *p++ = v & 0x7f;
+    return p;
+}
+
+// Fill a format from a string of parameter type codes
+int __visible
+msgparse_format_init(struct msgparse_format *mf, const char *types)
+{
+    int len = strlen(types), i;
+    if (len > MSGPARSE_MAX_PARAMS)
+        return -1;
+    for (i=0; i<len; i++)
+        if (types[i] != MPT_UINT && types[i] != MPT_INT
+            && types[i] != MPT_BUFFER)
+            return -1;
+    memset(mf, 0, sizeof(*mf));
+    memcpy(mf->types, types, len);
+    mf->num_params = len;
+    return 0;
+}
+
+// Parse the parameters of the message whose id is at 'pos' in 'data'.
+// Integers are stored in 'params' and buffers are stored as the
+// offset of their data in 'data' (the length is the byte before it).
+// Returns the position after the message or -1 on a parse error.
+int __visible
+msgparse_parse_format(struct msgparse_format *mf, uint8_t *data, int len
+                      , int pos, int64_t *params)
+{
+    if (pos < 0 || pos >= len)
+        return -1;
+    uint8_t *p = &data[pos + 1], *end = &data[len];
+    int i;
+    for (i=0; i<mf->num_params; i++) {
+        int64_t v;
+        switch (mf->types[i]) {
+        case MPT_UINT:
+            if (parse_vlq(&p, end, &v))
+                return -1;
+            params[i] = (uint32_t)v;
+            break;
+        case MPT_INT:
+            if (parse_vlq(&p, end, &v))
+                return -1;
+            params[i] = v;
+            break;
+        case MPT_BUFFER:
+            if (p >= end || *p > end - p - 1)
+                return -1;
+            params[i] = p + 1 - data;
+            p += *p + 1;
+            break;
+        }
+    }
+    return p - data;
+}
+
+// Decode the parameters of a message block with the given format
+int
+msgparse_decode_format(struct msgparse_format *mf, uint8_t *msg, int len
+                       , int64_t *params)
+{
+    int end = len - MESSAGE_TRAILER_SIZE;
+    int ret = msgparse_parse_format(mf, msg, end, MESSAGE_HEADER_SIZE
+                                    , params);
+    if (ret != end)
+        // Parse error or extra data at end of message
+        return -1;
+    return 0;
+}
+
+// Encode a message with the given format.  Integers are read from
+// 'params', buffer parameters store their length in 'params' and
+// their data is read sequentially from 'bufdata'.  Returns the length
+// of the message or -1 if it does not fit in 'maxlen' bytes.
+int __visible
+msgparse_encode_format(struct msgparse_format *mf, int msgid
+                       , int64_t *params, uint8_t *bufdata
+                       , uint8_t *out, int maxlen)
+{
+    if (maxlen < 1)
+        return -1;
+    *out = msgid;
+    int i, pos = 1;
+    for (i=0; i<mf->num_params; i++) {
+        if (mf->types[i] != MPT_BUFFER) {
+            uint8_t vlq[5];
+            int vlen = encode_vlq(vlq, params[i]) - vlq;
+            if (vlen > maxlen - pos)
+                return -1;
+            memcpy(&out[pos], vlq, vlen);
+            pos += vlen;
+            continue;
+        }
+        int64_t blen = params[i];
+        if (blen < 0 || blen > 0xff || blen + 1 > maxlen - pos)
+            return -1;
+        out[pos++] = blen;
+        memcpy(&out[pos], bufdata, blen);
+        bufdata += blen;
+        pos += blen;
+    }
+    return pos;
+}
+
+// Encode a message and schedule its transmission on a serialqueue.
+// Returns -1 (without sending anything) if the message could not be
+// encoded.
+int __visible
+msgparse_send(struct serialqueue *sq, struct command_queue *cq
+              , struct msgparse_format *mf, int msgid, int64_t *params
+              , uint8_t *bufdata, uint64_t min_clock, uint64_t req_clock
+              , uint64_t notify_id)
+{
+    struct queue_message *qm = message_alloc();
+    int len = msgparse_encode_format(mf, msgid, params, bufdata, qm->msg
+                                     , MESSAGE_PAYLOAD_MAX);
+    if (len < 0) {
+        message_free(qm);
+        return -1;
+    }
+    qm->len = len;
+    qm->min_clock = min_clock;
+    qm->req_clock = req_clock;
+    qm->notify_id = notify_id;
+    serialqueue_send_one(sq, cq, qm);
+    return 0;
+}
+
+// Allocate a 'struct msgparser' object
+struct msgparser * __visible
+msgparse_alloc(void)
+{
+    struct msgparser *mp = malloc(sizeof(*mp));
+    memset(mp, 0, sizeof(*mp));
+    return mp;
+}
+
+// Free a 'struct msgparser' object
+void __visible
+msgparse_free(struct msgparser *mp)
+{
+    if (!mp)
+        return;
+    int i;
+    for (i=0; i<MSGPARSE_MAX_ID; i++)
+        free(mp->formats[i]);
+    free(mp);
+}
+
+// Register the parameter types of a message id
+int __visible
+msgparse_add_format(struct msgparser *mp, int msgid, const char *types)
+{
+    if (msgid < 0 || msgid >= MSGPARSE_MAX_ID)
+        return -1;
+    struct msgparse_format *mf = malloc(sizeof(*mf));
+    if (msgparse_format_init(mf, types)) {
+        free(mf);
+        return -1;
+    }
+    free(mp->formats[msgid]);
+    mp->formats[msgid] = mf;
+    return 0;
+}
+
+// Decode a message block.  Returns -1 if the message id is not
+// registered or if the message does not match its format.
+int __visible
+msgparse_decode(struct msgparser *mp, uint8_t *msg, int len
+                , struct msgparse_result *res)
+{
+    if (len <= MESSAGE_MIN || len > MESSAGE_MAX)
+        return -1;
+    int msgid = msg[MESSAGE_HEADER_SIZE];
+    if (msgid >= MSGPARSE_MAX_ID)
+        return -1;
+    struct msgparse_format *mf = mp->formats[msgid];
+    if (!mf || msgparse_decode_format(mf, msg, len, res->params))
+        return -1;
+    res->msgid = msgid;
+    res->num_params = mf->num_params;
+    return 0;
+}
+
+// Wait for the next message from a serialqueue and decode it.  The
+// 'res->msgid' field is set to -1 if the message was not decoded.
+void __visible
+msgparse_pull(struct msgparser *mp, struct serialqueue *sq
+              , struct pull_queue_message *pqm, struct msgparse_result *res)
+{
+    serialqueue_pull(sq, pqm);
+    res->msgid = -1;
+    if (pqm->len > 0)
+        msgparse_decode(mp, pqm->msg, pqm->len, res);
+}
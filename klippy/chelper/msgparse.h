@@ -0,0 +1,48 @@
+#ifndef MSGPARSE_H
+#define MSGPARSE_H
+
+#include <stdint.h> // uint8_t
+
+#define MSGPARSE_MAX_ID 128
+#define MSGPARSE_MAX_PARAMS 16
+
+// Parameter types
+#define MPT_UINT 'u'
+#define MPT_INT 'i'
+#define MPT_BUFFER 's'
+
+struct msgparse_format {
+    int num_params;
+    char types[MSGPARSE_MAX_PARAMS];
+};
+
+struct msgparse_result {
+    int msgid, num_params;
+    int64_t params[MSGPARSE_MAX_PARAMS];
+};
+
+int msgparse_format_init(struct msgparse_format *mf, const char *types);
+int msgparse_parse_format(struct msgparse_format *mf, uint8_t *data, int len
+                          , int pos, int64_t *params);
+int msgparse_decode_format(struct msgparse_format *mf, uint8_t *msg, int len
+                           , int64_t *params);
+int msgparse_encode_format(struct msgparse_format *mf, int msgid
+                           , int64_t *params, uint8_t *bufdata
+                           , uint8_t *out, int maxlen);
+struct msgparser *msgparse_alloc(void);
+void msgparse_free(struct msgparser *mp);
+int msgparse_add_format(struct msgparser *mp, int msgid, const char *types);
+int msgparse_decode(struct msgparser *mp, uint8_t *msg, int len
+                    , struct msgparse_result *res);
+struct serialqueue;
+struct command_queue;
+struct pull_queue_message;
+int msgparse_send(struct serialqueue *sq, struct command_queue *cq
+                  , struct msgparse_format *mf, int msgid, int64_t *params
+                  , uint8_t *bufdata, uint64_t min_clock, uint64_t req_clock
+                  , uint64_t notify_id);
+void msgparse_pull(struct msgparser *mp, struct serialqueue *sq
+                   , struct pull_queue_message *pqm
+                   , struct msgparse_result *res);
+
+#endif // msgparse.h
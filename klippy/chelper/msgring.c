@@ -0,0 +1,180 @@
+// Store decoded mcu responses for one oid in a ring buffer
+//
+// Copyright (C) 2026  The Klipper developers
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// A msgring claims all responses with a given msgtag and oid (using
+// a serialqueue fastreader) so that high rate messages do not need to
+// be dispatched to python one at a time.  Each message is decoded and
+// stored as a fixed size record:
+//   double receive_time;
+//   uint32_t params[num_params]; // buffer params store their length
+//   uint8_t data[buf_size];      // contents of the buffer param
+// The record size is rounded up to a multiple of 8 bytes.
+
+#include <pthread.h> // pthread_mutex_lock
+#include <stddef.h> // offsetof
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "msgblock.h" // message_alloc_and_encode
+#include "msgparse.h" // msgparse_decode_format
+#include "msgring.h" // msgring_alloc
+#include "pyhelper.h" // get_monotonic
+#include "serialqueue.h" // serialqueue_add_fastreader
+
+struct msgring {
+    struct fastreader fr;
+    struct serialqueue *sq;
+    struct msgparse_format mf;
+    int buf_param, buf_size, record_size, max_records;
+
+    pthread_mutex_t lock; // protects variables below
+    uint8_t *records;
+    int head, count;
+    uint32_t overflows;
+};
+
+// Handle a matching message (callback from serialqueue fastreader)
+static void
+handle_message(struct fastreader *fr, uint8_t *data, int len)
+{
+    struct msgring *mr = container_of(fr, struct msgring, fr);
+    double receive_time = get_monotonic();
+    int64_t params[MSGPARSE_MAX_PARAMS];
+    int ret = msgparse_decode_format(&mr->mf, data, len, params);
+    if (ret)
+        return;
+
+    pthread_mutex_lock(&mr->lock);
+    if (mr->count >= mr->max_records) {
+        mr->overflows++;
+        goto done;
+    }
+    int pos = (mr->head + mr->count) % mr->max_records;
+    uint8_t *rec = &mr->records[pos * mr->record_size];
+    memset(rec, 0, mr->record_size);
+    memcpy(rec, &receive_time, sizeof(receive_time));
+    uint32_t *rparams = (void*)&rec[sizeof(receive_time)];
+    int i;
+    for (i=0; i<mr->mf.num_params; i++) {
+        if (i != mr->buf_param) {
+            rparams[i] = params[i];
+            continue;
+        }
+        int buf_len = data[params[i] - 1];
+        if (buf_len > mr->buf_size)
+            buf_len = mr->buf_size;
+        rparams[i] = buf_len;
+        memcpy(&rparams[mr->mf.num_params], &data[params[i]], buf_len);
+    }
+    mr->count++;
+done:
+    pthread_mutex_unlock(&mr->lock);
+}
+
+// Create a ring buffer for messages with the given 'msgtag' and
+// 'oid'.  The 'types' string describes the message parameters (see
+// msgparse.h) - the first parameter must be the oid and at most one
+// parameter may be a buffer.
+struct msgring * __visible
+msgring_alloc(struct serialqueue *sq, uint32_t msgtag, uint32_t oid
+              , const char *types, int buf_size, int max_records)
+{
+    if (max_records <= 0 || buf_size < 0 || buf_size > MESSAGE_MAX
+        || types[0] != MPT_UINT)
+        return NULL;
+    struct msgring *mr = malloc(sizeof(*mr));
+    memset(mr, 0, sizeof(*mr));
+    if (msgparse_format_init(&mr->mf, types))
+        goto fail;
+    mr->buf_param = -1;
+    int i;
+    for (i=0; i<mr->mf.num_params; i++) {
+        if (mr->mf.types[i] != MPT_BUFFER)
+            continue;
+        if (mr->buf_param >= 0)
+            goto fail;
+        mr->buf_param = i;
+    }
+    mr->buf_size = mr->buf_param >= 0 ? buf_size : 0;
+    int size = sizeof(double) + mr->mf.num_params * 4 + mr->buf_size;
+    mr->record_size = (size + 7) & ~7;
+    mr->max_records = max_records;
+    mr->records = malloc(mr->record_size * max_records);
+    if (!mr->records)
+        goto fail;
+    int ret = pthread_mutex_init(&mr->lock, NULL);
+    if (ret) {
+        report_errno("msgring init", ret);
+        goto fail;
+    }
+
+    // Setup fastreader to claim matching messages
+    uint32_t prefix[] = {msgtag, oid};
+    struct queue_message *dummy = message_alloc_and_encode(
+        prefix, ARRAY_SIZE(prefix));
+    memcpy(mr->fr.prefix, dummy->msg, dummy->len);
+    mr->fr.prefix_len = dummy->len;
+    free(dummy);
+    mr->fr.func = handle_message;
+    mr->fr.exclusive = 1;
+    mr->sq = sq;
+    serialqueue_add_fastreader(sq, &mr->fr);
+    return mr;
+
+fail:
+    free(mr->records);
+    free(mr);
+    return NULL;
+}
+
+// Stop receiving messages and free a 'struct msgring'
+void __visible
+msgring_free(struct msgring *mr)
+{
+    if (!mr)
+        return;
+    serialqueue_rm_fastreader(mr->sq, &mr->fr);
+    pthread_mutex_destroy(&mr->lock);
+    free(mr->records);
+    free(mr);
+}
+
+// Return the size (in bytes) of each record
+int __visible
+msgring_get_record_size(struct msgring *mr)
+{
+    return mr->record_size;
+}
+
+// Copy up to 'max_records' of the oldest records into 'buf' and
+// remove them from the ring.  Returns the number of records copied.
+int __visible
+msgring_pull(struct msgring *mr, uint8_t *buf, int max_records)
+{
+    pthread_mutex_lock(&mr->lock);
+    int count = mr->count < max_records ? mr->count : max_records;
+    int first = mr->max_records - mr->head;
+    if (first > count)
+        first = count;
+    memcpy(buf, &mr->records[mr->head * mr->record_size]
+           , first * mr->record_size);
+    memcpy(&buf[first * mr->record_size], mr->records
+           , (count - first) * mr->record_size);
+    mr->head = (mr->head + count) % mr->max_records;
+    mr->count -= count;
+    pthread_mutex_unlock(&mr->lock);
+    return count;
+}
+
+// Return the number of messages dropped because the ring was full
+uint32_t __visible
+msgring_get_overflows(struct msgring *mr)
+{
+    pthread_mutex_lock(&mr->lock);
+    uint32_t overflows = mr->overflows;
+    pthread_mutex_unlock(&mr->lock);
+    return overflows;
+}
@@ -0,0 +1,15 @@
+#ifndef MSGRING_H
+#define MSGRING_H
+
+#include <stdint.h> // uint8_t
+
+struct serialqueue;
+struct msgring *msgring_alloc(struct serialqueue *sq, uint32_t msgtag
+                              , uint32_t oid, const char *types, int buf_size
+                              , int max_records);
+void msgring_free(struct msgring *mr);
+int msgring_get_record_size(struct msgring *mr);
+int msgring_pull(struct msgring *mr, uint8_t *buf, int max_records);
+uint32_t msgring_get_overflows(struct msgring *mr);
+
+#endif // msgring.h
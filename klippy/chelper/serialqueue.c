@@ -32,6 +32,7 @@
 struct command_queue {
     struct list_head upcoming_queue, ready_queue;
     struct list_node node;
+    int priority;
 };
 
 struct serialqueue {
@@ -61,6 +62,7 @@ struct serialqueue {
     struct list_head pending_queues;
     int ready_bytes, upcoming_bytes, need_ack_bytes, last_ack_bytes;
     uint64_t need_kick_clock;
+    int priority_credit[SQ_PRIORITY_NUM];
     struct list_head notify_queue;
     double last_write_fail_time;
     // Received messages
@@ -72,6 +74,8 @@ struct serialqueue {
     struct list_head old_sent, old_receive;
     // Stats
     uint32_t bytes_write, bytes_read, bytes_retransmit, bytes_invalid;
+    uint32_t priority_bytes[SQ_PRIORITY_NUM];
+    double priority_delay[SQ_PRIORITY_NUM];
 };
 
 #define SQPF_SERIAL 0
@@ -92,6 +96,15 @@ struct serialqueue {
 #define MIN_REQTIME_DELTA 0.250
 #define MIN_BACKGROUND_DELTA 0.005
 #define IDLE_QUERY_TIME 1.0
+#define MIN_URGENT_DELTA 0.050
+#define PRIORITY_DELAY_WEIGHT (1. / 16.)
+
+// Bandwidth budget of each command queue priority class (in 1/256ths
+// of the transmitted bytes).  A class may send its messages ahead of
+// the normal req_clock ordering while it has budget credit available.
+static const int priority_share[SQ_PRIORITY_NUM] = { 64, 26, 0 };
+#define PRIORITY_SHARE_SCALE 256
+#define MAX_PRIORITY_CREDIT (MESSAGE_PAYLOAD_MAX * 2 * PRIORITY_SHARE_SCALE)
 
 #define DEBUG_QUEUE_SENT 100
 #define DEBUG_QUEUE_RECEIVE 100
@@ -215,6 +228,20 @@ update_receive_seq(struct serialqueue *sq, double eventtime, uint64_t rseq)
     }
 }
 
+// Find the fast reader (if any) that handles the current input message
+static struct fastreader *
+find_fastreader(struct serialqueue *sq, int len)
+{
+    struct fastreader *fr;
+    list_for_each_entry(fr, &sq->fast_readers, node) {
+        if (len >= fr->prefix_len + MESSAGE_MIN
+            && memcmp(&sq->input_buf[MESSAGE_HEADER_SIZE]
+                      , fr->prefix, fr->prefix_len) == 0)
+            return fr;
+    }
+    return NULL;
+}
+
 // Process a well formed input message
 static void
 handle_message(struct serialqueue *sq, double eventtime, int len)
@@ -255,6 +282,7 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
     }
 
     // Process message
+    struct fastreader *fr = NULL;
     if (len == MESSAGE_MIN) {
         // Ack/nak message
         if (sq->last_ack_seq < rseq)
@@ -263,24 +291,24 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
             // Duplicate Ack is a Nak - do fast retransmit
             pollreactor_update_timer(sq->pr, SQPT_RETRANSMIT, PR_NOW);
     } else {
-        // Data message - add to receive queue
+        // Data message - add to receive queue (or only to the debug
+        // queue if claimed by a fast reader)
+        fr = find_fastreader(sq, len);
         struct queue_message *qm = message_fill(sq->input_buf, len);
         qm->sent_time = (rseq > sq->retransmit_seq
                          ? sq->last_receive_sent_time : 0.);
         qm->receive_time = get_monotonic(); // must be time post read()
         qm->receive_time -= calculate_bittime(sq, len);
-        list_add_tail(&qm->node, &sq->receive_queue);
-        must_wake = 1;
+        if (fr && fr->exclusive) {
+            debug_queue_add(&sq->old_receive, qm);
+        } else {
+            list_add_tail(&qm->node, &sq->receive_queue);
+            must_wake = 1;
+        }
     }
 
-    // Check fast readers
-    struct fastreader *fr;
-    list_for_each_entry(fr, &sq->fast_readers, node) {
-        if (len < fr->prefix_len + MESSAGE_MIN
-            || memcmp(&sq->input_buf[MESSAGE_HEADER_SIZE]
-                      , fr->prefix, fr->prefix_len) != 0)
-            continue;
-        // Release main lock and invoke callback
+    if (fr) {
+        // Release main lock and invoke fast reader callback
         pthread_mutex_lock(&sq->fast_reader_dispatch_lock);
         if (must_wake)
             check_wake_receive(sq);
@@ -440,28 +468,90 @@ retransmit_event(struct serialqueue *sq, double eventtime)
     return waketime;
 }
 
+// Find the command queue holding the next message to transmit.
+// Messages are normally sent in req_clock order, but a higher
+// priority class may jump ahead of that order while it has budget
+// credit available.  Messages close to their deadline are never
+// delayed by a higher priority class.
+static struct command_queue *
+find_next_queue(struct serialqueue *sq, uint64_t urgent_clock
+                , int *use_credit)
+{
+    uint64_t min_clock = MAX_CLOCK, prio_clock[SQ_PRIORITY_NUM];
+    struct command_queue *q, *cq = NULL, *prio_cq[SQ_PRIORITY_NUM];
+    int i;
+    for (i=0; i<SQ_PRIORITY_NUM; i++) {
+        prio_clock[i] = MAX_CLOCK;
+        prio_cq[i] = NULL;
+    }
+    list_for_each_entry(q, &sq->pending_queues, node) {
+        if (list_empty(&q->ready_queue))
+            continue;
+        struct queue_message *m = list_first_entry(
+            &q->ready_queue, struct queue_message, node);
+        if (m->req_clock < min_clock) {
+            min_clock = m->req_clock;
+            cq = q;
+        }
+        int p = q->priority;
+        if (m->req_clock < prio_clock[p]
+            && m->req_clock != BACKGROUND_PRIORITY_CLOCK
+            && sq->priority_credit[p] >= m->len * PRIORITY_SHARE_SCALE) {
+            prio_clock[p] = m->req_clock;
+            prio_cq[p] = q;
+        }
+    }
+    *use_credit = 0;
+    if (min_clock <= urgent_clock)
+        return cq;
+    for (i=0; i<cq->priority; i++) {
+        if (prio_cq[i]) {
+            *use_credit = 1;
+            return prio_cq[i];
+        }
+    }
+    return cq;
+}
+
+// Update the priority class budgets and stats after sending a message
+static void
+update_priority_stats(struct serialqueue *sq, struct queue_message *qm
+                      , int priority, int use_credit, double sendtime)
+{
+    int i;
+    for (i=0; i<SQ_PRIORITY_NUM; i++) {
+        int credit = sq->priority_credit[i] + qm->len * priority_share[i];
+        if (credit > MAX_PRIORITY_CREDIT)
+            credit = MAX_PRIORITY_CREDIT;
+        sq->priority_credit[i] = credit;
+    }
+    if (use_credit)
+        sq->priority_credit[priority] -= qm->len * PRIORITY_SHARE_SCALE;
+    sq->priority_bytes[priority] += qm->len;
+    double delay = sendtime - qm->ready_time;
+    if (delay < 0.)
+        delay = 0.;
+    sq->priority_delay[priority] += ((delay - sq->priority_delay[priority])
+                                     * PRIORITY_DELAY_WEIGHT);
+}
+
 // Construct a block of data to be sent to the serial port
 static int
 build_and_send_command(struct serialqueue *sq, uint8_t *buf, int pending
                        , double eventtime)
 {
+    double sendtime = eventtime > sq->idle_time ? eventtime : sq->idle_time;
+    sendtime += calculate_bittime(sq, pending);
+    uint64_t urgent_clock = clock_from_time(&sq->ce
+                                            , sendtime + MIN_URGENT_DELTA);
     int len = MESSAGE_HEADER_SIZE;
     while (sq->ready_bytes) {
-        // Find highest priority message (message with lowest req_clock)
-        uint64_t min_clock = MAX_CLOCK;
-        struct command_queue *q, *cq = NULL;
-        struct queue_message *qm = NULL;
-        list_for_each_entry(q, &sq->pending_queues, node) {
-            if (!list_empty(&q->ready_queue)) {
-                struct queue_message *m = list_first_entry(
-                    &q->ready_queue, struct queue_message, node);
-                if (m->req_clock < min_clock) {
-                    min_clock = m->req_clock;
-                    cq = q;
-                    qm = m;
-                }
-            }
-        }
+        // Find highest priority message
+        int use_credit;
+        struct command_queue *cq = find_next_queue(sq, urgent_clock
+                                                   , &use_credit);
+        struct queue_message *qm = list_first_entry(
+            &cq->ready_queue, struct queue_message, node);
         // Append message to outgoing command
         if (len + qm->len > MESSAGE_MAX - MESSAGE_TRAILER_SIZE)
             break;
@@ -471,6 +561,7 @@ build_and_send_command(struct serialqueue *sq, uint8_t *buf, int pending
         memcpy(&buf[len], qm->msg, qm->len);
         len += qm->len;
         sq->ready_bytes -= qm->len;
+        update_priority_stats(sq, qm, cq->priority, use_credit, sendtime);
         if (qm->notify_id) {
             // Message requires notification - add to notify list
             qm->req_clock = sq->send_seq;
@@ -542,6 +633,7 @@ check_send_command(struct serialqueue *sq, int pending, double eventtime)
             }
             list_del(&qm->node);
             list_add_tail(&qm->node, &cq->ready_queue);
+            qm->ready_time = eventtime;
             sq->upcoming_bytes -= qm->len;
             sq->ready_bytes += qm->len;
         }
@@ -630,6 +722,9 @@ serialqueue_alloc(int serial_fd, char serial_fd_type, int client_id)
     sq->serial_fd = serial_fd;
     sq->serial_fd_type = serial_fd_type;
     sq->client_id = client_id;
+    int i;
+    for (i=0; i<SQ_PRIORITY_NUM; i++)
+        sq->priority_credit[i] = MAX_PRIORITY_CREDIT;
 
     int ret = pipe(sq->pipe_fds);
     if (ret)
@@ -737,9 +832,19 @@ serialqueue_alloc_commandqueue(void)
     memset(cq, 0, sizeof(*cq));
     list_init(&cq->ready_queue);
     list_init(&cq->upcoming_queue);
+    cq->priority = SQ_PRIORITY_NORMAL;
     return cq;
 }
 
+// Set the priority class of a 'struct command_queue'
+void __visible
+serialqueue_set_commandqueue_priority(struct command_queue *cq, int priority)
+{
+    if (priority < 0 || priority >= SQ_PRIORITY_NUM)
+        priority = SQ_PRIORITY_NORMAL;
+    cq->priority = priority;
+}
+
 // Free a 'struct command_queue'
 void __visible
 serialqueue_free_commandqueue(struct command_queue *cq)
@@ -934,12 +1039,21 @@ serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
              " send_seq=%u receive_seq=%u retransmit_seq=%u"
              " srtt=%.3f rttvar=%.3f rto=%.3f"
              " ready_bytes=%u upcoming_bytes=%u"
+             " high_bytes=%u high_delay=%.4f"
+             " normal_bytes=%u normal_delay=%.4f"
+             " bulk_bytes=%u bulk_delay=%.4f"
              , stats.bytes_write, stats.bytes_read
              , stats.bytes_retransmit, stats.bytes_invalid
              , (int)stats.send_seq, (int)stats.receive_seq
              , (int)stats.retransmit_seq
              , stats.srtt, stats.rttvar, stats.rto
-             , stats.ready_bytes, stats.upcoming_bytes);
+             , stats.ready_bytes, stats.upcoming_bytes
+             , stats.priority_bytes[SQ_PRIORITY_HIGH]
+             , stats.priority_delay[SQ_PRIORITY_HIGH]
+             , stats.priority_bytes[SQ_PRIORITY_NORMAL]
+             , stats.priority_delay[SQ_PRIORITY_NORMAL]
+             , stats.priority_bytes[SQ_PRIORITY_BULK]
+             , stats.priority_delay[SQ_PRIORITY_BULK]);
 }
 
 // Extract old messages stored in the debug queues
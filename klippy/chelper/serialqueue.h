@@ -8,12 +8,19 @@
 #define MAX_CLOCK 0x7fffffffffffffffLL
 #define BACKGROUND_PRIORITY_CLOCK 0x7fffffff00000000LL
 
+// Command queue priority classes
+#define SQ_PRIORITY_HIGH   0
+#define SQ_PRIORITY_NORMAL 1
+#define SQ_PRIORITY_BULK   2
+#define SQ_PRIORITY_NUM    3
+
 struct fastreader;
 typedef void (*fastreader_cb)(struct fastreader *fr, uint8_t *data, int len);
 
 struct fastreader {
     struct list_node node;
     fastreader_cb func;
+    int exclusive; // matching messages are not added to the receive queue
     int prefix_len;
     uint8_t prefix[MESSAGE_MAX];
 };
@@ -32,6 +39,8 @@ void serialqueue_exit(struct serialqueue *sq);
 void serialqueue_free(struct serialqueue *sq);
 struct command_queue *serialqueue_alloc_commandqueue(void);
 void serialqueue_free_commandqueue(struct command_queue *cq);
+void serialqueue_set_commandqueue_priority(struct command_queue *cq
+                                           , int priority);
 void serialqueue_add_fastreader(struct serialqueue *sq, struct fastreader *fr);
 void serialqueue_rm_fastreader(struct serialqueue *sq, struct fastreader *fr);
 void serialqueue_send_batch(struct serialqueue *sq, struct command_queue *cq
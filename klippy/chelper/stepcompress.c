@@ -697,6 +697,7 @@ steppersync_alloc(struct serialqueue *sq, struct stepcompress **sc_list
     memset(ss, 0, sizeof(*ss));
     ss->sq = sq;
     ss->cq = serialqueue_alloc_commandqueue();
+    serialqueue_set_commandqueue_priority(ss->cq, SQ_PRIORITY_BULK);
 
     ss->sc_list = malloc(sizeof(*sc_list)*sc_num);
     memcpy(ss->sc_list, sc_list, sizeof(*sc_list)*sc_num);
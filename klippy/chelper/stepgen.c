@@ -0,0 +1,163 @@
+// Generate step times for several steppers in parallel
+//
+// Copyright (C) 2026  The Klipper developers
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// Each stepper has its own stepper_kinematics and stepcompress
+// objects, so the itersolve_generate_steps() calls for different
+// steppers are independent.  The only shared state is the trapq,
+// which is only read during step generation once its sentinels have
+// been updated.
+
+#include <pthread.h> // pthread_mutex_lock
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "itersolve.h" // itersolve_generate_steps
+#include "pyhelper.h" // report_errno
+#include "stepgen.h" // stepgen_pool_alloc
+#include "trapq.h" // trapq_check_sentinels
+
+struct stepgen_pool {
+    pthread_t *threads;
+    int num_threads;
+
+    pthread_mutex_t lock; // protects variables below
+    pthread_cond_t work_cond, done_cond;
+    int exiting;
+    struct stepper_kinematics **sks;
+    int count, next, pending;
+    double flush_time;
+    int32_t result;
+};
+
+// Generate steps for queued steppers until there is no more work.
+// Called with the pool lock held.
+static void
+run_work(struct stepgen_pool *sp)
+{
+    while (sp->next < sp->count) {
+        struct stepper_kinematics *sk = sp->sks[sp->next++];
+        double flush_time = sp->flush_time;
+        pthread_mutex_unlock(&sp->lock);
+        int32_t ret = itersolve_generate_steps(sk, flush_time);
+        pthread_mutex_lock(&sp->lock);
+        if (ret && !sp->result)
+            sp->result = ret;
+        if (!--sp->pending)
+            pthread_cond_signal(&sp->done_cond);
+    }
+}
+
+// Main code for worker threads
+static void *
+worker_thread(void *data)
+{
+    struct stepgen_pool *sp = data;
+    pthread_mutex_lock(&sp->lock);
+    while (!sp->exiting) {
+        run_work(sp);
+        pthread_cond_wait(&sp->work_cond, &sp->lock);
+    }
+    pthread_mutex_unlock(&sp->lock);
+    return NULL;
+}
+
+// Stop and free all worker threads
+static void
+stop_threads(struct stepgen_pool *sp)
+{
+    pthread_mutex_lock(&sp->lock);
+    sp->exiting = 1;
+    pthread_cond_broadcast(&sp->work_cond);
+    pthread_mutex_unlock(&sp->lock);
+    int i;
+    for (i = 0; i < sp->num_threads; i++) {
+        int ret = pthread_join(sp->threads[i], NULL);
+        if (ret)
+            report_errno("pthread_join", ret);
+    }
+    free(sp->threads);
+    sp->threads = NULL;
+    sp->num_threads = 0;
+}
+
+// Free a 'stepgen_pool' object
+void __visible
+stepgen_pool_free(struct stepgen_pool *sp)
+{
+    if (!sp)
+        return;
+    stop_threads(sp);
+    pthread_mutex_destroy(&sp->lock);
+    pthread_cond_destroy(&sp->work_cond);
+    pthread_cond_destroy(&sp->done_cond);
+    free(sp);
+}
+
+// Create a pool with 'num_threads' background threads.  The calling
+// thread also generates steps, so num_threads may be zero.
+struct stepgen_pool * __visible
+stepgen_pool_alloc(int num_threads)
+{
+    struct stepgen_pool *sp = malloc(sizeof(*sp));
+    memset(sp, 0, sizeof(*sp));
+    int ret = pthread_mutex_init(&sp->lock, NULL);
+    if (ret)
+        goto fail_init;
+    ret = pthread_cond_init(&sp->work_cond, NULL);
+    if (ret)
+        goto fail_init;
+    ret = pthread_cond_init(&sp->done_cond, NULL);
+    if (ret)
+        goto fail_init;
+    sp->threads = malloc(sizeof(*sp->threads) * (num_threads + 1));
+    int i;
+    for (i = 0; i < num_threads; i++) {
+        ret = pthread_create(&sp->threads[i], NULL, worker_thread, sp);
+        if (ret)
+            goto fail;
+        sp->num_threads++;
+    }
+    return sp;
+
+fail:
+    report_errno("stepgen pthread_create", ret);
+    stepgen_pool_free(sp);
+    return NULL;
+fail_init:
+    report_errno("stepgen init", ret);
+    free(sp);
+    return NULL;
+}
+
+// Generate steps for all the given steppers up to 'flush_time'.
+// Returns zero on success or the first error reported by
+// itersolve_generate_steps().
+int32_t __visible
+stepgen_pool_generate(struct stepgen_pool *sp, struct stepper_kinematics **sks
+                      , int count, double flush_time)
+{
+    // Update shared trapq sentinels before starting the worker threads
+    int i;
+    for (i = 0; i < count; i++)
+        if (sks[i]->tq)
+            trapq_check_sentinels(sks[i]->tq);
+    // Submit work and participate in step generation
+    pthread_mutex_lock(&sp->lock);
+    sp->sks = sks;
+    sp->count = sp->pending = count;
+    sp->next = 0;
+    sp->flush_time = flush_time;
+    sp->result = 0;
+    pthread_cond_broadcast(&sp->work_cond);
+    run_work(sp);
+    while (sp->pending)
+        pthread_cond_wait(&sp->done_cond, &sp->lock);
+    int32_t result = sp->result;
+    sp->sks = NULL;
+    sp->count = sp->next = 0;
+    pthread_mutex_unlock(&sp->lock);
+    return result;
+}
@@ -163,6 +163,31 @@ trapq_append(struct trapq *tq, double print_time
     }
 }
 
+// Add a list of moves to the trapezoid velocity queue
+static void
+trapq_append_list(struct trapq *tq, struct trapq_append_move *moves, int count)
+{
+    int i;
+    for (i = 0; i < count; i++) {
+        struct trapq_append_move *am = &moves[i];
+        trapq_append(tq, am->print_time, am->accel_t, am->cruise_t
+                     , am->decel_t, am->start_x, am->start_y, am->start_z
+                     , am->x_r, am->y_r, am->z_r
+                     , am->start_v, am->cruise_v, am->accel);
+    }
+}
+
+// Add a batch of toolhead moves and extruder moves in a single call
+void __visible
+trapq_append_batch(struct trapq *tq, struct trapq_append_move *moves
+                   , int count, struct trapq *etq
+                   , struct trapq_append_move *emoves, int ecount)
+{
+    trapq_append_list(tq, moves, count);
+    if (etq)
+        trapq_append_list(etq, emoves, ecount);
+}
+
 // Expire any moves older than `print_time` from the trapezoid velocity queue
 void __visible
 trapq_finalize_moves(struct trapq *tq, double print_time
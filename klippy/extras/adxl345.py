@@ -184,6 +184,31 @@ def read_axes_map(config):
         raise config.error("Invalid axes_map parameter")
     return [am[a.strip()] for a in axes_map]
 
+# Helper to convert arrays of raw (x, y, z) readings (as obtained from
+# BulkDataBatch.get_sample_arrays) to a list of (time, x, y, z) samples
+def build_array_samples(raw_xyz, valid, sequences, samples_per_block,
+                        axes_map, clock_updater, clock_sync, errors=None):
+    numpy = bulk_sensor.numpy
+    (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = axes_map
+    last_sequence = clock_updater.get_last_sequence()
+    time_base, chip_base, inv_freq = clock_sync.get_time_translation()
+    seq_diff = (sequences - last_sequence) & 0xffff
+    seq_diff -= (seq_diff & 0x8000) << 1
+    seq = last_sequence + seq_diff
+    msg_cdiff = seq * samples_per_block - chip_base
+    cdiff = msg_cdiff[:, None] + numpy.arange(valid.shape[1])
+    last_count = int(numpy.count_nonzero(valid[-1]))
+    clock_sync.set_last_chip_clock(
+        int(seq[-1]) * samples_per_block + last_count - 1)
+    if errors is not None:
+        valid = valid & ~errors
+    # Note that numpy.round() may differ from round() in the last digit
+    ptime = numpy.round(time_base + cdiff[valid] * inv_freq, 6)
+    x = numpy.round(raw_xyz[x_pos][valid] * x_scale, 6)
+    y = numpy.round(raw_xyz[y_pos][valid] * y_scale, 6)
+    z = numpy.round(raw_xyz[z_pos][valid] * z_scale, 6)
+    return list(zip(ptime.tolist(), x.tolist(), y.tolist(), z.tolist()))
+
 MIN_MSG_TIME = 0.100
 
 BYTES_PER_SAMPLE = 5
@@ -256,7 +281,21 @@ class ADXL345:
         self.batch_bulk.add_client(aqh.handle_batch)
         return aqh
     # Measurement decoding
+    def _extract_array_samples(self, raw_samples):
+        sequences, d, valid = raw_samples.get_sample_arrays(BYTES_PER_SAMPLE)
+        xlow, ylow, zlow, xzhigh, yzhigh = d.transpose((2, 0, 1))
+        errors = valid & ((yzhigh & 0x80) != 0)
+        self.last_error_count += int(errors.sum())
+        rx = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9)
+        ry = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9)
+        rz = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
+              - ((yzhigh & 0x40) << 7))
+        return build_array_samples((rx, ry, rz), valid, sequences,
+                                   SAMPLES_PER_BLOCK, self.axes_map,
+                                   self.clock_updater, self.clock_sync, errors)
     def _extract_samples(self, raw_samples):
+        if raw_samples.can_decode_arrays():
+            return self._extract_array_samples(raw_samples)
         # Load variables to optimize inner loop below
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
         last_sequence = self.clock_updater.get_last_sequence()
@@ -264,11 +303,10 @@ class ADXL345:
         # Process every message in raw_samples
         count = seq = 0
         samples = [None] * (len(raw_samples) * SAMPLES_PER_BLOCK)
-        for params in raw_samples:
-            seq_diff = (params['sequence'] - last_sequence) & 0xffff
+        for sequence, d in raw_samples.iter_messages():
+            seq_diff = (sequence - last_sequence) & 0xffff
             seq_diff -= (seq_diff & 0x8000) << 1
             seq = last_sequence + seq_diff
-            d = bytearray(params['data'])
             msg_cdiff = seq * SAMPLES_PER_BLOCK - chip_base
             for i in range(len(d) // BYTES_PER_SAMPLE):
                 d_xyz = d[i*BYTES_PER_SAMPLE:(i+1)*BYTES_PER_SAMPLE]
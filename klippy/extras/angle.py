@@ -470,7 +470,50 @@ class Angle:
     def add_client(self, client_cb):
         self.batch_bulk.add_client(client_cb)
     # Measurement decoding
+    def _extract_array_samples(self, raw_samples):
+        numpy = bulk_sensor.numpy
+        sequences, d, valid = raw_samples.get_sample_arrays(BYTES_PER_SAMPLE)
+        tcode, alow, ahigh = d.transpose((2, 0, 1))
+        errors = valid & (tcode == TCODE_ERROR)
+        error_count = int(errors.sum())
+        valid = valid & ~errors
+        # Determine the mcu clock of each sample
+        seq_diff = numpy.diff(sequences, prepend=self.last_sequence) & 0xffff
+        seq = self.last_sequence + numpy.cumsum(seq_diff)
+        msg_mclock = self.start_clock + seq*SAMPLES_PER_BLOCK*self.sample_ticks
+        sample_mclock = numpy.arange(valid.shape[1]) * self.sample_ticks
+        mclock = (msg_mclock[:, None] + sample_mclock)[valid]
+        tcode = tcode[valid]
+        # Unwrap angles
+        raw_angle = (alow | (ahigh << 8))[valid]
+        angle_diff = numpy.diff(raw_angle, prepend=self.last_angle) & 0xffff
+        angle_diff -= (angle_diff & 0x8000) << 1
+        angle = self.last_angle + numpy.cumsum(angle_diff)
+        # Calculate sample times
+        static_delay = 0.
+        if self.sensor_helper.is_tcode_absolute:
+            tparams = self.sensor_helper.get_tcode_params()
+            last_chip_mcu_clock, last_chip_clock, chip_freq = tparams
+            # tcode is tle5012b frame counter
+            mdiff = mclock - last_chip_mcu_clock
+            chip_mclock = last_chip_clock + (mdiff * chip_freq + .5).astype(
+                numpy.int64)
+            cdiff = ((tcode << 10) - chip_mclock) & 0xffff
+            cdiff -= (cdiff & 0x8000) << 1
+            sclock = mclock + (cdiff - 0x800) * (1. / chip_freq)
+        else:
+            # tcode is mcu clock offset shifted by time_shift
+            static_delay = self.sensor_helper.get_static_delay()
+            sclock = mclock + (tcode << self.time_shift)
+        ptime = numpy.round(
+            self.mcu.clock_to_print_time(sclock) - static_delay, 6)
+        self.last_sequence = int(seq[-1])
+        if len(angle):
+            self.last_angle = int(angle[-1])
+        return list(zip(ptime.tolist(), angle.tolist())), error_count
     def _extract_samples(self, raw_samples):
+        if raw_samples.can_decode_arrays():
+            return self._extract_array_samples(raw_samples)
         # Load variables to optimize inner loop below
         sample_ticks = self.sample_ticks
         start_clock = self.start_clock
@@ -491,12 +534,11 @@ class Angle:
         # Process every message in raw_samples
         count = error_count = 0
         samples = [None] * (len(raw_samples) * SAMPLES_PER_BLOCK)
-        for params in raw_samples:
-            seq_diff = (params['sequence'] - last_sequence) & 0xffff
+        for sequence, d in raw_samples.iter_messages():
+            seq_diff = (sequence - last_sequence) & 0xffff
             last_sequence += seq_diff
             samp_count = last_sequence * SAMPLES_PER_BLOCK
             msg_mclock = start_clock + samp_count*sample_ticks
-            d = bytearray(params['data'])
             for i in range(len(d) // BYTES_PER_SAMPLE):
                 d_ta = d[i*BYTES_PER_SAMPLE:(i+1)*BYTES_PER_SAMPLE]
                 tcode = d_ta[0]
@@ -103,6 +103,7 @@ class BedMesh:
         self.log_fade_complete = False
         self.base_fade_target = config.getfloat('fade_target', None)
         self.fade_target = 0.
+        self.status_version = 0
         self.gcode = self.printer.lookup_object('gcode')
         self.splitter = MoveSplitter(config, self.gcode)
         # setup persistent storage
@@ -219,7 +220,10 @@ class BedMesh:
         self.last_position[:] = newpos
     def get_status(self, eventtime=None):
         return self.status
+    def get_status_version(self):
+        return self.status_version
     def update_status(self):
+        self.status_version += 1
         self.status = {
             "profile_name": "",
             "mesh_min": (0., 0.),
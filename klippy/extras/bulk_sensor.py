@@ -3,7 +3,11 @@
 # Copyright (C) 2020-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading
+import logging, threading, struct
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # This "bulk sensor" module facilitates the processing of sensor chip
 # measurements that do not require the host to respond with low
@@ -18,6 +22,7 @@ import logging, threading
 # system (aka API Server).
 
 BATCH_INTERVAL = 0.500
+MAX_BULK_MSG_SIZE = 52
 
 # Helper to process accumulated messages in periodic batches
 class BatchBulkHelper:
@@ -109,25 +114,104 @@ class BatchWebhooksClient:
             return False
         tmp = dict(self.template)
         tmp['params'] = msg
-        self.cconn.send(tmp)
+        self.cconn.send(tmp, droppable=True, packable=True)
         return True
 
+# Each raw message is stored as a fixed size record (this matches the
+# layout used by chelper/msgring.c for "oid=%c sequence=%hu data=%*s"
+# messages): receive_time, oid, sequence, data length, data
+BULK_RECORD_HEADER = struct.Struct("=dIII")
+BULK_RECORD_DATA_SIZE = MAX_BULK_MSG_SIZE
+BULK_RECORD_SIZE = ((BULK_RECORD_HEADER.size + BULK_RECORD_DATA_SIZE + 7)
+                    // 8 * 8)
+BULK_RING_RECORDS = 4096
+
+# A batch of raw messages stored contiguously in a single buffer
+class BulkDataBatch:
+    def __init__(self, data):
+        self.data = data
+    def __len__(self):
+        return len(self.data) // BULK_RECORD_SIZE
+    def iter_messages(self):
+        # Generate a (sequence, data) tuple for each message
+        data = self.data
+        hdr_size = BULK_RECORD_HEADER.size
+        unpack_from = BULK_RECORD_HEADER.unpack_from
+        for pos in range(0, len(data), BULK_RECORD_SIZE):
+            rtime, oid, sequence, length = unpack_from(data, pos)
+            start = pos + hdr_size
+            yield sequence, bytearray(data[start:start+length])
+    def get_record_dtype(self):
+        # Description of a record suitable for numpy.dtype()
+        return {'names': ['time', 'oid', 'sequence', 'length', 'data'],
+                'formats': ['f8', 'u4', 'u4', 'u4',
+                            ('u1', (BULK_RECORD_DATA_SIZE,))],
+                'offsets': [0, 8, 12, 16, BULK_RECORD_HEADER.size],
+                'itemsize': BULK_RECORD_SIZE}
+    # Vectorized decoding (only available when numpy is installed)
+    def can_decode_arrays(self):
+        return numpy is not None
+    def get_sample_arrays(self, bytes_per_sample):
+        # Returns (sequences, samples, valid) arrays.  The 'samples'
+        # array has a row of sample bytes for every possible sample in
+        # each message and 'valid' notes which samples are present.
+        recs = numpy.frombuffer(self.data,
+                                dtype=numpy.dtype(self.get_record_dtype()))
+        count = BULK_RECORD_DATA_SIZE // bytes_per_sample
+        samples = recs['data'][:, :count*bytes_per_sample].reshape(
+            (len(recs), count, bytes_per_sample)).astype(numpy.int64)
+        valid = (numpy.arange(count)
+                 < (recs['length'] // bytes_per_sample)[:, None])
+        return recs['sequence'].astype(numpy.int64), samples, valid
+
 # Helper class to store incoming messages in a queue
 class BulkDataQueue:
     def __init__(self, mcu, msg_name, oid):
-        # Measurement storage (accessed from background thread)
+        self.mcu = mcu
+        self.msg_name = msg_name
+        self.oid = oid
+        # Messages are normally stored by the C code in a message ring
+        self.msg_ring = None
+        self.last_overflows = 0
+        # Fallback storage (accessed from background thread)
         self.lock = threading.Lock()
         self.raw_samples = []
-        # Register callback with mcu
+        # Register callbacks with mcu
         mcu.register_response(self._handle_data, msg_name, oid)
+        mcu.register_config_callback(self._build_config)
+    def _build_config(self):
+        if self.msg_ring is not None:
+            return
+        self.msg_ring = self.mcu.try_alloc_message_ring(
+            self.msg_name, self.oid, BULK_RECORD_DATA_SIZE, BULK_RING_RECORDS)
+        if self.msg_ring is None:
+            logging.info("Unable to allocate message ring for %s (oid %d)",
+                         self.msg_name, self.oid)
+        elif self.msg_ring.get_record_size() != BULK_RECORD_SIZE:
+            raise self.mcu.get_printer().config_error(
+                "Unexpected message ring layout for %s" % (self.msg_name,))
     def _handle_data(self, params):
+        data = params['data'][:BULK_RECORD_DATA_SIZE]
+        record = BULK_RECORD_HEADER.pack(
+            params['#receive_time'], params['oid'], params['sequence'],
+            len(data)) + data
+        record += b"\x00" * (BULK_RECORD_SIZE - len(record))
         with self.lock:
-            self.raw_samples.append(params)
+            self.raw_samples.append(record)
     def pull_samples(self):
         with self.lock:
             raw_samples = self.raw_samples
             self.raw_samples = []
-        return raw_samples
+        data = b"".join(raw_samples)
+        if self.msg_ring is not None:
+            data += self.msg_ring.pull()
+            overflows = self.msg_ring.get_overflows()
+            if overflows != self.last_overflows:
+                logging.warning("Dropped %d %s messages (oid %d)",
+                                overflows - self.last_overflows,
+                                self.msg_name, self.oid)
+                self.last_overflows = overflows
+        return BulkDataBatch(data)
     def clear_samples(self):
         self.pull_samples()
 
@@ -198,8 +282,6 @@ class ClockSyncRegression:
         inv_freq = clock_to_print_time(base_mcu + inv_cfreq) - base_time
         return base_time, base_chip, inv_freq
 
-MAX_BULK_MSG_SIZE = 52
-
 # Handle common periodic chip status query responses
 class ChipClockUpdater:
     def __init__(self, clock_sync, bytes_per_sample):
@@ -20,6 +20,7 @@ class ExcludeObject:
         self.next_transform = None
         self.last_position_extruded = [0., 0., 0., 0.]
         self.last_position_excluded = [0., 0., 0., 0.]
+        self.status_version = 0
 
         self._reset_state()
         self.gcode.register_command(
@@ -77,6 +78,7 @@ class ExcludeObject:
         self.excluded_objects = []
         self.current_object = None
         self.in_excluded_region = False
+        self.status_version += 1
 
     def _reset_file(self):
         self._reset_state()
@@ -177,6 +179,10 @@ class ExcludeObject:
         }
         return status
 
+    def get_status_version(self):
+        # status_version tracks changes to the object lists
+        return (self.status_version, self.current_object)
+
     def move(self, newpos, speed):
         move_in_excluded_region = self._test_in_excluded_region()
         self.last_speed = speed
@@ -227,6 +233,7 @@ class ExcludeObject:
 
             else:
                 self.excluded_objects = []
+                self.status_version += 1
 
         elif name:
             if name.upper() not in self.excluded_objects:
@@ -273,12 +280,14 @@ class ExcludeObject:
     def _add_object_definition(self, definition):
         self.objects = sorted(self.objects + [definition],
                               key=lambda o: o["name"])
+        self.status_version += 1
 
     def _exclude_object(self, name):
         self._register_transform()
         self.gcode.respond_info('Excluding object {}'.format(name.upper()))
         if name not in self.excluded_objects:
             self.excluded_objects = sorted(self.excluded_objects + [name])
+            self.status_version += 1
 
     def _unexclude_object(self, name):
         self.gcode.respond_info('Unexcluding object {}'.format(name.upper()))
@@ -286,6 +295,7 @@ class ExcludeObject:
             excluded_objects = list(self.excluded_objects)
             excluded_objects.remove(name)
             self.excluded_objects = sorted(excluded_objects)
+            self.status_version += 1
 
     def _list_objects(self, gcmd):
         if gcmd.get('JSON', None) is not None:
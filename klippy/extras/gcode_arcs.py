@@ -34,6 +34,8 @@ class ArcSupport:
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command("G2", self.cmd_G2)
         self.gcode.register_command("G3", self.cmd_G3)
+        self.gcode.register_fast_command("G2", self._fast_G2)
+        self.gcode.register_fast_command("G3", self._fast_G3)
 
         self.gcode.register_command("G17", self.cmd_G17)
         self.gcode.register_command("G18", self.cmd_G18)
@@ -45,10 +47,16 @@ class ArcSupport:
         self.plane = ARC_PLANE_X_Y
 
     def cmd_G2(self, gcmd):
-        self._cmd_inner(gcmd, True)
+        self._cmd_inner(self._get_params(gcmd), gcmd.get_commandline(), True)
 
     def cmd_G3(self, gcmd):
-        self._cmd_inner(gcmd, False)
+        self._cmd_inner(self._get_params(gcmd), gcmd.get_commandline(), False)
+
+    def _fast_G2(self, params, commandline):
+        self._cmd_inner(params, commandline, True)
+
+    def _fast_G3(self, params, commandline):
+        self._cmd_inner(params, commandline, False)
 
     def cmd_G17(self, gcmd):
         self.plane = ARC_PLANE_X_Y
@@ -59,36 +67,45 @@ class ArcSupport:
     def cmd_G19(self, gcmd):
         self.plane = ARC_PLANE_Y_Z
 
-    def _cmd_inner(self, gcmd, clockwise):
+    def _get_params(self, gcmd):
+        params = {}
+        for a in 'XYZEFIJKR':
+            v = gcmd.get_float(a, None)
+            if v is not None:
+                params[a] = v
+        return params
+
+    def _cmd_inner(self, params, commandline, clockwise):
+        error = self.printer.command_error
         gcodestatus = self.gcode_move.get_status()
         if not gcodestatus['absolute_coordinates']:
-            raise gcmd.error("G2/G3 does not support relative move mode")
+            raise error("G2/G3 does not support relative move mode")
         currentPos = gcodestatus['gcode_position']
 
         # Parse parameters
-        asTarget = self.Coord(x=gcmd.get_float("X", currentPos[0]),
-                              y=gcmd.get_float("Y", currentPos[1]),
-                              z=gcmd.get_float("Z", currentPos[2]),
+        asTarget = self.Coord(x=params.get("X", currentPos[0]),
+                              y=params.get("Y", currentPos[1]),
+                              z=params.get("Z", currentPos[2]),
                               e=None)
 
-        if gcmd.get_float("R", None) is not None:
-            raise gcmd.error("G2/G3 does not support R moves")
+        if params.get("R") is not None:
+            raise error("G2/G3 does not support R moves")
 
         # determine the plane coordinates and the helical axis
-        asPlanar = [ gcmd.get_float(a, 0.) for i,a in enumerate('IJ') ]
+        asPlanar = [ params.get(a, 0.) for i,a in enumerate('IJ') ]
         axes = (X_AXIS, Y_AXIS, Z_AXIS)
         if self.plane == ARC_PLANE_X_Z:
-            asPlanar = [ gcmd.get_float(a, 0.) for i,a in enumerate('IK') ]
+            asPlanar = [ params.get(a, 0.) for i,a in enumerate('IK') ]
             axes = (X_AXIS, Z_AXIS, Y_AXIS)
         elif self.plane == ARC_PLANE_Y_Z:
-            asPlanar = [ gcmd.get_float(a, 0.) for i,a in enumerate('JK') ]
+            asPlanar = [ params.get(a, 0.) for i,a in enumerate('JK') ]
             axes = (Y_AXIS, Z_AXIS, X_AXIS)
 
         if not (asPlanar[0] or asPlanar[1]):
-            raise gcmd.error("G2/G3 requires IJ, IK or JK parameters")
+            raise error("G2/G3 requires IJ, IK or JK parameters")
 
-        asE = gcmd.get_float("E", None)
-        asF = gcmd.get_float("F", None)
+        asE = params.get("E")
+        asF = params.get("F")
 
         # Build list of linear coordinates to move
         coords = self.planArc(currentPos, asTarget, asPlanar,
@@ -99,7 +116,7 @@ class ArcSupport:
                 e_base = currentPos[3]
             e_per_move = (asE - e_base) / len(coords)
 
-        # Convert coords into G1 commands
+        # Convert coords into G1 moves
         for coord in coords:
             g1_params = {'X': coord[0], 'Y': coord[1], 'Z': coord[2]}
             if e_per_move:
@@ -108,8 +125,7 @@ class ArcSupport:
                     e_base += e_per_move
             if asF is not None:
                 g1_params['F'] = asF
-            g1_gcmd = self.gcode.create_gcode_command("G1", "G1", g1_params)
-            self.gcode_move.cmd_G1(g1_gcmd)
+            self.gcode_move.process_move(g1_params, commandline)
 
     # function planArc() originates from marlin plan_arc()
     # https://github.com/MarlinFirmware/Marlin
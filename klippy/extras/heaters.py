@@ -57,6 +57,8 @@ class Heater:
         # Load additional modules
         self.printer.load_object(config, "verify_heater %s" % (self.name,))
         self.printer.load_object(config, "pid_calibrate")
+        printer_stats = self.printer.load_object(config, "statistics")
+        printer_stats.register_metrics(config.get_name(), self._get_metrics)
         gcode = self.printer.lookup_object("gcode")
         gcode.register_mux_command("SET_HEATER_TEMPERATURE", "HEATER",
                                    self.name, self.cmd_SET_HEATER_TEMPERATURE,
@@ -128,6 +130,10 @@ class Heater:
         is_active = target_temp or last_temp > 50.
         return is_active, '%s: target=%.0f temp=%.1f pwm=%.3f' % (
             self.name, target_temp, last_temp, last_pwm_value)
+    def _get_metrics(self, eventtime):
+        with self.lock:
+            return {'temp': self.last_temp, 'target': self.target_temp,
+                    'pwm': self.last_pwm_value}
     def get_status(self, eventtime):
         with self.lock:
             target_temp = self.target_temp
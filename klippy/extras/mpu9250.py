@@ -113,7 +113,19 @@ class MPU9250:
         self.batch_bulk.add_client(aqh.handle_batch)
         return aqh
     # Measurement decoding
+    def _extract_array_samples(self, raw_samples):
+        sequences, d, valid = raw_samples.get_sample_arrays(BYTES_PER_SAMPLE)
+        xhigh, xlow, yhigh, ylow, zhigh, zlow = d.transpose((2, 0, 1))
+        # Merge and perform twos-complement
+        rx = ((xhigh << 8) | xlow) - ((xhigh & 0x80) << 9)
+        ry = ((yhigh << 8) | ylow) - ((yhigh & 0x80) << 9)
+        rz = ((zhigh << 8) | zlow) - ((zhigh & 0x80) << 9)
+        return adxl345.build_array_samples(
+            (rx, ry, rz), valid, sequences, SAMPLES_PER_BLOCK, self.axes_map,
+            self.clock_updater, self.clock_sync)
     def _extract_samples(self, raw_samples):
+        if raw_samples.can_decode_arrays():
+            return self._extract_array_samples(raw_samples)
         # Load variables to optimize inner loop below
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
         last_sequence = self.clock_updater.get_last_sequence()
@@ -121,11 +133,10 @@ class MPU9250:
         # Process every message in raw_samples
         count = seq = 0
         samples = [None] * (len(raw_samples) * SAMPLES_PER_BLOCK)
-        for params in raw_samples:
-            seq_diff = (params['sequence'] - last_sequence) & 0xffff
+        for sequence, d in raw_samples.iter_messages():
+            seq_diff = (sequence - last_sequence) & 0xffff
             seq_diff -= (seq_diff & 0x8000) << 1
             seq = last_sequence + seq_diff
-            d = bytearray(params['data'])
             msg_cdiff = seq * SAMPLES_PER_BLOCK - chip_base
 
             for i in range(len(d) // BYTES_PER_SAMPLE):
@@ -3,10 +3,10 @@
 # Copyright (C) 2018-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, time, logging
+import os, time, logging, collections, math
 
 class PrinterSysStats:
-    def __init__(self, config):
+    def __init__(self, config, printer_stats):
         printer = config.get_printer()
         self.last_process_time = self.total_process_time = 0.
         self.last_load_avg = 0.
@@ -17,6 +17,8 @@ class PrinterSysStats:
         except:
             pass
         printer.register_event_handler("klippy:disconnect", self._disconnect)
+        printer_stats.register_metrics("system_stats", self.get_status,
+                                       counters=['cputime'])
     def _disconnect(self):
         if self.mem_file is not None:
             self.mem_file.close()
@@ -49,26 +51,178 @@ class PrinterSysStats:
                 'cputime': self.total_process_time,
                 'memavail': self.last_mem_avail}
 
+# Prometheus text format helpers
+def prometheus_name(name):
+    return "".join([c if c.isalnum() or c in "_:" else "_" for c in name])
+
+def prometheus_label(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+# A set of metrics from one object, stored in fixed size ring buffers
+class MetricGroup:
+    def __init__(self, name, callback, counters, size, sample_count):
+        self.name = name
+        self.callback = callback
+        self.counters = set(counters)
+        self.size = size
+        self.pad = min(sample_count, size)
+        self.series = {}
+    def sample(self, eventtime):
+        values = {name: value
+                  for name, value in self.callback(eventtime).items()
+                  if type(value) is int
+                  or (type(value) is float
+                      and not (math.isnan(value) or math.isinf(value)))}
+        for name, value in values.items():
+            series = self.series.get(name)
+            if series is None:
+                self.series[name] = series = collections.deque(
+                    [None] * self.pad, maxlen=self.size)
+            series.append(value)
+        for name, series in self.series.items():
+            if name not in values:
+                series.append(None)
+        self.pad = min(self.pad + 1, self.size)
+    def get_type(self, name):
+        if name in self.counters:
+            return "counter"
+        return "gauge"
+    def get_history(self, count):
+        return {name: list(series)[-count:]
+                for name, series in self.series.items()}
+    def get_last(self):
+        return {name: series[-1] for name, series in self.series.items()
+                if series[-1] is not None}
+
 class PrinterStats:
     def __init__(self, config):
         self.printer = config.get_printer()
         reactor = self.printer.get_reactor()
         self.stats_timer = reactor.register_timer(self.generate_stats)
         self.stats_cb = []
+        self.history_size = config.getint('history_size', 300, minval=1)
+        self.prometheus_file = config.get('prometheus_file', None)
+        self.sample_times = collections.deque(maxlen=self.history_size)
+        self.metric_groups = {}
         self.printer.register_event_handler("klippy:ready", self.handle_ready)
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("statistics/metrics",
+                                   self._handle_metrics_request)
+    def register_metrics(self, name, callback, counters=()):
+        # The callback(eventtime) must return a dictionary of numeric
+        # values - it is called after all stats() methods
+        self.metric_groups[name] = MetricGroup(
+            name, callback, counters, self.history_size,
+            len(self.sample_times))
     def handle_ready(self):
         self.stats_cb = [o.stats for n, o in self.printer.lookup_objects()
                          if hasattr(o, 'stats')]
         if self.printer.get_start_args().get('debugoutput') is None:
             reactor = self.printer.get_reactor()
             reactor.update_timer(self.stats_timer, reactor.NOW)
+    def _sample_metrics(self, eventtime):
+        self.sample_times.append(eventtime)
+        for mg in self.metric_groups.values():
+            mg.sample(eventtime)
+        if self.prometheus_file is not None:
+            self._write_prometheus()
     def generate_stats(self, eventtime):
         stats = [cb(eventtime) for cb in self.stats_cb]
         if max([s[0] for s in stats]):
-            logging.info("Stats %.1f: %s", eventtime,
-                         ' '.join([s[1] for s in stats]))
+            parts = [s[1] for s in stats]
+            logging.info("Stats %.1f: %s", eventtime, ' '.join(parts),
+                         extra={'stats_info': (eventtime, parts)})
+        self._sample_metrics(eventtime)
         return eventtime + 1.
+    def _handle_metrics_request(self, web_request):
+        count = web_request.get_int('count', self.history_size)
+        count = max(1, min(count, self.history_size))
+        names = web_request.get('objects', None, types=(list,))
+        groups = self.metric_groups
+        if names is not None:
+            groups = {n: groups[n] for n in names if n in groups}
+        web_request.send({
+            'times': list(self.sample_times)[-count:],
+            'types': {n: {m: mg.get_type(m) for m in mg.series}
+                      for n, mg in groups.items()},
+            'metrics': {n: mg.get_history(count)
+                        for n, mg in groups.items()}})
+    def get_prometheus_text(self):
+        metrics = {}
+        for group_name, mg in sorted(self.metric_groups.items()):
+            for name, value in sorted(mg.get_last().items()):
+                pname = "klipper_" + prometheus_name(name)
+                if pname not in metrics:
+                    metrics[pname] = ["# TYPE %s %s" % (pname,
+                                                        mg.get_type(name))]
+                metrics[pname].append('%s{object="%s"} %s' % (
+                    pname, prometheus_label(group_name), repr(value)))
+        return "".join(["\n".join(lines) + "\n"
+                        for pname, lines in sorted(metrics.items())])
+    def _write_prometheus(self):
+        # Write to a temporary file and rename so readers never see a
+        # partially written file
+        tmpname = self.prometheus_file + ".tmp"
+        try:
+            with open(tmpname, 'w') as f:
+                f.write(self.get_prometheus_text())
+            os.rename(tmpname, self.prometheus_file)
+        except OSError:
+            logging.exception("Unable to write prometheus file %s",
+                              self.prometheus_file)
+            self.prometheus_file = None
+
+# Report the reactor callback profiling information
+class ReactorStats:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("reactor/stats", self._handle_web_request)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command("REACTOR_STATS", self.cmd_REACTOR_STATS,
+                               desc=self.cmd_REACTOR_STATS_help)
+    def _update(self, enable, reset):
+        if enable is not None:
+            self.reactor.set_profiling(enable)
+        prof = self.reactor.get_profiler()
+        if reset and prof is not None:
+            prof.reset()
+        return prof
+    def _handle_web_request(self, web_request):
+        enable = web_request.get_int('enable', None)
+        reset = web_request.get_int('reset', 0)
+        prof = self._update(enable, reset)
+        res = {'enabled': prof is not None}
+        if prof is not None:
+            res.update(prof.get_stats())
+        web_request.send(res)
+    cmd_REACTOR_STATS_help = "Report time spent in reactor callbacks"
+    def cmd_REACTOR_STATS(self, gcmd):
+        enable = gcmd.get_int('ENABLE', None, minval=0, maxval=1)
+        reset = gcmd.get_int('RESET', 0, minval=0, maxval=1)
+        count = gcmd.get_int('COUNT', 10, minval=1)
+        prof = self._update(enable, reset)
+        if prof is None:
+            gcmd.respond_info("Reactor profiling is disabled"
+                              " (use REACTOR_STATS ENABLE=1)")
+            return
+        stats = prof.get_stats()
+        callbacks = sorted(stats['callbacks'].items(),
+                           key=(lambda i: i[1]['total_time']), reverse=True)
+        msg = ["Reactor stats over %.1f seconds:" % (stats['duration'],)]
+        for name, cs in callbacks[:count]:
+            msg.append("%s: calls=%d total=%.3fs max=%.3fms" % (
+                name, cs['count'], cs['total_time'], cs['max_time'] * 1000.))
+        msg.append("timer delay: " + " ".join(
+            ["%s:%d" % (label, cnt)
+             for label, cnt in stats['timer_delay'].items()]))
+        gcmd.respond_info("\n".join(msg), log=False)
 
 def load_config(config):
-    config.get_printer().add_object('system_stats', PrinterSysStats(config))
-    return PrinterStats(config)
+    printer = config.get_printer()
+    printer_stats = PrinterStats(config)
+    printer.add_object('system_stats', PrinterSysStats(config, printer_stats))
+    printer.add_object('reactor_stats', ReactorStats(config))
+    return printer_stats
@@ -82,7 +82,7 @@ class MCU_TMC_uart_bitbang:
         self.rx_pin = rx_pin_params['pin']
         self.tx_pin = tx_pin_params['pin']
         self.oid = self.mcu.create_oid()
-        self.cmd_queue = self.mcu.alloc_command_queue()
+        self.cmd_queue = self.mcu.alloc_command_queue('high')
         self.analog_mux = None
         if select_pins_desc is not None:
             self.analog_mux = MCU_analog_mux(self.mcu, self.cmd_queue,
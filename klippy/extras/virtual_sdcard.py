@@ -3,10 +3,320 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging, io
+import os, logging, io, threading, collections, struct, bisect, hashlib
+import multiprocessing
+import gcode
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
 
+READ_SIZE = 65536
+DISPATCH_SIZE = 8192
+READ_AHEAD_SIZE = 1024 * 1024
+
+# Read a g-code file from a background thread into a bounded buffer
+class ReadAheadFile:
+    def __init__(self, reactor, fname):
+        self.reactor = reactor
+        self.name = fname
+        self.file = io.open(fname, 'rb', buffering=0)
+        self.file.seek(0, os.SEEK_END)
+        self.file_size = self.file.tell()
+        # Read buffer (accessed from background thread)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.chunks = collections.deque()
+        self.bytes_buffered = 0
+        self.read_pos = 0
+        self.generation = 0
+        self.is_eof = self.is_error = self.must_stop = False
+        self.completion = None
+        self.bg_thread = None
+        self.partial_input = b""
+        # Statistics
+        self.stall_time = 0.
+    def get_file_size(self):
+        return self.file_size
+    def get_stats(self):
+        return self.bytes_buffered, self.stall_time
+    def _bg_thread(self):
+        while 1:
+            with self.lock:
+                while not self.must_stop and (
+                        self.is_eof or self.bytes_buffered >= READ_AHEAD_SIZE):
+                    self.cond.wait()
+                if self.must_stop:
+                    break
+                generation = self.generation
+                read_pos = self.read_pos
+            try:
+                self.file.seek(read_pos)
+                data = self.file.read(READ_SIZE)
+            except:
+                logging.exception("virtual_sdcard read")
+                data = None
+            with self.lock:
+                if generation != self.generation:
+                    # File position changed while reading - discard data
+                    continue
+                if data is None:
+                    self.is_error = self.is_eof = True
+                elif not data:
+                    self.is_eof = True
+                else:
+                    self.read_pos += len(data)
+                    self.bytes_buffered += len(data)
+                    for pos in range(0, len(data), DISPATCH_SIZE):
+                        self.chunks.append(data[pos:pos+DISPATCH_SIZE])
+                completion = self.completion
+                self.completion = None
+            if completion is not None:
+                self.reactor.async_complete(completion, None)
+    def start(self):
+        if self.bg_thread is not None:
+            return
+        self.must_stop = False
+        self.bg_thread = threading.Thread(target=self._bg_thread)
+        self.bg_thread.daemon = True
+        self.bg_thread.start()
+    def stop(self):
+        if self.bg_thread is None:
+            return
+        with self.lock:
+            self.must_stop = True
+            self.cond.notify()
+        self.bg_thread.join()
+        self.bg_thread = None
+        completion = self.completion
+        self.completion = None
+        if completion is not None:
+            completion.complete(None)
+    def close(self):
+        self.stop()
+        self.file.close()
+    def seek(self, pos):
+        self.partial_input = b""
+        with self.lock:
+            self.generation += 1
+            self.read_pos = pos
+            self.chunks.clear()
+            self.bytes_buffered = 0
+            self.is_eof = self.is_error = False
+            self.cond.notify()
+    def read(self):
+        # Return the next block of buffered data (called from main thread)
+        while 1:
+            with self.lock:
+                if self.chunks:
+                    data = self.chunks.popleft()
+                    self.bytes_buffered -= len(data)
+                    self.cond.notify()
+                    return data
+                if self.is_error or self.must_stop or self.bg_thread is None:
+                    raise IOError("Unable to read %s" % (self.name,))
+                if self.is_eof:
+                    return b""
+                self.completion = completion = self.reactor.completion()
+            stall_start = self.reactor.monotonic()
+            completion.wait()
+            self.stall_time += self.reactor.monotonic() - stall_start
+    def read_lines(self):
+        # Return the next group of lines in reverse order (None on EOF)
+        data = self.read()
+        if not data:
+            return None
+        lines = data.split(b'\n')
+        lines[0] = self.partial_input + lines[0]
+        self.partial_input = lines.pop()
+        lines.reverse()
+        return lines
+    def read_at(self, pos, count):
+        # Read data without disturbing the read-ahead buffer
+        f = io.open(self.name, 'rb')
+        try:
+            f.seek(pos)
+            return f.read(count)
+        finally:
+            f.close()
+
+######################################################################
+# Pre-parsed g-code cache
+######################################################################
+
+# The cache file contains a header, a stream of records (one per line
+# of the source file), an index mapping source offsets to record
+# offsets, and a trailer locating that index.  A "text" record stores
+# the raw line.  A "move" record stores the command (G0-G3), the
+# parameter letters, the parameter values as doubles, and the raw
+# line (used for position tracking and error messages).
+CACHE_MAGIC = b"KGC1"
+CACHE_HEADER = struct.Struct('<4sQd')
+CACHE_TRAILER = struct.Struct('<QQ4s')
+CACHE_INDEX = struct.Struct('<QQ')
+REC_TEXT = struct.Struct('<BI')
+REC_MOVE = struct.Struct('<BIB')
+OP_TEXT = 0xff
+
+def compile_gcode_file(fname, cache_fname):
+    fast_r = gcode.GCodeDispatch.fast_r
+    src = io.open(fname, 'rb')
+    st = os.fstat(src.fileno())
+    tmp_fname = cache_fname + ".tmp"
+    out = io.open(tmp_fname, 'wb')
+    out.write(CACHE_HEADER.pack(CACHE_MAGIC, st.st_size, st.st_mtime))
+    out_pos = CACHE_HEADER.size
+    src_pos = next_index_pos = 0
+    index = []
+    partial_input = b""
+    while 1:
+        data = src.read(READ_SIZE)
+        if not data:
+            break
+        lines = data.split(b'\n')
+        lines[0] = partial_input + lines[0]
+        partial_input = lines.pop()
+        recs = []
+        for line in lines:
+            if src_pos >= next_index_pos:
+                index.append(CACHE_INDEX.pack(src_pos, out_pos))
+                next_index_pos = src_pos + DISPATCH_SIZE
+            src_pos += len(line) + 1
+            try:
+                cmdline = line.decode().strip()
+            except UnicodeDecodeError:
+                cmdline = ""
+            cpos = cmdline.find(';')
+            if cpos >= 0:
+                cmdline = cmdline[:cpos]
+            if fast_r.match(cmdline) is None:
+                rec = REC_TEXT.pack(OP_TEXT, len(line)) + line
+            else:
+                parts = cmdline.split()
+                params = {p[0]: float(p[1:]) for p in parts[1:]}
+                letters = "".join(params.keys())
+                values = [params[l] for l in letters]
+                rec = b"".join([
+                    REC_MOVE.pack(int(parts[0][1:]), len(line), len(letters)),
+                    letters.encode(),
+                    struct.pack('<%dd' % (len(values),), *values), line])
+            recs.append(rec)
+            out_pos += len(rec)
+        out.write(b"".join(recs))
+    src.close()
+    out.write(b"".join(index))
+    out.write(CACHE_TRAILER.pack(out_pos, len(index), CACHE_MAGIC))
+    out.close()
+    os.rename(tmp_fname, cache_fname)
+
+# Execute a print from a pre-parsed cache file
+class CompiledFile:
+    def __init__(self, reactor, fname, cache_fname):
+        self.name = fname
+        st = os.stat(fname)
+        self.file_size = st.st_size
+        f = io.open(cache_fname, 'rb')
+        try:
+            header = f.read(CACHE_HEADER.size)
+            magic, size, mtime = CACHE_HEADER.unpack(header)
+            if (magic != CACHE_MAGIC or size != st.st_size
+                or mtime != st.st_mtime):
+                raise ValueError("Cache file %s is stale" % (cache_fname,))
+            f.seek(-CACHE_TRAILER.size, os.SEEK_END)
+            index_pos, count, magic = CACHE_TRAILER.unpack(
+                f.read(CACHE_TRAILER.size))
+            if magic != CACHE_MAGIC:
+                raise ValueError("Cache file %s is incomplete" % (
+                    cache_fname,))
+            f.seek(index_pos)
+            data = f.read(count * CACHE_INDEX.size)
+        finally:
+            f.close()
+        index = [CACHE_INDEX.unpack_from(data, i * CACHE_INDEX.size)
+                 for i in range(count)]
+        if not index:
+            index = [(0, CACHE_HEADER.size)]
+        self.index_src = [i[0] for i in index]
+        self.index_cache = [i[1] for i in index]
+        self.records_end = index_pos
+        self.cache = ReadAheadFile(reactor, cache_fname)
+        # Record parsing state
+        self.buffer = b""
+        self.cache_pos = self.src_pos = self.skip_pos = 0
+    def get_file_size(self):
+        return self.file_size
+    def get_stats(self):
+        return self.cache.get_stats()
+    def start(self):
+        self.cache.start()
+    def stop(self):
+        self.cache.stop()
+    def close(self):
+        self.cache.close()
+    def seek(self, pos):
+        i = max(0, bisect.bisect_right(self.index_src, pos) - 1)
+        self.src_pos = self.index_src[i]
+        self.cache_pos = self.index_cache[i]
+        self.skip_pos = pos
+        self.buffer = b""
+        self.cache.seek(self.cache_pos)
+    def read_lines(self):
+        # Return the next group of lines in reverse order (None on EOF)
+        if self.cache_pos >= self.records_end:
+            return None
+        data = self.cache.read()
+        if not data:
+            return None
+        buf = self.buffer + data
+        buf_len = min(len(buf), self.records_end - self.cache_pos)
+        lines = []
+        pos = 0
+        src_pos = self.src_pos
+        skip_pos = self.skip_pos
+        while pos + REC_TEXT.size <= buf_len:
+            op, line_len = REC_TEXT.unpack_from(buf, pos)
+            if op == OP_TEXT:
+                end = pos + REC_TEXT.size + line_len
+                if end > buf_len:
+                    break
+                line = buf[end-line_len:end]
+            else:
+                if pos + REC_MOVE.size > buf_len:
+                    break
+                op, line_len, count = REC_MOVE.unpack_from(buf, pos)
+                letters_pos = pos + REC_MOVE.size
+                values_pos = letters_pos + count
+                end = values_pos + count * 8 + line_len
+                if end > buf_len:
+                    break
+                line = buf[end-line_len:end]
+                if src_pos >= skip_pos:
+                    letters = buf[letters_pos:values_pos].decode()
+                    values = struct.unpack_from('<%dd' % (count,), buf,
+                                                values_pos)
+                    line = (line, "G%d" % (op,), dict(zip(letters, values)))
+            pos = end
+            next_src_pos = src_pos + line_len + 1
+            if src_pos < skip_pos:
+                if next_src_pos <= skip_pos:
+                    # Line is before requested file position
+                    src_pos = next_src_pos
+                    continue
+                # Requested position is in the middle of this line
+                line = line[skip_pos - src_pos:]
+            lines.append(line)
+            src_pos = next_src_pos
+        self.buffer = buf[pos:]
+        self.cache_pos += pos
+        self.src_pos = src_pos
+        lines.reverse()
+        return lines
+    def read_at(self, pos, count):
+        f = io.open(self.name, 'rb')
+        try:
+            f.seek(pos)
+            return f.read(count)
+        finally:
+            f.close()
+
 class VirtualSD:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -17,6 +327,12 @@ class VirtualSD:
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
         self.current_file = None
         self.file_position = self.file_size = 0
+        # Pre-parsed g-code cache
+        self.cache_dirname = config.get('cache_path', None)
+        if self.cache_dirname is not None:
+            self.cache_dirname = os.path.normpath(
+                os.path.expanduser(self.cache_dirname))
+        self.precompile_proc = self.precompile_timer = None
         # Print Stat Tracking
         self.print_stats = self.printer.load_object(config, 'print_stats')
         # Work timer
@@ -40,14 +356,17 @@ class VirtualSD:
         self.gcode.register_command(
             "SDCARD_PRINT_FILE", self.cmd_SDCARD_PRINT_FILE,
             desc=self.cmd_SDCARD_PRINT_FILE_help)
+        if self.cache_dirname is not None:
+            self.gcode.register_command(
+                "SDCARD_PRECOMPILE", self.cmd_SDCARD_PRECOMPILE,
+                desc=self.cmd_SDCARD_PRECOMPILE_help)
     def handle_shutdown(self):
         if self.work_timer is not None:
             self.must_pause_work = True
             try:
                 readpos = max(self.file_position - 1024, 0)
                 readcount = self.file_position - readpos
-                self.current_file.seek(readpos)
-                data = self.current_file.read(readcount + 128)
+                data = self.current_file.read_at(readpos, readcount + 128)
             except:
                 logging.exception("virtual_sdcard shutdown read")
                 return
@@ -57,7 +376,9 @@ class VirtualSD:
     def stats(self, eventtime):
         if self.work_timer is None:
             return False, ""
-        return True, "sd_pos=%d" % (self.file_position,)
+        buffered, stall_time = self.current_file.get_stats()
+        return True, "sd_pos=%d sd_buffered=%d sd_stall=%.3f" % (
+            self.file_position, buffered, stall_time)
     def get_file_list(self, check_subdirs=False):
         if check_subdirs:
             flist = []
@@ -102,6 +423,55 @@ class VirtualSD:
             return 0.
     def is_active(self):
         return self.work_timer is not None
+    # Pre-parsed g-code cache handling
+    def _get_cache_filename(self, fname):
+        key = hashlib.sha1(os.path.realpath(fname).encode()).hexdigest()
+        return os.path.join(self.cache_dirname, key + ".kgc")
+    def _open_cached_file(self, fname):
+        cache_fname = self._get_cache_filename(fname)
+        if not os.path.exists(cache_fname):
+            return None
+        try:
+            return CompiledFile(self.reactor, fname, cache_fname)
+        except:
+            logging.info("Unable to use g-code cache %s for %s",
+                         cache_fname, fname)
+            return None
+    def _start_precompile(self, fname):
+        if self.precompile_proc is not None:
+            return False
+        cache_fname = self._get_cache_filename(fname)
+        def precompile_impl():
+            import queuelogger
+            queuelogger.clear_bg_logging()
+            try:
+                # Try to re-nice compile process
+                os.nice(20)
+            except:
+                pass
+            if not os.path.exists(self.cache_dirname):
+                os.makedirs(self.cache_dirname)
+            compile_gcode_file(fname, cache_fname)
+        logging.info("Starting g-code cache compile of %s to %s",
+                     fname, cache_fname)
+        self.precompile_proc = multiprocessing.Process(target=precompile_impl)
+        self.precompile_proc.daemon = True
+        self.precompile_proc.start()
+        self.precompile_timer = self.reactor.register_timer(
+            self._check_precompile, self.reactor.monotonic() + 1.)
+        return True
+    def _check_precompile(self, eventtime):
+        if self.precompile_proc.is_alive():
+            return eventtime + 1.
+        self.precompile_proc.join()
+        if self.precompile_proc.exitcode:
+            logging.info("G-Code cache compile failed")
+        else:
+            logging.info("G-Code cache compile complete")
+        self.precompile_proc = None
+        self.reactor.unregister_timer(self.precompile_timer)
+        self.precompile_timer = None
+        return self.reactor.NEVER
     def do_pause(self):
         if self.work_timer is not None:
             self.must_pause_work = True
@@ -149,6 +519,16 @@ class VirtualSD:
             filename = filename[1:]
         self._load_file(gcmd, filename, check_subdirs=True)
         self.do_resume()
+    cmd_SDCARD_PRECOMPILE_help = "Build the pre-parsed g-code cache for a "\
+        "file"
+    def cmd_SDCARD_PRECOMPILE(self, gcmd):
+        filename = gcmd.get("FILENAME")
+        if filename[0] == '/':
+            filename = filename[1:]
+        fname = self._find_file(gcmd, filename, check_subdirs=True)
+        if not self._start_precompile(fname):
+            raise gcmd.error("G-Code cache compile already in progress")
+        gcmd.respond_info("Compiling g-code cache for %s" % (filename,))
     def cmd_M20(self, gcmd):
         # List SD card
         files = self.get_file_list()
@@ -168,7 +548,7 @@ class VirtualSD:
         if filename.startswith('/'):
             filename = filename[1:]
         self._load_file(gcmd, filename)
-    def _load_file(self, gcmd, filename, check_subdirs=False):
+    def _find_file(self, gcmd, filename, check_subdirs=False):
         files = self.get_file_list(check_subdirs)
         flist = [f[0] for f in files]
         files_by_lower = { fname.lower(): fname for fname, fsize in files }
@@ -176,11 +556,21 @@ class VirtualSD:
         try:
             if fname not in flist:
                 fname = files_by_lower[fname.lower()]
-            fname = os.path.join(self.sdcard_dirname, fname)
-            f = io.open(fname, 'r', newline='')
-            f.seek(0, os.SEEK_END)
-            fsize = f.tell()
-            f.seek(0)
+        except:
+            logging.exception("virtual_sdcard file open")
+            raise gcmd.error("Unable to open file")
+        return os.path.join(self.sdcard_dirname, fname)
+    def _load_file(self, gcmd, filename, check_subdirs=False):
+        fname = self._find_file(gcmd, filename, check_subdirs)
+        f = None
+        if self.cache_dirname is not None:
+            f = self._open_cached_file(fname)
+        try:
+            if f is None:
+                f = ReadAheadFile(self.reactor, fname)
+                if self.cache_dirname is not None:
+                    self._start_precompile(fname)
+            fsize = f.get_file_size()
         except:
             logging.exception("virtual_sdcard file open")
             raise gcmd.error("Unable to open file")
@@ -219,49 +609,59 @@ class VirtualSD:
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
-        try:
-            self.current_file.seek(self.file_position)
-        except:
-            logging.exception("virtual_sdcard seek")
-            self.work_timer = None
-            return self.reactor.NEVER
+        self.current_file.seek(self.file_position)
+        self.current_file.start()
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
         lines = []
         error_message = None
         while not self.must_pause_work:
             if not lines:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    lines = self.current_file.read_lines()
                 except:
                     logging.exception("virtual_sdcard read")
                     break
-                if not data:
+                if lines is None:
                     # End of file
                     self.current_file.close()
                     self.current_file = None
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
+            # Dispatch a batch of commands while holding the gcode mutex
             self.cmd_from_sd = True
-            line = lines.pop()
-            next_file_position = self.file_position + len(line) + 1
-            self.next_file_position = next_file_position
+            need_seek = False
             try:
-                self.gcode.run_script(line)
+                with gcode_mutex:
+                    while lines and not self.must_pause_work:
+                        line = lines.pop()
+                        cmd = None
+                        if line.__class__ is tuple:
+                            # Pre-parsed move from the g-code cache
+                            line, cmd, params = line
+                        next_file_position = self.file_position + len(line) + 1
+                        self.next_file_position = next_file_position
+                        if cmd is None:
+                            self.gcode.run_script_from_command(line.decode())
+                        else:
+                            self.gcode.run_parsed_command(
+                                cmd, params, line.decode().strip())
+                        self.file_position = self.next_file_position
+                        # Do we need to skip around?
+                        if self.next_file_position != next_file_position:
+                            need_seek = True
+                            break
+                        # Yield to any other request waiting on the mutex
+                        if gcode_mutex.has_waiters():
+                            break
             except self.gcode.error as e:
                 error_message = str(e)
                 try:
@@ -273,18 +673,12 @@ class VirtualSD:
                 logging.exception("virtual_sdcard dispatch")
                 break
             self.cmd_from_sd = False
-            self.file_position = self.next_file_position
-            # Do we need to skip around?
-            if self.next_file_position != next_file_position:
-                try:
-                    self.current_file.seek(self.file_position)
-                except:
-                    logging.exception("virtual_sdcard seek")
-                    self.work_timer = None
-                    return self.reactor.NEVER
+            if need_seek:
+                self.current_file.seek(self.file_position)
                 lines = []
-                partial_input = ""
         logging.info("Exiting SD card print (position %d)", self.file_position)
+        if self.current_file is not None:
+            self.current_file.stop()
         self.work_timer = None
         self.cmd_from_sd = False
         if error_message is not None:
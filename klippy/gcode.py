@@ -103,6 +103,7 @@ class GCodeDispatch:
         self.base_gcode_handlers = self.gcode_handlers = {}
         self.ready_gcode_handlers = {}
         self.mux_commands = {}
+        self.fast_handlers = {}
         self.gcode_help = {}
         self.status_commands = {}
         # Register commands needed before config file is loaded
@@ -127,6 +128,7 @@ class GCodeDispatch:
                 del self.ready_gcode_handlers[cmd]
             if cmd in self.base_gcode_handlers:
                 del self.base_gcode_handlers[cmd]
+            self.fast_handlers.pop(cmd, None)
             self._build_status_commands()
             return old_cmd
         if cmd in self.ready_gcode_handlers:
@@ -141,6 +143,14 @@ class GCodeDispatch:
         if desc is not None:
             self.gcode_help[cmd] = desc
         self._build_status_commands()
+    def register_fast_command(self, cmd, fast_func):
+        # Register a handler that receives pre-parsed float parameters
+        # for simple "traditional" commands (eg, "G1 X10 Y20 F3000")
+        func = self.ready_gcode_handlers.get(cmd)
+        if func is None or not self.is_traditional_gcode(cmd):
+            raise self.printer.config_error(
+                "gcode command %s not available for fast dispatch" % (cmd,))
+        self.fast_handlers[cmd] = (func, fast_func)
     def register_mux_command(self, cmd, key, value, func, desc=None):
         prev = self.mux_commands.get(cmd)
         if prev is None:
@@ -185,13 +195,29 @@ class GCodeDispatch:
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    fast_r = re.compile(r'G[0-3](?:\s+[A-Z][-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))*'
+                        r'\s*$')
     def _process_commands(self, commands, need_ack=True):
+        fast_handlers = self.fast_handlers
         for line in commands:
             # Ignore comments and leading/trailing spaces
             line = origline = line.strip()
             cpos = line.find(';')
             if cpos >= 0:
                 line = line[:cpos]
+            # Fast path for simple move commands
+            if self.fast_r.match(line) is not None:
+                parts = line.split()
+                cmd = parts[0]
+                fast_handler = fast_handlers.get(cmd)
+                if (fast_handler is not None
+                    and fast_handler[0] is self.gcode_handlers.get(cmd)):
+                    params = {p[0]: float(p[1:]) for p in parts[1:]}
+                    self._run_handler(fast_handler[1], (params, origline),
+                                      cmd, need_ack)
+                    if need_ack:
+                        self.respond_raw("ok")
+                    continue
             # Break line into parts and determine command
             parts = self.args_r.split(line.upper())
             numparts = len(parts)
@@ -207,21 +233,32 @@ class GCodeDispatch:
             gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
             # Invoke handler for command
             handler = self.gcode_handlers.get(cmd, self.cmd_default)
-            try:
-                handler(gcmd)
-            except self.error as e:
-                self._respond_error(str(e))
-                self.printer.send_event("gcode:command_error")
-                if not need_ack:
-                    raise
-            except:
-                msg = 'Internal error on command:"%s"' % (cmd,)
-                logging.exception(msg)
-                self.printer.invoke_shutdown(msg)
-                self._respond_error(msg)
-                if not need_ack:
-                    raise
+            self._run_handler(handler, (gcmd,), cmd, need_ack)
             gcmd.ack()
+    def _run_handler(self, handler, args, cmd, need_ack):
+        try:
+            handler(*args)
+        except self.error as e:
+            self._respond_error(str(e))
+            self.printer.send_event("gcode:command_error")
+            if not need_ack:
+                raise
+        except:
+            msg = 'Internal error on command:"%s"' % (cmd,)
+            logging.exception(msg)
+            self.printer.invoke_shutdown(msg)
+            self._respond_error(msg)
+            if not need_ack:
+                raise
+    def run_parsed_command(self, cmd, params, commandline):
+        # Run a command whose parameters were already parsed by the
+        # caller (the caller must hold the mutex)
+        fast_handler = self.fast_handlers.get(cmd)
+        if (fast_handler is None
+            or fast_handler[0] is not self.gcode_handlers.get(cmd)):
+            self._process_commands([commandline], need_ack=False)
+            return
+        self._run_handler(fast_handler[1], (params, commandline), cmd, False)
     def run_script_from_command(self, script):
         self._process_commands(script.split('\n'), need_ack=False)
     def run_script(self, script):
@@ -259,21 +259,24 @@ class PrinterExtruder:
         if diff_r:
             return (self.instant_corner_v / abs(diff_r))**2
         return move.max_cruise_v2
-    def move(self, print_time, move):
+    def prepare_move(self, print_time, move):
+        # Return the trapq parameters for a move (caller must queue them)
         axis_r = move.axes_r[3]
         accel = move.accel * axis_r
         start_v = move.start_v * axis_r
         cruise_v = move.cruise_v * axis_r
-        can_pressure_advance = False
+        can_pressure_advance = 0.
         if axis_r > 0. and (move.axes_d[0] or move.axes_d[1]):
-            can_pressure_advance = True
-        # Queue movement (x is extruder movement, y is pressure advance flag)
-        self.trapq_append(self.trapq, print_time,
-                          move.accel_t, move.cruise_t, move.decel_t,
-                          move.start_pos[3], 0., 0.,
-                          1., can_pressure_advance, 0.,
-                          start_v, cruise_v, accel)
+            can_pressure_advance = 1.
         self.last_position = move.end_pos[3]
+        # Movement parameters (x is extruder movement, y is pressure
+        # advance flag)
+        return (print_time, move.accel_t, move.cruise_t, move.decel_t,
+                move.start_pos[3], 0., 0.,
+                1., can_pressure_advance, 0.,
+                start_v, cruise_v, accel)
+    def move(self, print_time, move):
+        self.trapq_append(self.trapq, *self.prepare_move(print_time, move))
     def find_past_position(self, print_time):
         if self.extruder_stepper is None:
             return 0.
@@ -305,8 +305,15 @@ def main():
                     help="input tty name (default is /tmp/printer)")
     opts.add_option("-a", "--api-server", dest="apiserver",
                     help="api server unix domain socket filename")
+    opts.add_option("--api-json-thread", action="store_true",
+                    dest="apijsonthread",
+                    help="encode and decode api server messages in a thread")
     opts.add_option("-l", "--logfile", dest="logfile",
                     help="write log to file instead of stderr")
+    opts.add_option("--log-flush-interval", type="float", dest="logflush",
+                    default=0., help="maximum time to buffer log file writes")
+    opts.add_option("--stats-log", dest="statslog",
+                    help="also write periodic statistics to a json file")
     opts.add_option("-v", action="store_true", dest="verbose",
                     help="enable debug messages")
     opts.add_option("-o", "--debugoutput", dest="debugoutput",
@@ -321,8 +328,12 @@ def main():
         import_test()
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
+    if options.statslog and not options.logfile:
+        opts.error("The --stats-log option requires a log file")
     start_args = {'config_file': args[0], 'apiserver': options.apiserver,
                   'start_reason': 'startup'}
+    if options.apijsonthread:
+        start_args['api_json_thread'] = True
 
     debuglevel = logging.INFO
     if options.verbose:
@@ -339,7 +350,8 @@ def main():
     bglogger = None
     if options.logfile:
         start_args['log_file'] = options.logfile
-        bglogger = queuelogger.setup_bg_logging(options.logfile, debuglevel)
+        bglogger = queuelogger.setup_bg_logging(
+            options.logfile, debuglevel, options.logflush, options.statslog)
     else:
         logging.getLogger().setLevel(debuglevel)
     logging.info("Starting Klippy...")
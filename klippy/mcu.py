@@ -89,8 +89,8 @@ class CommandWrapper:
         self._cmd_queue = cmd_queue
         self._msgtag = msgparser.lookup_msgtag(msgformat) & 0xffffffff
     def send(self, data=(), minclock=0, reqclock=0):
-        cmd = self._cmd.encode(data)
-        self._serial.raw_send(cmd, minclock, reqclock, self._cmd_queue)
+        self._serial.send_format(self._cmd, data, minclock, reqclock,
+                                 self._cmd_queue)
     def get_command_tag(self):
         return self._msgtag
 
@@ -405,7 +405,7 @@ class MCU_pwm:
         if self._max_duration and self._start_value != self._shutdown_value:
             raise pins.error("Pin with max duration must have start"
                              " value equal to shutdown value")
-        cmd_queue = self._mcu.alloc_command_queue()
+        cmd_queue = self._mcu.alloc_command_queue('high')
         curtime = self._mcu.get_printer().get_reactor().monotonic()
         printtime = self._mcu.estimated_print_time(curtime)
         self._last_clock = self._mcu.print_time_to_clock(printtime + 0.200)
@@ -553,6 +553,11 @@ class MCU_adc:
 # Main MCU class
 ######################################################################
 
+MCU_STATS_COUNTERS = [
+    'bytes_write', 'bytes_read', 'bytes_retransmit', 'bytes_invalid',
+    'send_seq', 'receive_seq', 'retransmit_seq',
+    'high_bytes', 'normal_bytes', 'bulk_bytes']
+
 class MCU:
     error = error
     def __init__(self, config, clocksync):
@@ -621,6 +626,9 @@ class MCU:
         printer.register_event_handler("klippy:connect", self._connect)
         printer.register_event_handler("klippy:shutdown", self._shutdown)
         printer.register_event_handler("klippy:disconnect", self._disconnect)
+        printer_stats = printer.load_object(config, 'statistics')
+        printer_stats.register_metrics(config.get_name(), self._get_metrics,
+                                       counters=MCU_STATS_COUNTERS)
     # Serial callbacks
     def _handle_mcu_stats(self, params):
         count = params['count']
@@ -866,8 +874,14 @@ class MCU:
         return self._name
     def register_response(self, cb, msg, oid=None):
         self._serial.register_response(cb, msg, oid)
-    def alloc_command_queue(self):
-        return self._serial.alloc_command_queue()
+    def try_alloc_message_ring(self, msg, oid, buf_size=0, max_records=4096):
+        try:
+            return self._serial.alloc_message_ring(msg, oid, buf_size,
+                                                   max_records)
+        except serialhdl.error as e:
+            return None
+    def alloc_command_queue(self, priority='normal'):
+        return self._serial.alloc_command_queue(priority)
     def lookup_command(self, msgformat, cq=None):
         return CommandWrapper(self._serial, msgformat, cq)
     def lookup_query_command(self, msgformat, respformat, oid=None,
@@ -1001,6 +1015,8 @@ class MCU:
         last_stats = {k:(float(v) if '.' in v else int(v)) for k, v in parts}
         self._get_status_info['last_stats'] = last_stats
         return False, '%s: %s' % (self._name, stats)
+    def _get_metrics(self, eventtime):
+        return self._get_status_info.get('last_stats', {})
 
 Common_MCU_errors = {
     ("Timer too close",): """
@@ -39,6 +39,7 @@ class PT_uint32:
     is_dynamic_string = False
     max_length = 5
     signed = False
+    c_type = 'u'
     def encode(self, out, v):
         if v >= 0xc000000 or v < -0x4000000: out.append((v>>28) & 0x7f | 0x80)
         if v >= 0x180000 or v < -0x80000:    out.append((v>>21) & 0x7f | 0x80)
@@ -61,6 +62,7 @@ class PT_uint32:
 
 class PT_int32(PT_uint32):
     signed = True
+    c_type = 'i'
 class PT_uint16(PT_uint32):
     max_length = 3
 class PT_int16(PT_int32):
@@ -73,6 +75,7 @@ class PT_string:
     is_int = False
     is_dynamic_string = True
     max_length = 64
+    c_type = 's'
     def encode(self, out, v):
         out.append(len(v))
         out.extend(bytearray(v))
@@ -99,6 +102,7 @@ class Enumeration:
     def __init__(self, pt, enum_name, enums):
         self.pt = pt
         self.max_length = pt.max_length
+        self.c_type = pt.c_type
         self.enum_name = enum_name
         self.enums = enums
         self.reverse_enums = {v: k for k, v in enums.items()}
@@ -159,6 +163,73 @@ def convert_msg_format(msgformat):
         msgformat = msgformat.replace(c, '%s')
     return msgformat
 
+# The C helper code is loaded on first use (this module is also used
+# by tools that may not be able to build it)
+c_helper = None
+
+def get_c_helper():
+    global c_helper
+    if c_helper is None:
+        try:
+            import chelper
+            c_helper = chelper.get_ffi()
+        except Exception:
+            logging.debug("msgproto C helper unavailable", exc_info=True)
+            c_helper = ()
+    return c_helper
+
+# Encode messages using the C helper code (chelper/msgparse.c)
+class CMessageFormat:
+    def __init__(self, mf):
+        self.ffi_main, self.ffi_lib = get_c_helper()
+        self.msgid = mf.msgid
+        self.c_format = self.ffi_main.new('struct msgparse_format *')
+        ret = self.ffi_lib.msgparse_format_init(self.c_format,
+                                                mf.c_types.encode())
+        if ret:
+            raise error("Unable to use C helper for %s" % (mf.msgformat,))
+        self.num_params = len(mf.param_types)
+        self.buffers = [i for i, t in enumerate(mf.param_types)
+                        if t.is_dynamic_string]
+        self.enums = [(i, t) for i, t in enumerate(mf.param_types)
+                      if isinstance(t, Enumeration)]
+    def get_params(self, params):
+        # Return the (params, bufdata) arguments for the C code (or None
+        # if the C code can not encode these parameters)
+        if len(params) < self.num_params:
+            return None
+        if not self.buffers and not self.enums:
+            return params, b""
+        params = list(params)
+        for i, t in self.enums:
+            tv = t.enums.get(params[i])
+            if tv is None:
+                return None
+            params[i] = tv
+        bufs = []
+        for i in self.buffers:
+            try:
+                v = bytes(bytearray(params[i]))
+            except Exception:
+                return None
+            params[i] = len(v)
+            bufs.append(v)
+        return params, b"".join(bufs)
+    def encode(self, params):
+        cparams = self.get_params(params)
+        if cparams is None:
+            return None
+        out = self.ffi_main.new('uint8_t[]', MESSAGE_MAX)
+        try:
+            ret = self.ffi_lib.msgparse_encode_format(
+                self.c_format, self.msgid, cparams[0], cparams[1],
+                out, MESSAGE_PAYLOAD_MAX)
+        except (TypeError, OverflowError):
+            return None
+        if ret < 0:
+            return None
+        return self.ffi_main.unpack(out, ret)
+
 class MessageFormat:
     def __init__(self, msgid, msgformat, enumerations={}):
         self.msgid = msgid
@@ -168,6 +239,18 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
+        self.c_types = "".join([t.c_type for t in self.param_types])
+        self.c_format = None
+    def get_c_format(self):
+        # Return a CMessageFormat (or None if the C helper is unavailable)
+        if self.c_format is None:
+            self.c_format = False
+            if get_c_helper():
+                try:
+                    self.c_format = CMessageFormat(self)
+                except error:
+                    pass
+        return self.c_format or None
     def encode(self, params):
         out = []
         out.append(self.msgid)
@@ -3,41 +3,119 @@
 # Copyright (C) 2016-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, logging.handlers, threading, queue, time
+import logging, logging.handlers, threading, queue, time, json
+
+# Argument types that may be safely formatted in the background thread
+DEFER_FORMAT_TYPES = {str, int, float, bool, type(None)}
 
 # Class to forward all messages through a queue to a background thread
 class QueueHandler(logging.Handler):
     def __init__(self, queue):
         logging.Handler.__init__(self)
         self.queue = queue
+    def _can_defer(self, record):
+        if record.exc_info or type(record.msg) is not str:
+            return False
+        args = record.args
+        if type(args) is not tuple:
+            return not args
+        for arg in args:
+            if type(arg) not in DEFER_FORMAT_TYPES:
+                return False
+        return True
     def emit(self, record):
         try:
-            self.format(record)
-            record.msg = record.message
-            record.args = None
-            record.exc_info = None
+            if not self._can_defer(record):
+                # Mutable arguments must be formatted by the caller
+                self.format(record)
+                record.msg = record.message
+                record.args = None
+                record.exc_info = None
             self.queue.put_nowait(record)
         except Exception:
             self.handleError(record)
 
+# Convert a value from a "Stats" line into a json value
+def parse_stats_value(val):
+    try:
+        return int(val)
+    except ValueError:
+        pass
+    try:
+        return float(val)
+    except ValueError:
+        return val
+
+# Convert the parts of a "Stats" line into a dictionary
+def parse_stats(eventtime, parts):
+    out = {'time': round(eventtime, 3)}
+    for part in parts:
+        group = out
+        for p in part.split():
+            if '=' not in p:
+                group = out.setdefault(p.rstrip(':'), {})
+                continue
+            name, val = p.split('=', 1)
+            group[name] = parse_stats_value(val)
+    return out
+
 # Class to poll a queue in a background thread and log each message
 class QueueListener(logging.handlers.TimedRotatingFileHandler):
-    def __init__(self, filename):
+    def __init__(self, filename, flush_interval=0., stats_filename=None):
         logging.handlers.TimedRotatingFileHandler.__init__(
             self, filename, when='midnight', backupCount=5)
+        self.flush_interval = flush_interval
+        self.stats_handler = None
+        if stats_filename is not None:
+            self.stats_handler = logging.handlers.TimedRotatingFileHandler(
+                stats_filename, when='midnight', backupCount=5)
         self.bg_queue = queue.Queue()
         self.bg_thread = threading.Thread(target=self._bg_thread)
         self.bg_thread.start()
         self.rollover_info = {}
     def _bg_thread(self):
+        flush_time = None
         while 1:
-            record = self.bg_queue.get(True)
+            # Writes are batched - flush once the queue is empty or
+            # once flush_interval has elapsed
+            timeout = None
+            if flush_time is not None:
+                timeout = max(0., flush_time - time.time())
+            try:
+                record = self.bg_queue.get(True, timeout)
+            except queue.Empty:
+                self._flush_batch()
+                flush_time = None
+                continue
             if record is None:
                 break
             self.handle(record)
+            if self.stats_handler is not None:
+                self._write_stats(record)
+            if flush_time is None:
+                flush_time = time.time() + self.flush_interval
+            elif time.time() >= flush_time:
+                self._flush_batch()
+                flush_time = None
+        self._flush_batch()
+    def _write_stats(self, record):
+        stats_info = getattr(record, 'stats_info', None)
+        if stats_info is None:
+            return
+        stats = parse_stats(*stats_info)
+        self.stats_handler.handle(logging.makeLogRecord(
+            {'msg': json.dumps(stats, separators=(',', ':')),
+             'level': logging.INFO}))
+    def _flush_batch(self):
+        logging.handlers.TimedRotatingFileHandler.flush(self)
+    def flush(self):
+        # Flushing is performed by _flush_batch()
+        pass
     def stop(self):
         self.bg_queue.put_nowait(None)
         self.bg_thread.join()
+        if self.stats_handler is not None:
+            self.stats_handler.close()
     def set_rollover_info(self, name, info):
         if info is None:
             self.rollover_info.pop(name, None)
@@ -57,9 +135,10 @@ class QueueListener(logging.handlers.TimedRotatingFileHandler):
 
 MainQueueHandler = None
 
-def setup_bg_logging(filename, debuglevel):
+def setup_bg_logging(filename, debuglevel, flush_interval=0.,
+                     stats_filename=None):
     global MainQueueHandler
-    ql = QueueListener(filename)
+    ql = QueueListener(filename, flush_interval, stats_filename)
     MainQueueHandler = QueueHandler(ql.bg_queue)
     root = logging.getLogger()
     root.addHandler(MainQueueHandler)
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, queue
+import os, gc, select, math, time, logging, queue, bisect
 import greenlet
 import chelper, util
 
@@ -72,6 +72,8 @@ class ReactorMutex:
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def has_waiters(self):
+        return not not self.queue
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
@@ -91,6 +93,89 @@ class ReactorMutex:
         self.next_pending = True
         self.reactor.update_timer(self.queue[0].timer, self.reactor.NOW)
 
+# Upper bounds (in seconds) of the timer delay histogram buckets
+DELAY_BUCKETS = [.001, .002, .005, .010, .025, .050, .100, .250]
+
+# Optional accounting of the time spent in each reactor callback.
+# Time is only charged to a callback while it is running - time spent
+# while its greenlet is paused is not included.
+class ReactorProfiler:
+    def __init__(self, monotonic):
+        self.monotonic = monotonic
+        self.clock = time.perf_counter
+        self.cur_name = None
+        self.cur_start = 0.
+        self.reset()
+    def reset(self):
+        self.callbacks = {}
+        self.timer_delay = [0] * (len(DELAY_BUCKETS) + 1)
+        self.start_time = self.monotonic()
+    def _account(self, now):
+        name = self.cur_name
+        if name is None:
+            return
+        run_time = now - self.cur_start
+        cs = self.callbacks.get(name)
+        if cs is None:
+            cs = self.callbacks[name] = [0, 0., 0.]
+        cs[1] += run_time
+        if run_time > cs[2]:
+            cs[2] = run_time
+    def call(self, callback, eventtime):
+        name = getattr(callback, '__qualname__', None) or repr(callback)
+        start = self.clock()
+        outer_name = self.cur_name
+        if outer_name is not None:
+            self._account(start)
+        self.cur_name = name
+        self.cur_start = start
+        res = callback(eventtime)
+        now = self.clock()
+        cs = self.callbacks.get(name)
+        if cs is None:
+            cs = self.callbacks[name] = [0, 0., 0.]
+        cs[0] += 1
+        if self.cur_name is name:
+            run_time = now - self.cur_start
+            cs[1] += run_time
+            if run_time > cs[2]:
+                cs[2] = run_time
+        else:
+            self._account(now)
+        self.cur_name = outer_name
+        self.cur_start = now
+        return res
+    def call_timer(self, callback, waketime, eventtime):
+        if waketime > _NOW:
+            delay = eventtime - waketime
+            self.timer_delay[bisect.bisect_left(DELAY_BUCKETS, delay)] += 1
+        return self.call(callback, eventtime)
+    def pause_begin(self):
+        now = self.clock()
+        self._account(now)
+        name = self.cur_name
+        self.cur_name = None
+        self.cur_start = now
+        return name
+    def pause_end(self, name):
+        now = self.clock()
+        self._account(now)
+        self.cur_name = name
+        self.cur_start = now
+    def get_stats(self):
+        callbacks = {name: {'count': cs[0], 'total_time': round(cs[1], 6),
+                            'max_time': round(cs[2], 6)}
+                     for name, cs in self.callbacks.items()}
+        delay = {}
+        for i, count in enumerate(self.timer_delay):
+            if i < len(DELAY_BUCKETS):
+                label = "<%gms" % (DELAY_BUCKETS[i] * 1000.,)
+            else:
+                label = ">=%gms" % (DELAY_BUCKETS[-1] * 1000.,)
+            delay[label] = count
+        return {'duration': self.monotonic() - self.start_time,
+                'callbacks': callbacks, 'timer_delay': delay}
+
 class SelectReactor:
     NOW = _NOW
     NEVER = _NEVER
@@ -101,6 +186,8 @@ class SelectReactor:
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
+        # Callback profiling
+        self._profiler = None
         # Timers
         self._timers = []
         self._next_timer = self.NEVER
@@ -116,6 +203,14 @@ class SelectReactor:
         self._all_greenlets = []
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    # Profiling
+    def set_profiling(self, enable):
+        if not enable:
+            self._profiler = None
+        elif self._profiler is None:
+            self._profiler = ReactorProfiler(self.monotonic)
+    def get_profiler(self):
+        return self._profiler
     # Timers
     def update_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
@@ -151,11 +246,16 @@ class SelectReactor:
             return min(1., max(.001, self._next_timer - eventtime))
         self._next_timer = self.NEVER
         g_dispatch = self._g_dispatch
+        prof = self._profiler
         for t in self._timers:
             waketime = t.waketime
             if eventtime >= waketime:
                 t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
+                if prof is None:
+                    t.waketime = waketime = t.callback(eventtime)
+                else:
+                    t.waketime = waketime = prof.call_timer(
+                        t.callback, waketime, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._next_timer = min(self._next_timer, waketime)
                     self._end_greenlet(g_dispatch)
@@ -210,6 +310,12 @@ class SelectReactor:
         if g is not self._g_dispatch:
             if self._g_dispatch is None:
                 return self._sys_pause(waketime)
+            prof = self._profiler
+            if prof is not None:
+                name = prof.pause_begin()
+                eventtime = self._g_dispatch.switch(waketime)
+                prof.pause_end(name)
+                return eventtime
             # Switch to _check_timers (via g.timer.callback return)
             return self._g_dispatch.switch(waketime)
         # Pausing the dispatch greenlet - prepare a new greenlet to do dispatch
@@ -221,6 +327,12 @@ class SelectReactor:
         g_next.parent = g.parent
         g.timer = self.register_timer(g.switch, waketime)
         self._next_timer = self.NOW
+        prof = self._profiler
+        if prof is not None:
+            name = prof.pause_begin()
+            eventtime = g_next.switch()
+            prof.pause_end(name)
+            return eventtime
         # Switch to _dispatch_loop (via _end_greenlet or direct)
         eventtime = g_next.switch()
         # This greenlet activated from g.timer.callback (via _check_timers)
@@ -270,14 +382,20 @@ class SelectReactor:
             eventtime = self.monotonic()
             for fd in res[0]:
                 busy = True
-                fd.read_callback(eventtime)
+                if self._profiler is None:
+                    fd.read_callback(eventtime)
+                else:
+                    self._profiler.call(fd.read_callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
             for fd in res[1]:
                 busy = True
-                fd.write_callback(eventtime)
+                if self._profiler is None:
+                    fd.write_callback(eventtime)
+                else:
+                    self._profiler.call(fd.write_callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -344,13 +462,21 @@ class PollReactor(SelectReactor):
             for fd, event in res:
                 busy = True
                 if event & (select.POLLIN | select.POLLHUP):
-                    self._fds[fd].read_callback(eventtime)
+                    if self._profiler is None:
+                        self._fds[fd].read_callback(eventtime)
+                    else:
+                        self._profiler.call(self._fds[fd].read_callback,
+                                            eventtime)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
                         break
                 if event & select.POLLOUT:
-                    self._fds[fd].write_callback(eventtime)
+                    if self._profiler is None:
+                        self._fds[fd].write_callback(eventtime)
+                    else:
+                        self._profiler.call(self._fds[fd].write_callback,
+                                            eventtime)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
@@ -395,13 +521,21 @@ class EPollReactor(SelectReactor):
             for fd, event in res:
                 busy = True
                 if event & (select.EPOLLIN | select.EPOLLHUP):
-                    self._fds[fd].read_callback(eventtime)
+                    if self._profiler is None:
+                        self._fds[fd].read_callback(eventtime)
+                    else:
+                        self._profiler.call(self._fds[fd].read_callback,
+                                            eventtime)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
                         break
                 if event & select.EPOLLOUT:
-                    self._fds[fd].write_callback(eventtime)
+                    if self._profiler is None:
+                        self._fds[fd].write_callback(eventtime)
+                    else:
+                        self._profiler.call(self._fds[fd].write_callback,
+                                            eventtime)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
@@ -11,6 +11,112 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+# Command queue priority classes (see chelper/serialqueue.c)
+CQ_PRIORITIES = {'high': 0, 'normal': 1, 'bulk': 2}
+
+# Decode mcu responses using the C helper code
+class MessageDecoder:
+    def __init__(self, msgparser):
+        self.msgparser = msgparser
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.c_parser = self.ffi_main.gc(self.ffi_lib.msgparse_alloc(),
+                                         self.ffi_lib.msgparse_free)
+        self.result = self.ffi_main.new('struct msgparse_result *')
+        self.formats = {}
+        for msgid, mf in msgparser.messages_by_id.items():
+            if not isinstance(mf, msgproto.MessageFormat):
+                continue
+            ret = self.ffi_lib.msgparse_add_format(
+                self.c_parser, msgid, mf.c_types.encode())
+            if ret:
+                continue
+            names = [name for name, pt in mf.param_names]
+            buffers = [(i, name) for i, (name, pt) in enumerate(mf.param_names)
+                       if pt.is_dynamic_string]
+            enums = [(name, pt.reverse_enums) for name, pt in mf.param_names
+                     if isinstance(pt, msgproto.Enumeration)]
+            self.formats[msgid] = (mf.name, names, buffers, enums)
+    def _build_params(self, msg):
+        name, names, buffers, enums = self.formats[self.result.msgid]
+        values = self.ffi_main.unpack(self.result.params, len(names))
+        params = dict(zip(names, values))
+        for i, pname in buffers:
+            pos = values[i]
+            params[pname] = self.ffi_main.buffer(msg)[pos:pos+msg[pos-1]]
+        for pname, reverse_enums in enums:
+            v = params[pname]
+            tv = reverse_enums.get(v)
+            if tv is None:
+                tv = "?%d" % (v,)
+            params[pname] = tv
+        params['#name'] = name
+        return params
+    def parse(self, msg, msglen):
+        ret = self.ffi_lib.msgparse_decode(self.c_parser, msg, msglen,
+                                           self.result)
+        if ret:
+            # Unknown, output, or invalid message - use python parser
+            return self.msgparser.parse(msg[0:msglen])
+        return self._build_params(msg)
+    def pull(self, serialqueue, pqm):
+        # Wait for the next message from the serialqueue and decode it
+        self.ffi_lib.msgparse_pull(self.c_parser, serialqueue, pqm,
+                                   self.result)
+    def parse_pulled(self, pqm):
+        if self.result.msgid < 0:
+            return self.msgparser.parse(pqm.msg[0:pqm.len])
+        return self._build_params(pqm.msg)
+
+# Store all responses of one message type and oid in a C ring buffer
+# (instead of dispatching each message to a python handler).  The ring
+# is owned by the SerialReader and is freed on disconnect.
+class MessageRing:
+    def __init__(self, serial, msg_name, oid, buf_size=0, max_records=4096):
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        msgparser = serial.get_msgparser()
+        mf = msgparser.messages_by_name.get(msg_name)
+        if mf is None:
+            raise error("Unknown message %s" % (msg_name,))
+        msgtag = msgparser.lookup_msgtag(mf.msgformat) & 0xffffffff
+        self.param_names = [name for name, pt in mf.param_names]
+        serialqueue = serial.get_serialqueue()
+        if serialqueue is None:
+            raise error("Unable to allocate message ring for %s"
+                        % (msg_name,))
+        self.ring = self.ffi_lib.msgring_alloc(
+            serialqueue, msgtag, oid, mf.c_types.encode(),
+            buf_size, max_records)
+        if self.ring == self.ffi_main.NULL:
+            raise error("Unable to allocate message ring for %s"
+                        % (msg_name,))
+        self.record_size = self.ffi_lib.msgring_get_record_size(self.ring)
+        self.last_overflows = 0
+        self.max_records = max_records
+        self.pull_buf = self.ffi_main.new('uint8_t[]',
+                                          self.record_size * max_records)
+    def get_param_names(self):
+        return list(self.param_names)
+    def get_record_size(self):
+        return self.record_size
+    def get_overflows(self):
+        if self.ring is not None:
+            self.last_overflows = self.ffi_lib.msgring_get_overflows(
+                self.ring)
+        return self.last_overflows
+    def pull(self):
+        # Return the pending records as a single bytes object
+        if self.ring is None:
+            return b""
+        count = self.ffi_lib.msgring_pull(self.ring, self.pull_buf,
+                                          self.max_records)
+        return self.ffi_main.buffer(self.pull_buf, count * self.record_size)[:]
+    def free(self):
+        # Must be called before the serialqueue is freed
+        if self.ring is not None:
+            self.get_overflows()
+            self.ffi_lib.msgring_free(self.ring)
+            self.ring = None
+
 class SerialReader:
     def __init__(self, reactor, warn_prefix=""):
         self.reactor = reactor
@@ -18,6 +124,7 @@ class SerialReader:
         # Serial port
         self.serial_dev = None
         self.msgparser = msgproto.MessageParser(warn_prefix=warn_prefix)
+        self.msgdecoder = MessageDecoder(self.msgparser)
         # C interface
         self.ffi_main, self.ffi_lib = chelper.get_ffi()
         self.serialqueue = None
@@ -33,10 +140,13 @@ class SerialReader:
         # Sent message notification tracking
         self.last_notify_id = 0
         self.pending_notifications = {}
+        # Message rings (freed on disconnect)
+        self.message_rings = []
     def _bg_thread(self):
         response = self.ffi_main.new('struct pull_queue_message *')
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
+            msgdecoder = self.msgdecoder
+            msgdecoder.pull(self.serialqueue, response)
             count = response.len
             if count < 0:
                 break
@@ -46,7 +156,11 @@ class SerialReader:
                 completion = self.pending_notifications.pop(response.notify_id)
                 self.reactor.async_complete(completion, params)
                 continue
-            params = self.msgparser.parse(response.msg[0:count])
+            if msgdecoder is self.msgdecoder:
+                params = msgdecoder.parse_pulled(response)
+            else:
+                # Decoder was replaced (by _start_session) while waiting
+                params = self.msgdecoder.parse(response.msg, count)
             params['#sent_time'] = response.sent_time
             params['#receive_time'] = response.receive_time
             hdl = (params['#name'], params.get('oid'))
@@ -94,6 +208,7 @@ class SerialReader:
         msgparser = msgproto.MessageParser(warn_prefix=self.warn_prefix)
         msgparser.process_identify(identify_data)
         self.msgparser = msgparser
+        self.msgdecoder = MessageDecoder(msgparser)
         self.register_response(self.handle_unknown, '#unknown')
         # Setup baud adjust
         if serial_fd_type == b'c':
@@ -209,6 +324,9 @@ class SerialReader:
             self.ffi_lib.serialqueue_exit(self.serialqueue)
             if self.background_thread is not None:
                 self.background_thread.join()
+            for ring in self.message_rings:
+                ring.free()
+            self.message_rings = []
             self.background_thread = self.serialqueue = None
         if self.serial_dev is not None:
             self.serial_dev.close()
@@ -226,6 +344,11 @@ class SerialReader:
         return self.reactor
     def get_msgparser(self):
         return self.msgparser
+    def alloc_message_ring(self, msg_name, oid, buf_size=0,
+                           max_records=4096):
+        ring = MessageRing(self, msg_name, oid, buf_size, max_records)
+        self.message_rings.append(ring)
+        return ring
     def get_serialqueue(self):
         return self.serialqueue
     def get_default_command_queue(self):
@@ -252,6 +375,22 @@ class SerialReader:
         if params is None:
             self._error("Serial connection closed")
         return params
+    def send_format(self, mf, params, minclock, reqclock, cmd_queue):
+        # Encode and queue the message with a single call to the C code
+        c_format = mf.get_c_format()
+        if c_format is not None:
+            cparams = c_format.get_params(params)
+            if cparams is not None:
+                try:
+                    ret = self.ffi_lib.msgparse_send(
+                        self.serialqueue, cmd_queue, c_format.c_format,
+                        mf.msgid, cparams[0], cparams[1], minclock, reqclock,
+                        0)
+                except (TypeError, OverflowError):
+                    ret = -1
+                if not ret:
+                    return
+        self.raw_send(mf.encode(params), minclock, reqclock, cmd_queue)
     def send(self, msg, minclock=0, reqclock=0):
         cmd = self.msgparser.create_command(msg)
         self.raw_send(cmd, minclock, reqclock, self.default_cmd_queue)
@@ -259,9 +398,12 @@ class SerialReader:
         cmd = self.msgparser.create_command(msg)
         src = SerialRetryCommand(self, response)
         return src.get_response([cmd], self.default_cmd_queue)
-    def alloc_command_queue(self):
-        return self.ffi_main.gc(self.ffi_lib.serialqueue_alloc_commandqueue(),
-                                self.ffi_lib.serialqueue_free_commandqueue)
+    def alloc_command_queue(self, priority='normal'):
+        cq = self.ffi_main.gc(self.ffi_lib.serialqueue_alloc_commandqueue(),
+                              self.ffi_lib.serialqueue_free_commandqueue)
+        self.ffi_lib.serialqueue_set_commandqueue_priority(
+            cq, CQ_PRIORITIES[priority])
+        return cq
     # Dumping debug lists
     def dump_debug(self):
         out = []
@@ -211,7 +211,7 @@ class MCU_stepper:
         return old_tq
     def add_active_callback(self, cb):
         self._active_callbacks.append(cb)
-    def generate_steps(self, flush_time):
+    def prepare_generate_steps(self, flush_time):
         # Check for activity if necessary
         if self._active_callbacks:
             sk = self._stepper_kinematics
@@ -221,8 +221,10 @@ class MCU_stepper:
                 self._active_callbacks = []
                 for cb in cbs:
                     cb(ret)
+        return self._stepper_kinematics
+    def generate_steps(self, flush_time):
+        sk = self.prepare_generate_steps(flush_time)
         # Generate steps
-        sk = self._stepper_kinematics
         ret = self._itersolve_generate_steps(sk, flush_time)
         if ret:
             raise error("Internal error in stepcompress")
@@ -231,6 +233,51 @@ class MCU_stepper:
         a = axis.encode()
         return ffi_lib.itersolve_is_active_axis(self._stepper_kinematics, a)
 
+# Generate steps for several steppers at once using a pool of threads
+class ParallelStepGenerator:
+    def __init__(self, config, num_threads):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        # The calling thread also generates steps
+        pool = ffi_lib.stepgen_pool_alloc(num_threads - 1)
+        if pool == ffi_main.NULL:
+            raise config.error("Unable to start %d step generation threads"
+                               % (num_threads - 1,))
+        self._pool = ffi_main.gc(pool, ffi_lib.stepgen_pool_free)
+        self._stepgen_pool_generate = ffi_lib.stepgen_pool_generate
+        self._steppers = []
+        self._sks = ffi_main.NULL
+        self._other_generators = []
+    def set_step_generators(self, handlers):
+        # Steps for MCU_stepper and PrinterRail objects are generated
+        # in parallel - any other handlers are called sequentially
+        steppers = []
+        others = []
+        for handler in handlers:
+            obj = getattr(handler, '__self__', None)
+            if handler != getattr(obj, 'generate_steps', None):
+                others.append(handler)
+            elif isinstance(obj, MCU_stepper):
+                steppers.append(obj)
+            elif isinstance(obj, PrinterRail):
+                steppers.extend(obj.get_steppers())
+            else:
+                others.append(handler)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self._steppers = steppers
+        self._sks = ffi_main.new("struct stepper_kinematics *[]",
+                                 len(steppers))
+        self._other_generators = others
+    def generate_steps(self, flush_time):
+        sks = self._sks
+        for i, stepper in enumerate(self._steppers):
+            sks[i] = stepper.prepare_generate_steps(flush_time)
+        ret = self._stepgen_pool_generate(self._pool, sks, len(self._steppers),
+                                          flush_time)
+        if ret:
+            raise error("Internal error in stepcompress")
+        for handler in self._other_generators:
+            handler(flush_time)
+
 # Helper code to build a stepper object from a config section
 def PrinterStepper(config, units_in_radians=False):
     printer = config.get_printer()
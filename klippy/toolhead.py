@@ -3,32 +3,43 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, importlib
-import mcu, chelper, kinematics.extruder
+import math, logging, importlib, array
+import mcu, chelper, stepper, kinematics.extruder
 
 # Common suffixes: _d is distance (in mm), _v is velocity (in
 #   mm/second), _v2 is velocity squared (mm^2/s^2), _t is time (in
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
+# Moves share an empty timing callback list until one is registered
+NO_CALLBACKS = ()
+
 # Class to track each move request
 class Move:
+    __slots__ = ('toolhead', 'start_pos', 'end_pos', 'accel',
+                 'junction_deviation', 'timing_callbacks', 'is_kinematic_move',
+                 'axes_d', 'move_d', 'axes_r', 'min_move_t', 'max_start_v2',
+                 'max_cruise_v2', 'delta_v2', 'max_smoothed_v2',
+                 'smooth_delta_v2', 'start_v', 'cruise_v', 'end_v',
+                 'accel_t', 'cruise_t', 'decel_t')
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
-        self.start_pos = tuple(start_pos)
-        self.end_pos = tuple(end_pos)
+        self.start_pos = start_pos = tuple(start_pos)
+        self.end_pos = end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
         self.junction_deviation = toolhead.junction_deviation
-        self.timing_callbacks = []
+        self.timing_callbacks = NO_CALLBACKS
         velocity = min(speed, toolhead.max_velocity)
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        axes_d = (end_pos[0] - start_pos[0], end_pos[1] - start_pos[1],
+                  end_pos[2] - start_pos[2], end_pos[3] - start_pos[3])
+        move_d = math.sqrt(axes_d[0]*axes_d[0] + axes_d[1]*axes_d[1]
+                           + axes_d[2]*axes_d[2])
         if move_d < .000000001:
             # Extrude only move
             self.end_pos = (start_pos[0], start_pos[1], start_pos[2],
                             end_pos[3])
-            axes_d[0] = axes_d[1] = axes_d[2] = 0.
-            self.move_d = move_d = abs(axes_d[3])
+            axes_d = (0., 0., 0., axes_d[3])
+            move_d = abs(axes_d[3])
             inv_move_d = 0.
             if move_d:
                 inv_move_d = 1. / move_d
@@ -37,7 +48,10 @@ class Move:
             self.is_kinematic_move = False
         else:
             inv_move_d = 1. / move_d
-        self.axes_r = [d * inv_move_d for d in axes_d]
+        self.axes_d = axes_d
+        self.move_d = move_d
+        self.axes_r = (axes_d[0] * inv_move_d, axes_d[1] * inv_move_d,
+                       axes_d[2] * inv_move_d, axes_d[3] * inv_move_d)
         self.min_move_t = move_d / velocity
         # Junction speeds are tracked in velocity squared.  The
         # delta_v2 is the maximum amount of this squared-velocity that
@@ -114,10 +128,11 @@ class MoveQueue:
     def __init__(self, toolhead):
         self.toolhead = toolhead
         self.queue = []
+        self.lookahead_flush_time = LOOKAHEAD_FLUSH_TIME
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
     def reset(self):
         del self.queue[:]
-        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        self.junction_flush = self.lookahead_flush_time
     def set_flush_time(self, flush_time):
         self.junction_flush = flush_time
     def get_last(self):
@@ -125,7 +140,7 @@ class MoveQueue:
             return self.queue[-1]
         return None
     def flush(self, lazy=False):
-        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        self.junction_flush = self.lookahead_flush_time
         update_flush_count = lazy
         queue = self.queue
         flush_count = len(queue)
@@ -186,6 +201,69 @@ class MoveQueue:
             # Enough moves have been queued to reach the target flush time.
             self.flush(lazy=True)
 
+# Alternative MoveQueue that stores the look-ahead parameters of each
+# queued move in contiguous C arrays and runs the backward pass in C.
+# The results are bit-for-bit identical to MoveQueue.flush().
+class CMoveQueue(MoveQueue):
+    def __init__(self, toolhead):
+        MoveQueue.__init__(self, toolhead)
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.alloc_count = 0
+        self.la_moves = self.la_junctions = self.la_delayed = None
+        self._alloc_arrays(1024)
+    def _alloc_arrays(self, count):
+        ffi_main = self.ffi_main
+        la_moves = ffi_main.new("struct lookahead_move[]", count)
+        if self.la_moves is not None:
+            ffi_main.memmove(la_moves, self.la_moves,
+                             ffi_main.sizeof("struct lookahead_move")
+                             * len(self.queue))
+        self.la_moves = la_moves
+        self.la_junctions = ffi_main.new("struct lookahead_junction[]", count)
+        self.la_delayed = ffi_main.new("struct lookahead_delayed[]", count)
+        self.alloc_count = count
+    def flush(self, lazy=False):
+        self.junction_flush = self.lookahead_flush_time
+        queue = self.queue
+        flush_count = self.ffi_lib.lookahead_flush(
+            self.la_moves, len(queue), lazy, self.la_junctions,
+            self.la_delayed)
+        if not flush_count:
+            return
+        junctions = self.la_junctions
+        for i in range(flush_count):
+            j = junctions[i]
+            queue[i].set_junction(j.start_v2, j.cruise_v2, j.end_v2)
+        # Generate step times for all moves ready to be flushed
+        self.toolhead._process_moves(queue[:flush_count])
+        # Remove processed moves from the queue
+        del queue[:flush_count]
+        if queue:
+            self.ffi_main.memmove(self.la_moves, self.la_moves + flush_count,
+                                  self.ffi_main.sizeof("struct lookahead_move")
+                                  * len(queue))
+    def add_move(self, move):
+        queue = self.queue
+        if len(queue) >= self.alloc_count:
+            self._alloc_arrays(self.alloc_count * 2)
+        if queue:
+            move.calc_junction(queue[-1])
+        m = self.la_moves[len(queue)]
+        m.max_start_v2 = move.max_start_v2
+        m.delta_v2 = move.delta_v2
+        m.max_smoothed_v2 = move.max_smoothed_v2
+        m.smooth_delta_v2 = move.smooth_delta_v2
+        m.max_cruise_v2 = move.max_cruise_v2
+        queue.append(move)
+        if len(queue) == 1:
+            return
+        self.junction_flush -= move.min_move_t
+        if self.junction_flush <= 0.:
+            # Enough moves have been queued to reach the target flush time.
+            self.flush(lazy=True)
+
+LOOKAHEAD_BACKENDS = {'python': MoveQueue, 'c': CMoveQueue}
+
 BUFFER_TIME_LOW = 1.0
 BUFFER_TIME_HIGH = 2.0
 BUFFER_TIME_START = 0.250
@@ -197,6 +275,95 @@ STEPCOMPRESS_FLUSH_TIME = 0.050
 SDS_CHECK_TIME = 0.001 # step+dir+step filter in stepcompress.c
 MOVE_HISTORY_EXPIRE = 30.
 
+# Number of doubles in each chelper "struct trapq_append_move"
+TRAPQ_MOVE_FIELDS = 13
+
+# Adaptive flush tuning
+TUNING_INTERVAL = 1.000
+TUNING_HIGH_LOAD = 0.250
+TUNING_LOW_LOAD = 0.050
+MIN_MOVE_BATCH_TIME = 0.100
+MAX_MOVE_BATCH_TIME = 2.000
+MAX_BGFLUSH_BATCH_TIME = 1.000
+MAX_LOOKAHEAD_FLUSH_TIME = 1.000
+
+# Adjust the toolhead flush batch sizes from the measured step
+# generation cost and the amount of step data buffered ahead of the mcu
+class FlushTuning:
+    def __init__(self, toolhead, enabled):
+        self.toolhead = toolhead
+        self.enabled = enabled
+        self.move_batch_time = MOVE_BATCH_TIME
+        self.bgflush_batch_time = BGFLUSH_BATCH_TIME
+        self.lookahead_flush_time = LOOKAHEAD_FLUSH_TIME
+        self.stepgen_load = self.headroom = 0.
+        self.stepgen_cost = self.stepgen_span = 0.
+        self.late_flushes = self.total_late_flushes = self.adjustments = 0
+        self.next_update = 0.
+    def note_step_generation(self, start_time, end_time, flush_span):
+        self.stepgen_cost += end_time - start_time
+        self.stepgen_span += flush_span
+        if end_time >= self.next_update:
+            self._update(end_time)
+    def note_late_flush(self):
+        self.late_flushes += 1
+        self.total_late_flushes += 1
+    def _relax(self, value, default):
+        value = default + (value - default) * .75
+        if abs(value - default) < .001:
+            return default
+        return value
+    def _update(self, eventtime):
+        self.next_update = eventtime + TUNING_INTERVAL
+        # Fraction of real time spent generating steps
+        if self.stepgen_span > 0.:
+            load = self.stepgen_cost / self.stepgen_span
+            self.stepgen_load = .7 * self.stepgen_load + .3 * load
+        self.stepgen_cost = self.stepgen_span = 0.
+        # Step data committed ahead of the mcu
+        toolhead = self.toolhead
+        est_print_time = toolhead.mcu.estimated_print_time(eventtime)
+        self.headroom = toolhead.last_flush_time - est_print_time
+        mbt = self.move_batch_time
+        bgt = self.bgflush_batch_time
+        lft = self.lookahead_flush_time
+        if self.late_flushes or 0. < self.headroom < BGFLUSH_LOW_TIME:
+            # Host is falling behind - queue more data in smaller batches
+            mbt = max(mbt * .8, MIN_MOVE_BATCH_TIME)
+            bgt = min(bgt * 1.5, MAX_BGFLUSH_BATCH_TIME)
+        elif self.stepgen_load > TUNING_HIGH_LOAD:
+            # Step generation is expensive - use larger batches
+            mbt = min(mbt * 1.25, MAX_MOVE_BATCH_TIME)
+            lft = min(lft * 1.25, MAX_LOOKAHEAD_FLUSH_TIME)
+        elif self.stepgen_load < TUNING_LOW_LOAD:
+            mbt = self._relax(mbt, MOVE_BATCH_TIME)
+            bgt = self._relax(bgt, BGFLUSH_BATCH_TIME)
+            lft = self._relax(lft, LOOKAHEAD_FLUSH_TIME)
+        self.late_flushes = 0
+        if (mbt, bgt, lft) != (self.move_batch_time, self.bgflush_batch_time,
+                               self.lookahead_flush_time):
+            self.adjustments += 1
+            self.move_batch_time = mbt
+            self.bgflush_batch_time = bgt
+            self.lookahead_flush_time = lft
+            toolhead.move_queue.lookahead_flush_time = lft
+    def get_status(self):
+        return {'enabled': self.enabled,
+                'move_batch_time': self.move_batch_time,
+                'bgflush_batch_time': self.bgflush_batch_time,
+                'lookahead_flush_time': self.lookahead_flush_time,
+                'stepgen_load': self.stepgen_load,
+                'headroom': self.headroom,
+                'late_flushes': self.total_late_flushes,
+                'adjustments': self.adjustments}
+    def stats(self):
+        if not self.enabled:
+            return ""
+        return (" move_batch_time=%.3f bgflush_batch_time=%.3f"
+                " lookahead_flush_time=%.3f stepgen_load=%.3f" % (
+                    self.move_batch_time, self.bgflush_batch_time,
+                    self.lookahead_flush_time, self.stepgen_load))
+
 DRIP_SEGMENT_TIME = 0.050
 DRIP_TIME = 0.100
 class DripModeEndSignal(Exception):
@@ -210,7 +377,9 @@ class ToolHead:
         self.all_mcus = [
             m for n, m in self.printer.lookup_objects(module='mcu')]
         self.mcu = self.all_mcus[0]
-        self.move_queue = MoveQueue(self)
+        lookahead_class = config.getchoice('lookahead_backend',
+                                           LOOKAHEAD_BACKENDS, 'c')
+        self.move_queue = lookahead_class(self)
         self.move_queue.set_flush_time(BUFFER_TIME_HIGH)
         self.commanded_pos = [0., 0., 0., 0.]
         # Velocity and acceleration control
@@ -244,12 +413,23 @@ class ToolHead:
         # Kinematic step generation scan window time tracking
         self.kin_flush_delay = SDS_CHECK_TIME
         self.kin_flush_times = []
+        # Flush batch size tuning
+        self.flush_tuning = FlushTuning(
+            self, config.getboolean('adaptive_flush', False))
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
         self.trapq_append = ffi_lib.trapq_append
+        self.trapq_append_batch = ffi_lib.trapq_append_batch
+        self.ffi_main = ffi_main
         self.trapq_finalize_moves = ffi_lib.trapq_finalize_moves
         self.step_generators = []
+        self.parallel_stepgen = None
+        stepgen_threads = config.getint('step_generation_threads', 1,
+                                        minval=1)
+        if stepgen_threads > 1:
+            self.parallel_stepgen = stepper.ParallelStepGenerator(
+                config, stepgen_threads)
         # Create kinematics class
         gcode = self.printer.lookup_object('gcode')
         self.Coord = gcode.Coord
@@ -280,6 +460,9 @@ class ToolHead:
                    "manual_probe", "tuning_tower"]
         for module_name in modules:
             self.printer.load_object(config, module_name)
+        printer_stats = self.printer.load_object(config, 'statistics')
+        printer_stats.register_metrics('toolhead', self._get_metrics,
+                                       counters=['print_stall'])
     # Print time and flush tracking
     def _advance_flush_time(self, flush_time):
         flush_time = max(flush_time, self.last_flush_time)
@@ -287,8 +470,17 @@ class ToolHead:
         sg_flush_want = min(flush_time + STEPCOMPRESS_FLUSH_TIME,
                             self.print_time - self.kin_flush_delay)
         sg_flush_time = max(sg_flush_want, flush_time)
-        for sg in self.step_generators:
-            sg(sg_flush_time)
+        if self.flush_tuning.enabled:
+            start_time = self.reactor.monotonic()
+        if self.parallel_stepgen is not None:
+            self.parallel_stepgen.generate_steps(sg_flush_time)
+        else:
+            for sg in self.step_generators:
+                sg(sg_flush_time)
+        if self.flush_tuning.enabled:
+            self.flush_tuning.note_step_generation(
+                start_time, self.reactor.monotonic(),
+                sg_flush_time - self.last_sg_flush_time)
         self.last_sg_flush_time = sg_flush_time
         # Free trapq entries that are no longer needed
         clear_history_time = self.clear_history_time
@@ -306,8 +498,9 @@ class ToolHead:
         flush_time = max(self.last_flush_time, self.print_time - pt_delay)
         self.print_time = max(self.print_time, next_print_time)
         want_flush_time = max(flush_time, self.print_time - pt_delay)
+        move_batch_time = self.flush_tuning.move_batch_time
         while 1:
-            flush_time = min(flush_time + MOVE_BATCH_TIME, want_flush_time)
+            flush_time = min(flush_time + move_batch_time, want_flush_time)
             self._advance_flush_time(flush_time)
             if flush_time >= want_flush_time:
                 break
@@ -331,26 +524,48 @@ class ToolHead:
             self._calc_print_time()
         # Queue moves into trapezoid motion queue (trapq)
         next_move_time = self.print_time
+        tq_moves = []
+        extruder_moves = []
         for move in moves:
             if move.is_kinematic_move:
-                self.trapq_append(
-                    self.trapq, next_move_time,
+                start_pos = move.start_pos
+                axes_r = move.axes_r
+                tq_moves.extend((
+                    next_move_time,
                     move.accel_t, move.cruise_t, move.decel_t,
-                    move.start_pos[0], move.start_pos[1], move.start_pos[2],
-                    move.axes_r[0], move.axes_r[1], move.axes_r[2],
-                    move.start_v, move.cruise_v, move.accel)
+                    start_pos[0], start_pos[1], start_pos[2],
+                    axes_r[0], axes_r[1], axes_r[2],
+                    move.start_v, move.cruise_v, move.accel))
             if move.axes_d[3]:
-                self.extruder.move(next_move_time, move)
+                extruder_moves.extend(
+                    self.extruder.prepare_move(next_move_time, move))
             next_move_time = (next_move_time + move.accel_t
                               + move.cruise_t + move.decel_t)
             for cb in move.timing_callbacks:
                 cb(next_move_time)
+        self._append_trapq_moves(tq_moves, extruder_moves)
         # Generate steps for moves
         if self.special_queuing_state:
             self._update_drip_move_time(next_move_time)
         self.note_kinematic_activity(next_move_time + self.kin_flush_delay,
                                      set_step_gen_time=True)
         self._advance_move_time(next_move_time)
+    def _append_trapq_moves(self, tq_moves, extruder_moves):
+        # Add all toolhead and extruder moves to their trapq in one C call
+        ffi_main = self.ffi_main
+        tq_data = array.array('d', tq_moves)
+        tq_count = len(tq_moves) // TRAPQ_MOVE_FIELDS
+        etrapq = ffi_main.NULL
+        e_data = array.array('d', extruder_moves)
+        e_count = len(extruder_moves) // TRAPQ_MOVE_FIELDS
+        if e_count:
+            etrapq = self.extruder.get_trapq()
+        self.trapq_append_batch(
+            self.trapq,
+            ffi_main.from_buffer("struct trapq_append_move[]", tq_data),
+            tq_count, etrapq,
+            ffi_main.from_buffer("struct trapq_append_move[]", e_data),
+            e_count)
     def _flush_lookahead(self):
         # Transit from "NeedPrime"/"Priming"/"Drip"/main state to "NeedPrime"
         self.move_queue.flush()
@@ -433,7 +648,11 @@ class ToolHead:
                 buffer_time = self.last_flush_time - est_print_time
                 if buffer_time > BGFLUSH_LOW_TIME:
                     return eventtime + buffer_time - BGFLUSH_LOW_TIME
-                ftime = est_print_time + BGFLUSH_LOW_TIME + BGFLUSH_BATCH_TIME
+                if 0. < buffer_time < BGFLUSH_LOW_TIME * .5:
+                    # Timer ran late - buffered step data is running low
+                    self.flush_tuning.note_late_flush()
+                ftime = (est_print_time + BGFLUSH_LOW_TIME
+                         + self.flush_tuning.bgflush_batch_time)
                 self._advance_flush_time(min(self.need_flush_time, ftime))
         except:
             logging.exception("Exception in flush_handler")
@@ -541,8 +760,17 @@ class ToolHead:
         is_active = buffer_time > -60. or not self.special_queuing_state
         if self.special_queuing_state == "Drip":
             buffer_time = 0.
-        return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
-            self.print_time, max(buffer_time, 0.), self.print_stall)
+        return is_active, (
+            "print_time=%.3f buffer_time=%.3f print_stall=%d%s" % (
+                self.print_time, max(buffer_time, 0.), self.print_stall,
+                self.flush_tuning.stats()))
+    def _get_metrics(self, eventtime):
+        buffer_time = 0.
+        if self.special_queuing_state != "Drip":
+            est_print_time = self.mcu.estimated_print_time(eventtime)
+            buffer_time = max(self.print_time - est_print_time, 0.)
+        return {'print_time': self.print_time, 'buffer_time': buffer_time,
+                'print_stall': self.print_stall}
     def check_busy(self, eventtime):
         est_print_time = self.mcu.estimated_print_time(eventtime)
         lookahead_empty = not self.move_queue.queue
@@ -559,7 +787,8 @@ class ToolHead:
                      'max_velocity': self.max_velocity,
                      'max_accel': self.max_accel,
                      'max_accel_to_decel': self.requested_accel_to_decel,
-                     'square_corner_velocity': self.square_corner_velocity})
+                     'square_corner_velocity': self.square_corner_velocity,
+                     'flush_tuning': self.flush_tuning.get_status()})
         return res
     def _handle_shutdown(self):
         self.can_pause = False
@@ -570,6 +799,8 @@ class ToolHead:
         return self.trapq
     def register_step_generator(self, handler):
         self.step_generators.append(handler)
+        if self.parallel_stepgen is not None:
+            self.parallel_stepgen.set_step_generators(self.step_generators)
     def note_step_generation_scan_time(self, delay, old_delay=0.):
         self.flush_step_generation()
         cur_delay = self.kin_flush_delay
@@ -584,7 +815,7 @@ class ToolHead:
         if last_move is None:
             callback(self.get_last_move_time())
             return
-        last_move.timing_callbacks.append(callback)
+        last_move.timing_callbacks = last_move.timing_callbacks + (callback,)
     def note_kinematic_activity(self, kin_time, set_step_gen_time=False):
         self.need_flush_time = max(self.need_flush_time, kin_time)
         if set_step_gen_time:
@@ -103,6 +103,7 @@ def setup_python2_wrappers():
     sys.modules["queue"] = Queue
     io.StringIO = StringIO.StringIO
     time.process_time = time.clock
+    time.perf_counter = time.time
 setup_python2_wrappers()
 
 
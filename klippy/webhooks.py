@@ -3,10 +3,16 @@
 # Copyright (C) 2020 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license
-import logging, socket, os, sys, errno, json, collections
+import logging, socket, os, sys, errno, json, collections, threading, queue
+import time, struct, array
 import gcode
 
 REQUEST_LOG_SIZE = 20
+SEND_BUFFER_DROP_SIZE = 1024 * 1024
+SEND_BUFFER_MAX_SIZE = 8 * 1024 * 1024
+SEND_MAX_CHUNKS = 64
+JSON_CHUNK_ITEMS = 64
+PACK_MIN_ROWS = 16
 
 # Json decodes strings as unicode types in Python 2.x.  This doesn't
 # play well with some parts of Klipper (particuarly displays), so we
@@ -26,6 +32,159 @@ if sys.version_info.major < 3:
                     for k, v in data.items()}
         return data
 
+def decode_requests(requests):
+    res = []
+    for req in requests:
+        try:
+            res.append(json.loads(req, object_hook=json_loads_byteify))
+        except Exception as e:
+            res.append(e)
+    return res
+
+def encode_message(data):
+    return json.dumps(data, separators=(',', ':')).encode() + b"\x03"
+
+# Encode large lists a piece at a time so that a background thread
+# does not hold the GIL for the entire encoding of a large message
+def json_dumps_chunked(data):
+    if type(data) == dict and all([type(k) == str for k in data]):
+        return '{' + ','.join([json.dumps(k) + ':' + json_dumps_chunked(v)
+                               for k, v in data.items()]) + '}'
+    if type(data) in (list, tuple) and len(data) > JSON_CHUNK_ITEMS:
+        parts = []
+        for i in range(0, len(data), JSON_CHUNK_ITEMS):
+            part = json.dumps(data[i:i+JSON_CHUNK_ITEMS],
+                              separators=(',', ':'))
+            parts.append(part[1:-1])
+            # Let the main thread run if it is waiting on the GIL
+            time.sleep(0.)
+        return '[' + ','.join(parts) + ']'
+    return json.dumps(data, separators=(',', ':'))
+
+# Copy the containers of a message so that it can be encoded in a
+# background thread while the reactor continues to update status
+def snapshot_data(data):
+    if isinstance(data, dict):
+        res = dict(data)
+        for k, v in res.items():
+            if isinstance(v, (dict, list, tuple)):
+                res[k] = snapshot_data(v)
+        return res
+    if not isinstance(data, (list, tuple)):
+        return data
+    res = list(data)
+    for i, v in enumerate(res):
+        if isinstance(v, (dict, list, tuple)):
+            res[i] = snapshot_data(v)
+    return res
+
+def encode_message_chunked(data):
+    return json_dumps_chunked(data).encode() + b"\x03"
+
+# Pack a list of rows of numbers into little-endian binary data.
+# Returns None if the value is not a suitable table.
+def pack_table(rows):
+    if type(rows) not in (list, tuple) or len(rows) < PACK_MIN_ROWS:
+        return None
+    first = rows[0]
+    if type(first) not in (list, tuple):
+        return None
+    shape = [len(v) if type(v) in (list, tuple) else 0 for v in first]
+    width = sum([s or 1 for s in shape])
+    if max(shape):
+        flat = []
+        for row in rows:
+            for v in row:
+                if type(v) in (list, tuple):
+                    flat.extend(v)
+                else:
+                    flat.append(v)
+    else:
+        flat = [v for row in rows for v in row]
+    if len(flat) != width * len(rows):
+        return None
+    types = set([type(v) for v in flat])
+    meta = {'rows': len(rows), 'shape': shape}
+    if types == set([int]):
+        meta['type'] = 'q'
+    elif types <= set([int, float]):
+        # Note integer columns so they can be restored as integers
+        meta['type'] = 'd'
+        int_columns = []
+        for i in range(width):
+            column = flat[i::width]
+            if set([type(v) for v in column]) == set([int]):
+                if max(column) > 1<<53 or min(column) < -(1<<53):
+                    return None
+                int_columns.append(i)
+        if int_columns:
+            meta['int_columns'] = int_columns
+    else:
+        return None
+    try:
+        data = array.array(meta['type'], flat)
+    except (OverflowError, ValueError):
+        # Value out of range (or 'q' arrays not supported on Python 2)
+        return None
+    if sys.byteorder != 'little':
+        data.byteswap()
+    if sys.version_info.major < 3:
+        return meta, data.tostring()
+    return meta, data.tobytes()
+
+# Encode a message using binary framing.  Tables of numbers in the
+# message "params" are sent as packed binary data after the json.
+def encode_packed_message(data):
+    params = data.get('params')
+    if type(params) != dict:
+        return encode_message(data)
+    params = dict(params)
+    blobs = []
+    offset = 0
+    for key, value in params.items():
+        res = pack_table(value)
+        if res is None:
+            continue
+        meta, blob = res
+        meta['offset'] = offset
+        offset += len(blob)
+        params[key] = {'__packed__': meta}
+        blobs.append(blob)
+    if not blobs:
+        return encode_message(data)
+    data = dict(data)
+    data['params'] = params
+    jmsg = json.dumps(data, separators=(',', ':')).encode()
+    return b''.join([b"\x02", struct.pack('<II', len(jmsg), offset),
+                     jmsg] + blobs)
+
+# Perform json encoding and decoding in a background thread.  Results
+# are returned to the reactor thread in the order they were queued.
+class JsonWorker:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.bg_queue = queue.Queue()
+        self.bg_thread = threading.Thread(target=self._bg_thread)
+        self.bg_thread.daemon = True
+        self.bg_thread.start()
+    def _bg_thread(self):
+        while 1:
+            job = self.bg_queue.get(True)
+            if job is None:
+                break
+            func, data, callback = job
+            try:
+                res = func(data)
+            except Exception as e:
+                res = e
+            self.reactor.register_async_callback(
+                (lambda e, cb=callback, d=data, r=res: cb(d, r)))
+    def queue_job(self, func, data, callback):
+        self.bg_queue.put_nowait((func, data, callback))
+    def stop(self):
+        self.bg_queue.put_nowait(None)
+        self.bg_thread.join()
+
 class WebRequestError(gcode.CommandError):
     def __init__(self, message,):
         Exception.__init__(self, message)
@@ -40,9 +199,8 @@ class Sentinel:
 
 class WebRequest:
     error = WebRequestError
-    def __init__(self, client_conn, request):
+    def __init__(self, client_conn, base_request):
         self.client_conn = client_conn
-        base_request = json.loads(request, object_hook=json_loads_byteify)
         if type(base_request) != dict:
             raise ValueError("Not a top-level dictionary")
         self.id = base_request.get('id', None)
@@ -52,6 +210,7 @@ class WebRequest:
             raise ValueError("Invalid request type")
         self.response = None
         self.is_error = False
+        self.is_deferred = False
 
     def get_client_connection(self):
         return self.client_conn
@@ -89,6 +248,17 @@ class WebRequest:
             raise WebRequestError("Multiple calls to send not allowed")
         self.response = data
 
+    def defer(self):
+        # The endpoint will call complete() at a later time
+        self.is_deferred = True
+
+    def complete(self, data):
+        self.is_deferred = False
+        self.send(data)
+        result = self.finish()
+        if result is not None:
+            self.client_conn.send(result)
+
     def finish(self):
         if self.id is None:
             return None
@@ -108,12 +278,15 @@ class ServerSocket:
         self.reactor = printer.get_reactor()
         self.sock = self.fd_handle = None
         self.clients = {}
+        self.json_worker = None
         start_args = printer.get_start_args()
         server_address = start_args.get('apiserver')
         is_fileinput = (start_args.get('debuginput') is not None)
         if not server_address or is_fileinput:
             # Do not enable server
             return
+        if start_args.get('api_json_thread'):
+            self.json_worker = JsonWorker(self.reactor)
         self._remove_socket_file(server_address)
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.sock.setblocking(0)
@@ -144,6 +317,9 @@ class ServerSocket:
                 self.sock.close()
             except socket.error:
                 pass
+        if self.json_worker is not None:
+            self.json_worker.stop()
+            self.json_worker = None
 
     def _handle_shutdown(self):
         for client in self.clients.values():
@@ -170,7 +346,18 @@ class ServerSocket:
                 if client.blocking_count < 0:
                     logging.info("Closing unresponsive client %s", client.uid)
                     client.close()
-        return False, ""
+        if not self.clients:
+            return False, ""
+        clients = list(self.clients.values())
+        buffered = [c.send_buffered for c in clients]
+        dropped = sum([c.dropped_count for c in clients])
+        msg = "webhooks: clients=%d buffered=%d max_buffered=%d dropped=%d" % (
+            len(buffered), sum(buffered), max(buffered), dropped)
+        # Report each client so that a slow client can be identified
+        for c in clients:
+            msg += " buffered_%d=%d dropped_%d=%d" % (
+                c.uid, c.send_buffered, c.uid, c.dropped_count)
+        return False, msg
 
 class ClientConnection:
     def __init__(self, server, sock):
@@ -180,13 +367,20 @@ class ClientConnection:
         self.server = server
         self.uid = id(self)
         self.sock = sock
+        self.json_worker = server.json_worker
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self.process_received, self._do_send)
-        self.partial_data = self.send_buffer = b""
+        self.partial_data = b""
+        self.send_queue = collections.deque()
+        self.send_buffered = self.dropped_count = 0
+        self.binary_framing = False
         self.is_blocking = False
         self.blocking_count = 0
         self.set_client_info("?", "New connection")
         self.request_log = collections.deque([], REQUEST_LOG_SIZE)
+        self.pending_requests = collections.deque()
+        self.process_timer = self.reactor.register_timer(
+            self._process_pending)
 
     def dump_request_log(self):
         out = []
@@ -213,6 +407,9 @@ class ClientConnection:
         self.set_client_info(None, "Disconnected")
         self.reactor.unregister_fd(self.fd_handle)
         self.fd_handle = None
+        if not self.pending_requests:
+            self.reactor.unregister_timer(self.process_timer)
+            self.process_timer = None
         try:
             self.sock.close()
         except socket.error:
@@ -222,6 +419,15 @@ class ClientConnection:
     def is_closed(self):
         return self.fd_handle is None
 
+    def is_send_blocked(self):
+        return self.is_blocking
+
+    def set_binary_framing(self, binary_framing):
+        self.binary_framing = binary_framing
+
+    def is_binary_framing(self):
+        return self.binary_framing
+
     def process_received(self, eventtime):
         try:
             data = self.sock.recv(4096)
@@ -239,16 +445,46 @@ class ClientConnection:
         requests = data.split(b'\x03')
         requests[0] = self.partial_data + requests[0]
         self.partial_data = requests.pop()
+        if not requests:
+            return
         for req in requests:
             self.request_log.append((eventtime, req))
+        if self.json_worker is not None:
+            self.json_worker.queue_job(decode_requests, requests,
+                                       self._process_decoded)
+            return
+        self._process_decoded(requests, decode_requests(requests))
+
+    def _process_decoded(self, requests, decoded):
+        for req, base_request in zip(requests, decoded):
             try:
-                web_request = WebRequest(self, req)
+                if isinstance(base_request, Exception):
+                    raise base_request
+                web_request = WebRequest(self, base_request)
             except Exception:
                 logging.exception("webhooks: Error decoding Server Request %s"
                                   % (req))
                 continue
-            self.reactor.register_callback(
-                lambda e, s=self, wr=web_request: s._process_request(wr))
+            self.pending_requests.append(web_request)
+        if self.process_timer is None:
+            # Connection already closed
+            self.pending_requests.clear()
+        elif self.pending_requests:
+            self.reactor.update_timer(self.process_timer, self.reactor.NOW)
+
+    def _process_pending(self, eventtime):
+        # Process all received requests in order from a single timer
+        pending_requests = self.pending_requests
+        while pending_requests:
+            web_request = pending_requests.popleft()
+            # If this request pauses, then the timer will be invoked
+            # again (in another greenlet) to process later requests
+            self.reactor.update_timer(self.process_timer, self.reactor.NOW)
+            self._process_request(web_request)
+        if self.is_closed() and self.process_timer is not None:
+            self.reactor.unregister_timer(self.process_timer)
+            self.process_timer = None
+        return self.reactor.NEVER
 
     def _process_request(self, web_request):
         try:
@@ -262,19 +498,51 @@ class ClientConnection:
             logging.exception(msg)
             web_request.set_error(WebRequestError(str(e)))
             self.printer.invoke_shutdown(msg)
+        if web_request.is_deferred and not web_request.is_error:
+            return
         result = web_request.finish()
         if result is None:
             return
         self.send(result)
 
-    def send(self, data):
+    def send(self, data, droppable=False, packable=False):
+        if droppable and self.send_buffered >= SEND_BUFFER_DROP_SIZE:
+            # Client is not keeping up - discard optional messages
+            self.dropped_count += 1
+            return
+        if packable and self.binary_framing:
+            encode = encode_packed_message
+        elif self.json_worker is not None:
+            encode = encode_message_chunked
+        else:
+            self._send_encoded(data, None)
+            return
+        if self.json_worker is not None:
+            self.json_worker.queue_job(encode, snapshot_data(data),
+                                       self._send_encoded)
+            return
         try:
-            jmsg = json.dumps(data, separators=(',', ':'))
-            self.send_buffer += jmsg.encode() + b"\x03"
-        except (TypeError, ValueError) as e:
-            msg = ("json encoding error: %s" % (str(e),))
-            logging.exception(msg)
-            self.printer.invoke_shutdown(msg)
+            msg = encode(data)
+        except Exception:
+            msg = None
+        self._send_encoded(data, msg)
+
+    def _send_encoded(self, data, msg):
+        if msg is None or isinstance(msg, Exception):
+            # Encode (or report errors) from the main thread
+            try:
+                msg = encode_message(data)
+            except (TypeError, ValueError) as e:
+                msg = ("json encoding error: %s" % (str(e),))
+                logging.exception(msg)
+                self.printer.invoke_shutdown(msg)
+                return
+        self.send_queue.append(msg)
+        self.send_buffered += len(msg)
+        if self.send_buffered > SEND_BUFFER_MAX_SIZE:
+            logging.info("webhooks: Closing client %s with %d bytes unsent",
+                         self.uid, self.send_buffered)
+            self.close()
             return
         if not self.is_blocking:
             self._do_send()
@@ -282,15 +550,32 @@ class ClientConnection:
     def _do_send(self, eventtime=None):
         if self.fd_handle is None:
             return
+        send_queue = self.send_queue
         try:
-            sent = self.sock.send(self.send_buffer)
+            if len(send_queue) > 1 and hasattr(self.sock, 'sendmsg'):
+                chunks = [send_queue[i] for i in range(
+                    min(len(send_queue), SEND_MAX_CHUNKS))]
+                sent = self.sock.sendmsg(chunks)
+            elif send_queue:
+                sent = self.sock.send(send_queue[0])
+            else:
+                sent = 0
         except socket.error as e:
             if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
                 logging.info("webhooks: socket write error %d" % (self.uid,))
                 self.close()
                 return
             sent = 0
-        if sent < len(self.send_buffer):
+        # Release sent data without copying the remaining data
+        self.send_buffered -= sent
+        while sent:
+            chunk = send_queue[0]
+            if sent < len(chunk):
+                send_queue[0] = memoryview(chunk)[sent:]
+                break
+            sent -= len(chunk)
+            send_queue.popleft()
+        if send_queue:
             if not self.is_blocking:
                 self.reactor.set_fd_wake(self.fd_handle, False, True)
                 self.is_blocking = True
@@ -298,7 +583,6 @@ class ClientConnection:
         elif self.is_blocking:
             self.reactor.set_fd_wake(self.fd_handle, True, False)
             self.is_blocking = False
-        self.send_buffer = self.send_buffer[sent:]
 
 class WebHooks:
     def __init__(self, printer):
@@ -348,9 +632,14 @@ class WebHooks:
         web_request.send({'endpoints': list(self._endpoints.keys())})
 
     def _handle_info_request(self, web_request):
+        cconn = web_request.get_client_connection()
         client_info = web_request.get_dict('client_info', None)
         if client_info is not None:
-            web_request.get_client_connection().set_client_info(client_info)
+            cconn.set_client_info(client_info)
+        binary_framing = web_request.get('binary_framing', None,
+                                         types=(bool,))
+        if binary_framing is not None:
+            cconn.set_binary_framing(binary_framing)
         state_message, state = self.printer.get_state_message()
         src_path = os.path.dirname(__file__)
         klipper_path = os.path.normpath(os.path.join(src_path, ".."))
@@ -361,7 +650,8 @@ class WebHooks:
                     'python_path': sys.executable,
                     'process_id': os.getpid(),
                     'user_id': os.getuid(),
-                    'group_id': os.getgid()}
+                    'group_id': os.getgid(),
+                    'binary_framing': cconn.is_binary_framing()}
         start_args = self.printer.get_start_args()
         for sa in ['log_file', 'config_file', 'software_version', 'cpu_info']:
             response[sa] = start_args.get(sa)
@@ -455,6 +745,37 @@ class GCodeHelper:
             self.is_output_registered = True
 
 SUBSCRIPTION_REFRESH_TIME = .25
+MIN_SUBSCRIPTION_REFRESH_TIME = .050
+
+# Return a list of [index, value] changes if a numeric list value is
+# more compactly sent as a delta from the last reported value
+def encode_list_delta(value, last):
+    if (not isinstance(value, (list, tuple))
+        or not isinstance(last, (list, tuple)) or len(value) != len(last)):
+        return None
+    changes = []
+    for i, v in enumerate(value):
+        if v != last[i]:
+            if type(v) not in (int, float):
+                return None
+            changes.append([i, v])
+    if len(changes) * 2 >= len(value):
+        return None
+    return changes
+
+# Tracking of the status information already sent to a client
+class StatusSubscription:
+    def __init__(self, cconn, objects, send_func, template,
+                 refresh_time=SUBSCRIPTION_REFRESH_TIME, use_delta=False):
+        self.cconn = cconn
+        self.objects = objects
+        self.send_func = send_func
+        self.template = template
+        self.refresh_time = refresh_time
+        self.use_delta = use_delta
+        self.next_time = 0.
+        self.last_status = {}
+        self.last_versions = {}
 
 class QueryStatusHelper:
     def __init__(self, printer):
@@ -462,7 +783,7 @@ class QueryStatusHelper:
         self.clients = {}
         self.pending_queries = []
         self.query_timer = None
-        self.last_query = {}
+        self.status_cache = {}
         # Register webhooks
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("objects/list", self._handle_list)
@@ -472,52 +793,94 @@ class QueryStatusHelper:
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _query_object(self, obj_name, eventtime, query):
+        res = query.get(obj_name, None)
+        if res is not None:
+            return res
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            res = ({}, None)
+        elif hasattr(po, 'get_status_version'):
+            # Reuse last status if object reports no changes
+            version = po.get_status_version()
+            res = self.status_cache.get(obj_name, None)
+            if res is None or res[1] != version:
+                res = self.status_cache[obj_name] = (
+                    po.get_status(eventtime), version)
+        else:
+            res = (po.get_status(eventtime), None)
+        query[obj_name] = res
+        return res
+    def _update_subscription(self, sub, eventtime, query, is_query):
+        cquery = {}
+        cdelta = {}
+        for obj_name, req_items in sub.objects.items():
+            res, version = self._query_object(obj_name, eventtime, query)
+            if req_items is None:
+                req_items = list(res.keys())
+                if req_items:
+                    sub.objects[obj_name] = req_items
+            if (not is_query and version is not None
+                and sub.last_versions.get(obj_name) == version):
+                continue
+            lres = sub.last_status.get(obj_name, {})
+            sub.last_status[obj_name] = res
+            sub.last_versions[obj_name] = version
+            cres = {}
+            dres = {}
+            for ri in req_items:
+                rd = res.get(ri, None)
+                if is_query:
+                    cres[ri] = rd
+                    continue
+                lrd = lres.get(ri)
+                if rd != lrd:
+                    delta = None
+                    if sub.use_delta:
+                        delta = encode_list_delta(rd, lrd)
+                    if delta is not None:
+                        dres[ri] = delta
+                    else:
+                        cres[ri] = rd
+            if cres or is_query:
+                cquery[obj_name] = cres
+            if dres:
+                cdelta[obj_name] = dres
+        # Send data
+        if cquery or cdelta or is_query:
+            tmp = dict(sub.template)
+            tmp['params'] = {'eventtime': eventtime, 'status': cquery}
+            if cdelta:
+                tmp['params']['delta'] = cdelta
+            sub.send_func(tmp)
     def _do_query(self, eventtime):
-        last_query = self.last_query
-        query = self.last_query = {}
+        query = {}
         msglist = self.pending_queries
         self.pending_queries = []
-        msglist.extend(self.clients.values())
-        # Generate get_status() info for each client
-        for cconn, subscription, send_func, template in msglist:
-            is_query = cconn is None
-            if not is_query and cconn.is_closed():
+        # Respond to new queries
+        for sub in msglist:
+            sub.next_time = eventtime + sub.refresh_time
+            self._update_subscription(sub, eventtime, query, True)
+        # Generate get_status() info for each client that is due
+        reactor = self.printer.get_reactor()
+        next_time = reactor.NEVER
+        for cconn, sub in list(self.clients.items()):
+            if cconn.is_closed():
                 del self.clients[cconn]
                 continue
-            # Query each requested printer object
-            cquery = {}
-            for obj_name, req_items in subscription.items():
-                res = query.get(obj_name, None)
-                if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
-                if req_items is None:
-                    req_items = list(res.keys())
-                    if req_items:
-                        subscription[obj_name] = req_items
-                lres = last_query.get(obj_name, {})
-                cres = {}
-                for ri in req_items:
-                    rd = res.get(ri, None)
-                    if is_query or rd != lres.get(ri):
-                        cres[ri] = rd
-                if cres or is_query:
-                    cquery[obj_name] = cres
-            # Send data
-            if cquery or is_query:
-                tmp = dict(template)
-                tmp['params'] = {'eventtime': eventtime, 'status': cquery}
-                send_func(tmp)
-        if not query:
+            if eventtime >= sub.next_time:
+                # Coalesce updates while a slow client catches up
+                if not cconn.is_send_blocked():
+                    self._update_subscription(sub, eventtime, query, False)
+                sub.next_time = eventtime + sub.refresh_time
+            next_time = min(next_time, sub.next_time)
+        if not self.clients:
             # Unregister timer if there are no longer any subscriptions
-            reactor = self.printer.get_reactor()
             reactor.unregister_timer(self.query_timer)
             self.query_timer = None
+            self.status_cache.clear()
             return reactor.NEVER
-        return eventtime + SUBSCRIPTION_REFRESH_TIME
+        return next_time
     def _handle_query(self, web_request, is_subscribe=False):
         objects = web_request.get_dict('objects')
         # Validate subscription format
@@ -528,23 +891,36 @@ class QueryStatusHelper:
                 for ri in v:
                     if type(ri) != str:
                         raise web_request.error("Invalid argument")
+        refresh_time = web_request.get_float('refresh_time',
+                                             SUBSCRIPTION_REFRESH_TIME)
+        if refresh_time < MIN_SUBSCRIPTION_REFRESH_TIME:
+            raise web_request.error("Invalid refresh_time")
+        use_delta = web_request.get('delta', False, types=(bool,))
         # Add to pending queries
         cconn = web_request.get_client_connection()
         template = web_request.get_dict('response_template', {})
         if is_subscribe and cconn in self.clients:
             del self.clients[cconn]
-        reactor = self.printer.get_reactor()
-        complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
+        sub = StatusSubscription(cconn, objects, None, template,
+                                 refresh_time, use_delta)
+        sub.send_func = (lambda msg: self._finish_query(
+            web_request, sub, is_subscribe, msg))
+        self.pending_queries.append(sub)
         # Start timer if needed
+        reactor = self.printer.get_reactor()
         if self.query_timer is None:
             qt = reactor.register_timer(self._do_query, reactor.NOW)
             self.query_timer = qt
-        # Wait for data to be queried
-        msg = complete.wait()
-        web_request.send(msg['params'])
+        else:
+            reactor.update_timer(self.query_timer, reactor.NOW)
+        # Respond when the data is queried (queries from the same
+        # reactor tick are handled by one _do_query() call)
+        web_request.defer()
+    def _finish_query(self, web_request, sub, is_subscribe, msg):
+        web_request.complete(msg['params'])
         if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+            sub.send_func = sub.cconn.send
+            self.clients[sub.cconn] = sub
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
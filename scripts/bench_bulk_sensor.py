@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Benchmark bulk sensor sample extraction (python loop vs numpy)
+#
+# Copyright (C) 2026  The Klipper developers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+from extras import bulk_sensor, adxl345, lis2dw, mpu9250, angle
+
+MCU_FREQ = 72000000.
+
+# Minimal stand-ins for the clock helpers used during extraction
+class BenchClockSync:
+    def __init__(self, rate):
+        self.inv_freq = 1. / rate
+    def get_time_translation(self):
+        return 10., 0., self.inv_freq
+    def set_last_chip_clock(self, chip_clock):
+        pass
+
+class BenchClockUpdater:
+    def __init__(self):
+        self.last_sequence = 0
+    def get_last_sequence(self):
+        return self.last_sequence
+
+class BenchMCU:
+    def clock_to_print_time(self, clock):
+        return clock / MCU_FREQ
+
+class BenchAngleHelper:
+    is_tcode_absolute = False
+    def get_static_delay(self):
+        return .000100
+
+def setup_accel(cls, rate):
+    chip = cls.__new__(cls)
+    chip.axes_map = [(0, adxl345.SCALE_XY), (1, adxl345.SCALE_XY),
+                     (2, adxl345.SCALE_Z)]
+    chip.clock_updater = BenchClockUpdater()
+    chip.clock_sync = BenchClockSync(rate)
+    chip.last_error_count = 0
+    return chip
+
+def setup_angle(cls, rate):
+    chip = cls.__new__(cls)
+    chip.mcu = BenchMCU()
+    chip.sensor_helper = BenchAngleHelper()
+    chip.sample_ticks = int(MCU_FREQ / rate)
+    chip.start_clock = 1000000
+    chip.time_shift = 4
+    chip.last_sequence = chip.last_angle = 0
+    return chip
+
+# Chips to simulate: (name, class, setup, max rate, sample module,
+#                     byte mask applied to each sample)
+CHIPS = [
+    ('adxl345', adxl345.ADXL345, setup_accel, 3200, adxl345,
+     [0xff, 0xff, 0xff, 0xff, 0x7f]),
+    ('lis2dw', lis2dw.LIS2DW, setup_accel, 1600, lis2dw, [0xff] * 6),
+    ('mpu9250', mpu9250.MPU9250, setup_accel, 4000, mpu9250, [0xff] * 6),
+    ('angle', angle.Angle, setup_angle, 10000, angle, [0xfe, 0xff, 0xff]),
+]
+
+# Build the raw message batches a chip would produce at the given rate
+def build_batches(rnd, mod, mask, rate, interval, count):
+    bps = mod.BYTES_PER_SAMPLE
+    msg_size = bps * mod.SAMPLES_PER_BLOCK
+    msgs_per_batch = int(rate * interval / mod.SAMPLES_PER_BLOCK + .5)
+    hdr = bulk_sensor.BULK_RECORD_HEADER
+    pad = b"\x00" * (bulk_sensor.BULK_RECORD_SIZE - hdr.size - msg_size)
+    batches = []
+    sequence = 0
+    for i in range(count):
+        records = []
+        for j in range(msgs_per_batch):
+            data = bytearray([rnd.randrange(256) & mask[k % bps]
+                              for k in range(msg_size)])
+            records.append(hdr.pack(0., 0, sequence & 0xffff, msg_size)
+                           + bytes(data) + pad)
+            sequence += 1
+        batches.append(bulk_sensor.BulkDataBatch(b"".join(records)))
+    return batches
+
+def run_bench(chip, batches, use_numpy):
+    numpy = bulk_sensor.numpy
+    if not use_numpy:
+        bulk_sensor.numpy = None
+    try:
+        start_time = time.process_time()
+        for i, batch in enumerate(batches):
+            if hasattr(chip, 'clock_updater'):
+                chip.clock_updater.last_sequence = (i * len(batch)) & 0xffff
+            chip._extract_samples(batch)
+        total_time = time.process_time() - start_time
+    finally:
+        bulk_sensor.numpy = numpy
+    return total_time / len(batches)
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--batches", type="int", dest="batches", default=200,
+                    help="number of batches to process per chip")
+    opts.add_option("-i", "--interval", type="float", dest="interval",
+                    default=adxl345.BATCH_UPDATES,
+                    help="batch interval (in seconds)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    have_numpy = bulk_sensor.numpy is not None
+    sys.stdout.write("%d batches, %.3fs batch interval\n"
+                     % (options.batches, options.interval))
+    if not have_numpy:
+        sys.stdout.write("numpy not available - only timing python loop\n")
+    rnd = random.Random(0)
+    for name, cls, setup, rate, mod, mask in CHIPS:
+        batches = build_batches(rnd, mod, mask, rate, options.interval,
+                                options.batches)
+        chip = setup(cls, rate)
+        loop = run_bench(chip, batches, False)
+        msg = "  %-8s %5dHz %5d samples: loop %.3fms" % (
+            name, rate, len(batches[0]) * mod.SAMPLES_PER_BLOCK,
+            loop * 1000.)
+        if have_numpy:
+            vec = run_bench(setup(cls, rate), batches, True)
+            msg += ", numpy %.3fms (%.2fx)" % (vec * 1000., loop / vec)
+        sys.stdout.write(msg + " per batch\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Benchmark the host g-code command parser
+#
+# Copyright (C) 2026  The Klipper developers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, logging, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import reactor, gcode
+from extras import gcode_move
+
+DEFAULT_GCODE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'test', 'klippy', 'move.gcode')
+
+MOVE_COMMANDS = ['G0', 'G1', 'G90', 'G91', 'G92', 'M82', 'M83']
+
+# Minimal printer object with just enough support for gcode.py
+class BenchPrinter:
+    config_error = Exception
+    command_error = gcode.CommandError
+    def __init__(self):
+        self.reactor = reactor.Reactor()
+        self.objects = {}
+        self.event_handlers = {}
+    def get_start_args(self):
+        return {}
+    def get_reactor(self):
+        return self.reactor
+    def get_printer(self):
+        return self
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+    def invoke_shutdown(self, msg):
+        raise Exception(msg)
+
+def setup_dispatch(lines):
+    printer = BenchPrinter()
+    dispatch = gcode.GCodeDispatch(printer)
+    printer.objects['gcode'] = dispatch
+    gm = gcode_move.GCodeMove(printer)
+    # Ignore commands that require a full printer (eg, G28, M400)
+    for line in lines:
+        cmd = line.split(';', 1)[0].strip().upper().split()
+        if cmd and cmd[0] not in MOVE_COMMANDS:
+            dispatch.register_command(cmd[0], None)
+            dispatch.register_command(cmd[0], (lambda gcmd: None))
+    dispatch._handle_ready()
+    gm.is_printer_ready = True
+    gm.move_with_transform = (lambda newpos, speed: None)
+    return dispatch
+
+def run_bench(lines, count, use_fast):
+    dispatch = setup_dispatch(lines)
+    if not use_fast:
+        dispatch.fast_handlers.clear()
+    script = lines * count
+    start_time = time.process_time()
+    dispatch._process_commands(script, need_ack=False)
+    total_time = time.process_time() - start_time
+    return len(script) / total_time
+
+def main():
+    usage = "%prog [options] [gcode_file]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", dest="count", default=2000,
+                    help="number of times to replay the g-code file")
+    options, args = opts.parse_args()
+    if len(args) > 1:
+        opts.error("Incorrect number of arguments")
+    fname = DEFAULT_GCODE
+    if args:
+        fname = args[0]
+    logging.basicConfig(level=logging.WARNING)
+    f = open(fname, 'r')
+    lines = f.read().split('\n')
+    f.close()
+    generic = run_bench(lines, options.count, False)
+    fast = run_bench(lines, options.count, True)
+    sys.stdout.write("%s: %d lines\n" % (fname, len(lines) * options.count))
+    sys.stdout.write("  generic parser: %.0f lines/s\n" % (generic,))
+    sys.stdout.write("  fast move path: %.0f lines/s (%.2fx)\n"
+                     % (fast, fast / generic))
+
+if __name__ == '__main__':
+    main()
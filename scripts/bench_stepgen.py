@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Benchmark sequential vs parallel host step generation
+#
+# Copyright (C) 2026  The Klipper developers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, math, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import chelper
+
+MCU_FREQ = 16000000.
+MOVE_TIME = 0.020
+
+# Steppers to simulate: (axis, step_distance)
+STEPPERS = [('x', .0125), ('x', .0125), ('y', .0125), ('y', .0125),
+            ('z', .0025), ('z', .0025), ('z', .0025), ('z', .0025)]
+
+# Create the trapq and fill it with a series of small circular moves
+def setup_trapq(ffi_main, ffi_lib, total_time):
+    trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+    count = int(total_time / MOVE_TIME)
+    velocity = 100.
+    pos = (100., 100., 10.)
+    for i in range(count):
+        angle = i * .05
+        npos = (100. + 50. * math.cos(angle), 100. + 50. * math.sin(angle),
+                10. + i * .001)
+        axes_d = [n - p for n, p in zip(npos, pos)]
+        move_d = math.sqrt(sum([d*d for d in axes_d]))
+        axes_r = [d / move_d for d in axes_d]
+        ffi_lib.trapq_append(trapq, 1. + i * MOVE_TIME, 0., MOVE_TIME, 0.,
+                             pos[0], pos[1], pos[2],
+                             axes_r[0], axes_r[1], axes_r[2],
+                             0., move_d / MOVE_TIME, 0.)
+        pos = npos
+    return trapq, 1. + count * MOVE_TIME
+
+# Create a set of steppers that generate steps from the trapq
+class BenchSteppers:
+    def __init__(self, ffi_main, ffi_lib, trapq, outfile):
+        self.ffi_lib = ffi_lib
+        self.sks = ffi_main.new("struct stepper_kinematics *[]",
+                                len(STEPPERS))
+        scs = ffi_main.new("struct stepcompress *[]", len(STEPPERS))
+        self.keep = []
+        for i, (axis, step_dist) in enumerate(STEPPERS):
+            sc = ffi_main.gc(ffi_lib.stepcompress_alloc(i),
+                             ffi_lib.stepcompress_free)
+            ffi_lib.stepcompress_fill(sc, 400, 1, 2)
+            sk = ffi_main.gc(ffi_lib.cartesian_stepper_alloc(axis.encode()),
+                             ffi_lib.free)
+            ffi_lib.itersolve_set_stepcompress(sk, sc, step_dist)
+            ffi_lib.itersolve_set_trapq(sk, trapq)
+            ffi_lib.itersolve_set_position(sk, 100., 100., 10.)
+            self.sks[i] = sk
+            scs[i] = sc
+            self.keep.extend([sc, sk])
+        self.serialqueue = ffi_main.gc(
+            ffi_lib.serialqueue_alloc(outfile.fileno(), b'f', 0),
+            ffi_lib.serialqueue_free)
+        self.ss = ffi_main.gc(
+            ffi_lib.steppersync_alloc(self.serialqueue, scs, len(STEPPERS),
+                                      10000),
+            ffi_lib.steppersync_free)
+        ffi_lib.steppersync_set_time(self.ss, 0., MCU_FREQ)
+        self.keep.append(scs)
+    def flush(self, flush_time):
+        clock = int(flush_time * MCU_FREQ)
+        self.ffi_lib.steppersync_flush(self.ss, clock, clock)
+    def close(self):
+        self.ffi_lib.serialqueue_exit(self.serialqueue)
+
+def run_bench(ffi_main, ffi_lib, trapq, end_time, flush_step, threads):
+    outfile = open(os.devnull, 'wb')
+    bs = BenchSteppers(ffi_main, ffi_lib, trapq, outfile)
+    pool = None
+    if threads > 1:
+        pool = ffi_main.gc(ffi_lib.stepgen_pool_alloc(threads - 1),
+                           ffi_lib.stepgen_pool_free)
+    count = len(STEPPERS)
+    total_time = 0.
+    flushes = 0
+    flush_time = 1.
+    while flush_time < end_time:
+        flush_time = min(flush_time + flush_step, end_time)
+        start_time = time.time()
+        if pool is None:
+            for i in range(count):
+                ret = ffi_lib.itersolve_generate_steps(bs.sks[i], flush_time)
+                if ret:
+                    raise Exception("Error in itersolve_generate_steps")
+        else:
+            ret = ffi_lib.stepgen_pool_generate(pool, bs.sks, count,
+                                                flush_time)
+            if ret:
+                raise Exception("Error in stepgen_pool_generate")
+        total_time += time.time() - start_time
+        flushes += 1
+        bs.flush(flush_time)
+    bs.close()
+    outfile.close()
+    return total_time / flushes
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--time", type="float", dest="time", default=30.,
+                    help="seconds of motion to simulate")
+    opts.add_option("-f", "--flush", type="float", dest="flush", default=.5,
+                    help="step generation flush interval (in seconds)")
+    opts.add_option("-j", "--threads", type="int", dest="threads",
+                    default=os.cpu_count() or 1,
+                    help="number of threads for parallel step generation")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    ffi_main, ffi_lib = chelper.get_ffi()
+    trapq, end_time = setup_trapq(ffi_main, ffi_lib, options.time)
+    seq = run_bench(ffi_main, ffi_lib, trapq, end_time, options.flush, 1)
+    par = run_bench(ffi_main, ffi_lib, trapq, end_time, options.flush,
+                    options.threads)
+    sys.stdout.write("%d steppers, %.1fs of motion, %.3fs flush interval\n"
+                     % (len(STEPPERS), options.time, options.flush))
+    sys.stdout.write("  sequential: %.3fms per flush\n" % (seq * 1000.,))
+    sys.stdout.write("  %d threads: %.3fms per flush (%.2fx)\n"
+                     % (options.threads, par * 1000., seq / par))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Measure reactor latency and request throughput of the api server
+#
+# Copyright (C) 2026  The Klipper developers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, socket, tempfile, multiprocessing, threading
+import time, json
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import reactor, webhooks
+
+PROBE_INTERVAL = .001
+
+# The subset of the printer interface used by webhooks
+class BenchPrinter:
+    command_error = Exception
+    def __init__(self, reactor, start_args):
+        self.reactor = reactor
+        self.start_args = start_args
+        self.objects = {}
+    def get_reactor(self):
+        return self.reactor
+    def get_start_args(self):
+        return self.start_args
+    def get_state_message(self):
+        return "Printer is ready", "ready"
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+    def lookup_objects(self, module=None):
+        return list(self.objects.items())
+    def register_event_handler(self, event, callback):
+        pass
+    def set_rollover_info(self, name, info, log=True):
+        pass
+    def invoke_shutdown(self, msg):
+        raise Exception(msg)
+
+# Stand-in api client that reads (and discards) all messages
+def run_client(sockname, read_delay):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sockname)
+    while 1:
+        data = sock.recv(65536)
+        if not data:
+            break
+        if read_delay:
+            time.sleep(read_delay)
+
+# Printer object with status information to query
+class BenchStatus:
+    def __init__(self):
+        self.status = {'position': [10., 20., 30., 40.], 'state': "ready",
+                       'values': list(range(20))}
+    def get_status(self, eventtime):
+        return self.status
+
+# Stand-in api client that sends many requests at once
+def run_request_client(sockname, method, count, result_queue):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sockname)
+    params = {}
+    if method == 'objects/query':
+        params = {'objects': {'bench': None}}
+    reqs = [json.dumps({'id': i, 'method': method, 'params': params},
+                       separators=(',', ':')).encode() + b"\x03"
+            for i in range(count)]
+    start_time = time.time()
+    # Send from a thread as the server stops reading while blocked
+    send_thread = threading.Thread(target=sock.sendall,
+                                   args=(b"".join(reqs),))
+    send_thread.start()
+    responses = 0
+    data = b""
+    while responses < count:
+        data += sock.recv(65536)
+        parts = data.split(b"\x03")
+        data = parts.pop()
+        responses += len(parts)
+    result_queue.put(time.time() - start_time)
+    send_thread.join()
+    sock.close()
+
+def run_request_bench(options, method):
+    sockname = os.path.join(tempfile.mkdtemp(), "bench_sock")
+    r = reactor.Reactor()
+    printer = BenchPrinter(r, {'apiserver': sockname})
+    printer.add_object('webhooks', webhooks.WebHooks(printer))
+    printer.add_object('bench', BenchStatus())
+    webhooks.QueryStatusHelper(printer)
+    result_queue = multiprocessing.Queue()
+    client = multiprocessing.Process(
+        target=run_request_client,
+        args=(sockname, method, options.requests, result_queue))
+    client.start()
+    def check_end(eventtime):
+        if client.is_alive():
+            return eventtime + .010
+        r.end()
+        return r.NEVER
+    r.register_timer(check_end, r.NOW)
+    r.run()
+    printer.lookup_object('webhooks').sconn._handle_disconnect()
+    r.finalize()
+    client.join()
+    os.unlink(sockname)
+    os.rmdir(os.path.dirname(sockname))
+    return result_queue.get()
+
+# Build a message similar to an accelerometer "dump" batch
+def build_message(samples):
+    data = [[100. + i * .0003125, 1234.5678, -234.5678, 9806.65]
+            for i in range(samples)]
+    return {'params': {'data': data, 'overflows': 0}, 'key': 123}
+
+def run_bench(options, json_thread):
+    sockname = os.path.join(tempfile.mkdtemp(), "bench_sock")
+    start_args = {'apiserver': sockname}
+    if json_thread:
+        start_args['api_json_thread'] = True
+    r = reactor.Reactor()
+    server = webhooks.ServerSocket(None, BenchPrinter(r, start_args))
+    client = multiprocessing.Process(target=run_client,
+                                     args=(sockname, options.read_delay))
+    client.start()
+    msg = build_message(options.samples)
+    lateness = []
+    state = {'sent': 0}
+    def probe(eventtime):
+        if state.get('waketime') is not None:
+            lateness.append(eventtime - state['waketime'])
+        state['waketime'] = waketime = eventtime + PROBE_INTERVAL
+        return waketime
+    def do_send(eventtime):
+        for c in server.clients.values():
+            c.send(msg)
+            state['sent'] += 1
+        return eventtime + options.interval
+    def do_end(eventtime):
+        r.end()
+        return r.NEVER
+    start_time = r.monotonic()
+    r.register_timer(probe, start_time)
+    r.register_timer(do_send, start_time + .100)
+    r.register_timer(do_end, start_time + options.time)
+    r.run()
+    server._handle_disconnect()
+    r.finalize()
+    client.join()
+    os.unlink(sockname)
+    os.rmdir(os.path.dirname(sockname))
+    lateness.sort()
+    count = len(lateness)
+    return {'sent': state['sent'],
+            'avg': sum(lateness) / count,
+            'p99': lateness[int(count * .99)],
+            'max': lateness[-1]}
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--time", type="float", dest="time", default=5.,
+                    help="seconds to run each test")
+    opts.add_option("-s", "--samples", type="int", dest="samples",
+                    default=20000, help="number of samples in each message")
+    opts.add_option("-i", "--interval", type="float", dest="interval",
+                    default=.100, help="time between messages (in seconds)")
+    opts.add_option("-r", "--read-delay", type="float", dest="read_delay",
+                    default=0., help="client delay after each socket read")
+    opts.add_option("-n", "--requests", type="int", dest="requests",
+                    default=0, help="measure throughput of this many requests"
+                    " (instead of latency)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    if options.requests:
+        sys.stdout.write("%d pipelined requests from one client\n"
+                         % (options.requests,))
+        for method in ['info', 'objects/query']:
+            duration = run_request_bench(options, method)
+            sys.stdout.write("  %14s: %.3fs (%.0f requests/s)\n"
+                             % (method, duration,
+                                options.requests / duration))
+        return
+    sys.stdout.write("%d sample messages every %.3fs for %.1fs\n"
+                     % (options.samples, options.interval, options.time))
+    for name, json_thread in [("reactor", False), ("thread", True)]:
+        res = run_bench(options, json_thread)
+        sys.stdout.write("  %8s json: sent=%d timer lateness avg=%.3fms"
+                         " p99=%.3fms max=%.3fms\n"
+                         % (name, res['sent'], res['avg'] * 1000.,
+                            res['p99'] * 1000., res['max'] * 1000.))
+
+if __name__ == '__main__':
+    main()
@@ -73,10 +73,14 @@ start_test klippy "Test klippy import (Python2)"
 $PYTHON2 klippy/klippy.py --import-test
 finish_test klippy "Test klippy import (Python2)"
 
+start_test klippy "Test message encoding (Python3)"
+$PYTHON scripts/test_msgproto.py ${DICTDIR}/*.dict
+finish_test klippy "Test message encoding (Python3)"
+
 start_test klippy "Test invoke klippy (Python3)"
-$PYTHON scripts/test_klippy.py -d ${DICTDIR} test/klippy/*.test
+$PYTHON scripts/test_klippy.py -j 0 -d ${DICTDIR} test/klippy/*.test
 finish_test klippy "Test invoke klippy (Python3)"
 
 start_test klippy "Test invoke klippy (Python2)"
-$PYTHON2 scripts/test_klippy.py -d ${DICTDIR} test/klippy/*.test
+$PYTHON2 scripts/test_klippy.py -j 0 -d ${DICTDIR} test/klippy/*.test
 finish_test klippy "Test invoke klippy (Python2)"
@@ -4,8 +4,9 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import optparse, datetime
-import matplotlib
+import optparse, datetime, json, array, operator
+import numpy, matplotlib
+import logindex
 
 MAXBANDWIDTH=25000.
 MAXBUFFER=2.
@@ -18,37 +19,178 @@ APPLY_PREFIX = [
     'target', 'temp', 'pwm'
 ]
 
-def parse_log(logname, mcu):
-    if mcu is None:
-        mcu = "mcu"
-    mcu_prefix = mcu + ":"
+def parse_value(val):
+    try:
+        return float(val)
+    except ValueError:
+        return numpy.nan
+
+# Store each stat in a numpy array (NaN for samples without the stat).
+# Samples with the same stat names (a "layout") are stored together.
+class StatsCollector:
+    def __init__(self):
+        self.sampletimes = array.array('d')
+        self.layouts = {}
+    def add_layout(self, key, names):
+        layout = None
+        if 'print_time' in names:
+            layout = (names, array.array('q'), array.array('d'))
+        self.layouts[key] = layout
+    def add_sample(self, key, sampletime, values):
+        layout = self.layouts[key]
+        if layout is None:
+            return
+        try:
+            values = list(map(float, values))
+        except ValueError:
+            values = [parse_value(v) for v in values]
+        layout[1].append(len(self.sampletimes))
+        layout[2].extend(values)
+        self.sampletimes.append(sampletime)
+    def get_data(self):
+        count = len(self.sampletimes)
+        if not count:
+            return {}
+        data = {'#sampletime': numpy.frombuffer(self.sampletimes)}
+        for layout in self.layouts.values():
+            if layout is None:
+                continue
+            names, samples, values = layout
+            samples = numpy.frombuffer(samples, dtype=numpy.int64)
+            values = numpy.frombuffer(values).reshape(-1, len(names))
+            for i, name in enumerate(names):
+                d = data.get(name)
+                if d is None:
+                    data[name] = d = numpy.full(count, numpy.nan)
+                d[samples] = values[:, i]
+        return data
+
+# Parse a json stats file (as produced by the klippy --stats-log option)
+def parse_stats_log(f, mcu, collector):
     apply_prefix = { p: 1 for p in APPLY_PREFIX }
-    f = open(logname, 'r')
-    out = []
     for line in f:
-        parts = line.split()
-        if not parts or parts[0] not in ('Stats', 'INFO:root:Stats'):
-            #if parts and parts[0] == 'INFO:root:shutdown:':
-            #    break
+        if not line.strip():
             continue
-        prefix = ""
+        stats = json.loads(line)
         keyparts = {}
-        for p in parts[2:]:
-            if '=' not in p:
-                prefix = p
-                if prefix == mcu_prefix:
-                    prefix = ''
+        for group, values in stats.items():
+            if not isinstance(values, dict):
+                keyparts[group] = values
                 continue
-            name, val = p.split('=', 1)
-            if name in apply_prefix:
-                name = prefix + name
-            keyparts[name] = val
-        if 'print_time' not in keyparts:
+            prefix = group + ":"
+            if group == mcu:
+                prefix = ''
+            for name, val in values.items():
+                if name in apply_prefix:
+                    name = prefix + name
+                keyparts[name] = val
+        key = tuple(keyparts)
+        if key not in collector.layouts:
+            collector.add_layout(key, key)
+        collector.add_sample(key, stats['time'], keyparts.values())
+
+# Parse the stats in a "Stats" line into a dictionary
+def parse_stats_line(rest, mcu_prefix):
+    apply_prefix = { p: 1 for p in APPLY_PREFIX }
+    prefix = ""
+    keyparts = {}
+    for p in rest.split():
+        if '=' not in p:
+            prefix = p
+            if prefix == mcu_prefix:
+                prefix = ''
             continue
-        keyparts['#sampletime'] = float(parts[1][:-1])
-        out.append(keyparts)
-    f.close()
-    return out
+        name, val = p.split('=', 1)
+        if name in apply_prefix:
+            name = prefix + name
+        keyparts[name] = val
+    return keyparts
+
+# Determine the position of the names and values in the tokens of a
+# "Stats" line (after its '=' characters are replaced with spaces)
+def get_stats_layout(rest, mcu_prefix, collector):
+    fixed = []
+    values = []
+    pos = 0
+    for p in rest.split():
+        fixed.append(pos)
+        pos += 1
+        if '=' in p:
+            name, val = p.split('=', 1)
+            if not name or not val or '=' in val:
+                return None
+            values.append(pos)
+            pos += 1
+    if len(fixed) < 2 or len(values) < 2:
+        return None
+    names = list(parse_stats_line(rest, mcu_prefix))
+    if len(names) != len(values):
+        # Duplicate names
+        return None
+    key = tuple(names)
+    if key not in collector.layouts:
+        collector.add_layout(key, names)
+    get_fixed = operator.itemgetter(*fixed)
+    tokens = rest.replace('=', ' ').split()
+    return (get_fixed, get_fixed(tokens), operator.itemgetter(*values), key)
+
+# Parse the "Stats" lines found by the log index
+def parse_log_stats(f, index, mcu, collector):
+    mcu_prefix = mcu + ":"
+    layouts = {}
+    for line_num, pos, end in index.stats:
+        f.seek(pos)
+        while pos < end:
+            line = f.readline()
+            pos += len(line)
+            parts = line.decode().split(None, 2)
+            if len(parts) < 3 or parts[0] not in ('Stats', 'INFO:root:Stats'):
+                continue
+            sampletime = float(parts[1][:-1])
+            rest = parts[2]
+            # Check for a known layout (based on the number of tokens)
+            tokens = rest.replace('=', ' ').split()
+            for get_fixed, fixed, get_values, key in layouts.get(
+                    len(tokens), ()):
+                if get_fixed(tokens) == fixed:
+                    collector.add_sample(key, sampletime, get_values(tokens))
+                    break
+            else:
+                layout = get_stats_layout(rest, mcu_prefix, collector)
+                if layout is not None:
+                    layouts.setdefault(len(tokens), []).append(layout)
+                    collector.add_sample(layout[3], sampletime,
+                                         layout[2](tokens))
+                    continue
+                keyparts = parse_stats_line(rest, mcu_prefix)
+                key = tuple(keyparts)
+                if key not in collector.layouts:
+                    collector.add_layout(key, key)
+                collector.add_sample(key, sampletime, keyparts.values())
+
+def parse_log(logname, mcu):
+    if mcu is None:
+        mcu = "mcu"
+    collector = StatsCollector()
+    with open(logname, 'rb') as f:
+        is_stats_log = f.read(1) == b'{'
+        f.seek(0)
+        if is_stats_log:
+            parse_stats_log(f, mcu, collector)
+        else:
+            index = logindex.get_index(logname)
+            parse_log_stats(f, index, mcu, collector)
+    return collector.get_data()
+
+# Return a column with missing values replaced by a default
+def get_column(data, name, default=0.):
+    d = data.get(name)
+    if d is None:
+        return numpy.full(len(data['#sampletime']), default)
+    return numpy.where(numpy.isnan(d), default, d)
+
+def to_dates(sampletimes):
+    return [datetime.datetime.utcfromtimestamp(st) for st in sampletimes]
 
 def setup_matplotlib(output_to_file):
     global matplotlib
@@ -61,10 +203,11 @@ def find_print_restarts(data):
     runoff_samples = {}
     last_runoff_start = last_buffer_time = last_sampletime = 0.
     last_print_stall = 0
-    for d in reversed(data):
+    samples = zip(data['#sampletime'].tolist(),
+                  get_column(data, 'buffer_time').tolist(),
+                  data['print_stall'].tolist())
+    for sampletime, buffer_time, print_stall in reversed(list(samples)):
         # Check for buffer runoff
-        sampletime = d['#sampletime']
-        buffer_time = float(d.get('buffer_time', 0.))
         if (last_runoff_start and last_sampletime - sampletime < 5
             and buffer_time > last_buffer_time):
             runoff_samples[last_runoff_start][1].append(sampletime)
@@ -76,7 +219,6 @@ def find_print_restarts(data):
         last_buffer_time = buffer_time
         last_sampletime = sampletime
         # Check for print stall
-        print_stall = int(d['print_stall'])
         if print_stall < last_print_stall:
             if last_runoff_start:
                 runoff_samples[last_runoff_start][0] = True
@@ -87,28 +229,29 @@ def find_print_restarts(data):
 
 def plot_mcu(data, maxbw):
     # Generate data for plot
-    basetime = lasttime = data[0]['#sampletime']
-    lastbw = float(data[0]['bytes_write']) + float(data[0]['bytes_retransmit'])
+    sampletimes = data['#sampletime'].tolist()
+    bws = (data['bytes_write'] + data['bytes_retransmit']).tolist()
+    mcu_loads = (data['mcu_task_avg'] + 3*data['mcu_task_stddev']).tolist()
+    buffer_times = data['buffer_time'].tolist()
+    awake_times = get_column(data, 'mcu_awake').tolist()
+    basetime = lasttime = sampletimes[0]
+    lastbw = bws[0]
     sample_resets = find_print_restarts(data)
     times = []
     bwdeltas = []
     loads = []
     awake = []
     hostbuffers = []
-    for d in data:
-        st = d['#sampletime']
+    for st, bw, load, hb, awake_time in zip(sampletimes, bws, mcu_loads,
+                                            buffer_times, awake_times):
         timedelta = st - lasttime
         if timedelta <= 0.:
             continue
-        bw = float(d['bytes_write']) + float(d['bytes_retransmit'])
         if bw < lastbw:
             lastbw = bw
             continue
-        load = float(d['mcu_task_avg']) + 3*float(d['mcu_task_stddev'])
         if st - basetime < 15.:
             load = 0.
-        pt = float(d['print_time'])
-        hb = float(d['buffer_time'])
         if hb >= MAXBUFFER or st in sample_resets:
             hb = 0.
         else:
@@ -117,7 +260,7 @@ def plot_mcu(data, maxbw):
         times.append(datetime.datetime.utcfromtimestamp(st))
         bwdeltas.append(100. * (bw - lastbw) / (maxbw * timedelta))
         loads.append(100. * load / TASK_MAX)
-        awake.append(100. * float(d.get('mcu_awake', 0.)) / STATS_INTERVAL)
+        awake.append(100. * awake_time / STATS_INTERVAL)
         lasttime = st
         lastbw = bw
 
@@ -139,25 +282,28 @@ def plot_mcu(data, maxbw):
 
 def plot_system(data):
     # Generate data for plot
-    lasttime = data[0]['#sampletime']
-    lastcputime = float(data[0]['cputime'])
+    sampletimes = data['#sampletime'].tolist()
+    all_cputimes = data['cputime'].tolist()
+    all_sysloads = data['sysload'].tolist()
+    all_memavails = data['memavail'].tolist()
+    lasttime = sampletimes[0]
+    lastcputime = all_cputimes[0]
     times = []
     sysloads = []
     cputimes = []
     memavails = []
-    for d in data:
-        st = d['#sampletime']
+    for st, cputime, sysload, memavail in zip(sampletimes, all_cputimes,
+                                              all_sysloads, all_memavails):
         timedelta = st - lasttime
         if timedelta <= 0.:
             continue
         lasttime = st
         times.append(datetime.datetime.utcfromtimestamp(st))
-        cputime = float(d['cputime'])
         cpudelta = max(0., min(1.5, (cputime - lastcputime) / timedelta))
         lastcputime = cputime
         cputimes.append(cpudelta * 100.)
-        sysloads.append(float(d['sysload']) * 100.)
-        memavails.append(float(d['memavail']))
+        sysloads.append(sysload * 100.)
+        memavails.append(memavail)
 
     # Build plot
     fig, ax1 = matplotlib.pyplot.subplots()
@@ -181,21 +327,17 @@ def plot_system(data):
     ax1.grid(True)
     return fig
 
+# Return the times and values of a frequency stat
+def get_freq_values(data, key):
+    values = data[key]
+    valid = ~numpy.isnan(values) & (values != 0.) & (values != 1.)
+    return to_dates(data['#sampletime'][valid].tolist()), values[valid]
+
 def plot_mcu_frequencies(data):
-    all_keys = {}
-    for d in data:
-        all_keys.update(d)
-    graph_keys = { key: ([], []) for key in all_keys
+    graph_keys = { key: get_freq_values(data, key) for key in data
                    if (key in ("freq", "adj")
                        or (key.endswith(":freq") or key.endswith(":adj"))) }
-    for d in data:
-        st = datetime.datetime.utcfromtimestamp(d['#sampletime'])
-        for key, (times, values) in graph_keys.items():
-            val = d.get(key)
-            if val not in (None, '0', '1'):
-                times.append(st)
-                values.append(float(val))
-    est_mhz = { key: round((sum(values)/len(values)) / 1000000.)
+    est_mhz = { key: round(numpy.mean(values) / 1000000.)
                 for key, (times, values) in graph_keys.items() }
 
     # Build plot
@@ -208,7 +350,7 @@ def plot_mcu_frequencies(data):
         mhz = est_mhz[key]
         label = "%s(%dMhz)" % (key, mhz)
         hz = mhz * 1000000.
-        ax1.plot_date(times, [(v - hz)/mhz for v in values], '.', label=label)
+        ax1.plot_date(times, (values - hz) / mhz, '.', label=label)
     fontP = matplotlib.font_manager.FontProperties()
     fontP.set_size('x-small')
     ax1.legend(loc='best', prop=fontP)
@@ -218,18 +360,8 @@ def plot_mcu_frequencies(data):
     return fig
 
 def plot_mcu_frequency(data, mcu):
-    all_keys = {}
-    for d in data:
-        all_keys.update(d)
-    graph_keys = { key: ([], []) for key in all_keys
+    graph_keys = { key: get_freq_values(data, key) for key in data
                    if key in ("freq", "adj") }
-    for d in data:
-        st = datetime.datetime.utcfromtimestamp(d['#sampletime'])
-        for key, (times, values) in graph_keys.items():
-            val = d.get(key)
-            if val not in (None, '0', '1'):
-                times.append(st)
-                values.append(float(val))
 
     # Build plot
     fig, ax1 = matplotlib.pyplot.subplots()
@@ -255,23 +387,17 @@ def plot_temperature(data, heaters):
         temp_key = heater + ':' + 'temp'
         target_key = heater + ':' + 'target'
         pwm_key = heater + ':' + 'pwm'
-        times = []
-        temps = []
-        targets = []
-        pwm = []
-        for d in data:
-            temp = d.get(temp_key)
-            if temp is None:
-                continue
-            times.append(datetime.datetime.utcfromtimestamp(d['#sampletime']))
-            temps.append(float(temp))
-            pwm.append(float(d.get(pwm_key, 0.)))
-            targets.append(float(d.get(target_key, 0.)))
+        temps = get_column(data, temp_key, numpy.nan)
+        valid = ~numpy.isnan(temps)
+        times = to_dates(data['#sampletime'][valid].tolist())
+        temps = temps[valid]
+        targets = get_column(data, target_key)[valid]
+        pwm = get_column(data, pwm_key)[valid]
         ax1.plot_date(times, temps, '-', label='%s temp' % (heater,), alpha=0.8)
-        if any(targets):
+        if targets.any():
             label = '%s target' % (heater,)
             ax1.plot_date(times, targets, '-', label=label, alpha=0.3)
-        if any(pwm):
+        if pwm.any():
             label = '%s pwm' % (heater,)
             ax2.plot_date(times, pwm, '-', label=label, alpha=0.2)
     # Build plot
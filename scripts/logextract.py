@@ -4,7 +4,8 @@
 # Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, re, collections, ast, itertools
+import sys, re, ast, itertools, bisect
+import logindex
 
 def format_comment(line_num, line):
     return "# %6d: %s" % (line_num, line)
@@ -576,40 +577,59 @@ class GatherShutdown:
 # Startup
 ######################################################################
 
+def decode_line(data):
+    return data.decode('utf-8', 'replace').rstrip()
+
+# Read the last line in the index entries that is before line_num
+def read_index_line(f, entries, line_num):
+    pos = bisect.bisect_left(entries, (line_num,)) - 1
+    if pos < 0:
+        return None
+    line_num, offset = entries[pos]
+    f.seek(offset)
+    return format_comment(line_num, decode_line(f.readline()))
+
 def main():
     logname = sys.argv[1]
-    last_git = last_start = None
+    index = logindex.get_index(logname)
     configs = {}
-    handler = None
-    recent_lines = collections.deque([], 200)
-    # Parse log file
-    with open(logname, 'rt') as f:
-        for line_num, line in enumerate(f):
-            line = line.rstrip()
-            line_num += 1
-            recent_lines.append((line_num, line))
-            if handler is not None:
-                ret = handler.add_line(line_num, line)
-                if ret:
-                    continue
-                recent_lines.clear()
-                handler = None
-            if line.startswith('Git version'):
-                last_git = format_comment(line_num, line)
-            elif line.startswith('Start printer at'):
-                last_start = format_comment(line_num, line)
-            elif line == '===== Config file =====':
-                handler = GatherConfig(configs, line_num,
-                                       recent_lines, logname)
-                handler.add_comment(last_git)
-                handler.add_comment(last_start)
-            elif 'shutdown: ' in line or line.startswith('Dumping '):
-                handler = GatherShutdown(configs, line_num,
-                                         recent_lines, logname)
-                handler.add_comment(last_git)
-                handler.add_comment(last_start)
-    if handler is not None:
-        handler.finalize()
+    triggers = sorted([(line_num, offset, GatherConfig)
+                       for line_num, offset in index.config]
+                      + [(line_num, offset, GatherShutdown)
+                         for line_num, offset in index.shutdown])
+    # Line the last handler stopped at and the offset of the next line
+    end_line_num = end_offset = 0
+    with open(logname, 'rb') as f:
+        for line_num, offset, handler_class in triggers:
+            if line_num < end_line_num:
+                # Line was consumed by an earlier handler
+                continue
+            # Gather the recent lines up to and including this line
+            f.seek(offset)
+            data = f.readline()
+            pos = offset + len(data)
+            recent_lines = []
+            if line_num > end_line_num:
+                lines = logindex.read_lines_before(f, offset, 199, end_offset)
+                lines.append(data)
+                first_line_num = line_num - len(lines) + 1
+                recent_lines = [(first_line_num + i, decode_line(l))
+                                for i, l in enumerate(lines)]
+            # Extract information from the lines following the trigger
+            handler = handler_class(configs, line_num, recent_lines, logname)
+            handler.add_comment(read_index_line(f, index.git, line_num))
+            handler.add_comment(read_index_line(f, index.start, line_num))
+            f.seek(pos)
+            for data in f:
+                line_num += 1
+                pos += len(data)
+                if not handler.add_line(line_num, decode_line(data)):
+                    break
+            else:
+                handler.finalize()
+                break
+            end_line_num = line_num
+            end_offset = pos
     # Write found config files
     for cfg in configs.values():
         cfg.write_file()
@@ -0,0 +1,148 @@
+# Build and load an index of the interesting lines in a klippy.log file
+#
+# Copyright (C) 2026  The Klipper developers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, re, json, zlib
+
+INDEX_VERSION = 1
+CHUNK_SIZE = 16 * 1024 * 1024
+HEAD_SIZE = 4096
+
+# Find the start of all lines that are not "Stats" lines (checked in
+# this order).  Lines containing "shutdown: " are also recorded as
+# "shutdown" lines.
+index_r = re.compile(
+    rb"\n(?:(?P<git>Git version)|(?P<start>Start printer at)"
+    rb"|(?P<config>===== Config file =====[ \t\r]*(?=\n))"
+    rb"|(?P<shutdown>Dumping )|(?!(?:INFO:root:)?Stats ))")
+
+# Index of line numbers and byte offsets.  The "git", "start",
+# "config", and "shutdown" lists contain (line_num, offset) pairs.
+# The "stats" list contains (line_num, offset, end_offset) tuples
+# describing runs of consecutive "Stats" lines.
+class LogIndex:
+    def __init__(self, head_crc=0):
+        self.head_crc = head_crc
+        self.size = self.lines = 0
+        self.git = []
+        self.start = []
+        self.config = []
+        self.shutdown = []
+        self.stats = []
+    def get_state(self):
+        return {'version': INDEX_VERSION, 'head_crc': self.head_crc,
+                'size': self.size, 'lines': self.lines, 'git': self.git,
+                'start': self.start, 'config': self.config,
+                'shutdown': self.shutdown, 'stats': self.stats}
+    def set_state(self, state):
+        if state.get('version') != INDEX_VERSION:
+            raise ValueError("Unknown index version")
+        self.head_crc = state['head_crc']
+        self.size = state['size']
+        self.lines = state['lines']
+        self.git = [tuple(i) for i in state['git']]
+        self.start = [tuple(i) for i in state['start']]
+        self.config = [tuple(i) for i in state['config']]
+        self.shutdown = [tuple(i) for i in state['shutdown']]
+        self.stats = [tuple(i) for i in state['stats']]
+    # Find the lines in a block of data that contain "shutdown: "
+    def _find_shutdown(self, data, end):
+        out = set()
+        pos = data.find(b"shutdown: ", 0, end)
+        while pos >= 0:
+            out.add(data.rfind(b'\n', 0, pos) + 1)
+            pos = data.find(b"shutdown: ", data.find(b'\n', pos), end)
+        return out
+    def _add_stats(self, line_num, start, end):
+        if self.stats and self.stats[-1][2] == start:
+            self.stats[-1] = self.stats[-1][:2] + (end,)
+        else:
+            self.stats.append((line_num, start, end))
+    # Scan new data (starting at self.size) from the log file
+    def scan(self, f):
+        f.seek(self.size)
+        # Each block starts with the newline ending the previous line
+        pending = b"\n"
+        while 1:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            data = pending + data
+            end = data.rfind(b'\n')
+            pending = data[end:]
+            base = self.size - 1
+            shutdown = self._find_shutdown(data, end)
+            lines = last_line_num = self.lines
+            last_pos = next_pos = 1
+            for m in index_r.finditer(data, 0, end + 1):
+                line_start = m.start() + 1
+                if line_start > end:
+                    break
+                lines += data.count(b'\n', last_pos, line_start)
+                last_pos = line_start
+                line_num = lines + 1
+                # Lines since the last match are all "Stats" lines
+                if line_num > last_line_num + 1:
+                    self._add_stats(last_line_num + 1, base + next_pos,
+                                    base + line_start)
+                last_line_num = line_num
+                next_pos = data.find(b'\n', line_start) + 1
+                kind = m.lastgroup
+                if kind is None and line_start in shutdown:
+                    kind = 'shutdown'
+                if kind is not None:
+                    getattr(self, kind).append((line_num, base + line_start))
+            self.lines = lines + data.count(b'\n', last_pos, end + 1)
+            if self.lines > last_line_num:
+                self._add_stats(last_line_num + 1, base + next_pos,
+                                base + end + 1)
+            self.size = base + end + 1
+
+def _get_head_crc(f):
+    f.seek(0)
+    return zlib.crc32(f.read(HEAD_SIZE))
+
+def _load_index(indexname, head_crc, size):
+    index = LogIndex(head_crc)
+    try:
+        with open(indexname, 'r') as f:
+            index.set_state(json.load(f))
+    except (OSError, ValueError, KeyError, TypeError):
+        return LogIndex(head_crc)
+    if index.head_crc != head_crc or index.size > size:
+        # Log file was rotated or replaced
+        return LogIndex(head_crc)
+    return index
+
+# Return the index for a log file - building or extending it if needed
+def get_index(logname):
+    indexname = logname + ".index"
+    with open(logname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        head_crc = _get_head_crc(f)
+        index = _load_index(indexname, head_crc, size)
+        if index.size < size:
+            index.scan(f)
+            try:
+                with open(indexname, 'w') as idxf:
+                    json.dump(index.get_state(), idxf, separators=(',', ':'))
+            except OSError:
+                pass
+    return index
+
+# Read up to 'count' lines that end before 'offset' (but not before
+# 'min_offset')
+def read_lines_before(f, offset, count, min_offset=0):
+    data = b""
+    pos = offset
+    while pos > min_offset and data.count(b'\n') <= count:
+        read_size = min(pos - min_offset, 64 * 1024)
+        pos -= read_size
+        f.seek(pos)
+        data = f.read(read_size) + data
+    lines = data.split(b'\n')[:-1]
+    if pos > min_offset:
+        # First line may be partial
+        lines = lines[1:]
+    return lines[max(0, len(lines) - count):]
@@ -5,6 +5,9 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, optparse, socket, select, json, errno, time, zlib
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..'))
+import whconsole
 
 INDEX_UPDATE_TIME = 5.0
 ClientInfo = {'program': 'motan_data_logger', 'version': 'v0.1'}
@@ -69,7 +72,8 @@ class DataLogger:
         self.db = {}
         self.next_index_time = 0.
         # Start login process
-        self.send_query("info", "info", {"client_info": ClientInfo},
+        self.send_query("info", "info", {"client_info": ClientInfo,
+                                         "binary_framing": True},
                         self.handle_info)
     def error(self, msg):
         sys.stderr.write(msg + "\n")
@@ -88,15 +92,18 @@ class DataLogger:
         data = self.webhook_socket.recv(4096)
         if not data:
             self.finish("Socket closed")
-        parts = data.split(b"\x03")
-        parts[0] = self.socket_data + parts[0]
-        self.socket_data = parts.pop()
-        for part in parts:
+        data = self.socket_data + data
+        parts, self.socket_data = whconsole.parse_frames(data)
+        for part, blob in parts:
             try:
                 msg = json.loads(part)
             except:
                 self.error("ERROR: Unable to parse line")
                 continue
+            if blob is not None:
+                # Log data in the regular json format
+                msg = whconsole.unpack_message(msg, blob)
+                part = json.dumps(msg, separators=(',', ':')).encode()
             self.logger.add_data(part)
             msg_q = msg.get("q")
             if msg_q is not None:
@@ -3,11 +3,17 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, os, optparse, logging, subprocess
+import sys, os, optparse, logging, subprocess, tempfile, shutil, time
+import json, multiprocessing, multiprocessing.pool
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import chelper
 
 TEMP_GCODE_FILE = "_test_.gcode"
 TEMP_LOG_FILE = "_test_.log"
 TEMP_OUTPUT_FILE = "_test_output"
+TEMP_STDOUT_FILE = "_test_.out"
+DEFAULT_TIMEOUT = 300.
 
 
 ######################################################################
@@ -17,18 +23,114 @@ TEMP_OUTPUT_FILE = "_test_output"
 class error(Exception):
     pass
 
+# Check that each data dictionary file can be loaded before any test
+# is started.  The parsed data is not reused - each klippy process
+# still loads its own dictionaries.
+class DictPreCheck:
+    def __init__(self):
+        self.checked = {}
+    def check(self, fname):
+        if fname in self.checked:
+            return
+        try:
+            f = open(fname, 'rb')
+            json.loads(f.read())
+            f.close()
+        except (IOError, OSError, ValueError) as e:
+            raise error("Unable to load data dictionary %s: %s" % (fname, e))
+        self.checked[fname] = True
+
+# A single invocation of klippy
+class TestRun:
+    def __init__(self, fname, config_fname, dict_fnames, gcode_fname, gcode,
+                 should_fail):
+        self.fname = fname
+        self.config_fname = config_fname
+        self.dict_fnames = dict_fnames
+        self.gcode_fname = gcode_fname
+        self.gcode = gcode
+        self.should_fail = should_fail
+    def get_name(self):
+        return "%s (%s)" % (self.fname, os.path.basename(self.config_fname))
+    def run(self, tempdir, verbose, keepfiles, capture, timeout):
+        # Returns (error message or None, run time, captured output)
+        start_time = time.time()
+        rundir = tempfile.mkdtemp(prefix="_test_", dir=tempdir)
+        gcode_fname = self.gcode_fname
+        if gcode_fname is None:
+            gcode_fname = os.path.join(rundir, TEMP_GCODE_FILE)
+            f = open(gcode_fname, 'w')
+            f.write('\n'.join(self.gcode + ['']))
+            f.close()
+        log_fname = os.path.join(rundir, TEMP_LOG_FILE)
+        # Call klippy
+        out_fname = os.path.join(rundir, TEMP_OUTPUT_FILE)
+        args = [ sys.executable, './klippy/klippy.py', self.config_fname,
+                 '-i', gcode_fname, '-o', out_fname, '-v' ]
+        for df in self.dict_fnames:
+            args += ['-d', df]
+        if not verbose:
+            args += ['-l', log_fname]
+        if capture:
+            stdout_fname = os.path.join(rundir, TEMP_STDOUT_FILE)
+            outf = open(stdout_fname, 'wb')
+            res = call_with_timeout(args, timeout, stdout=outf,
+                                    stderr=subprocess.STDOUT)
+            outf.close()
+        else:
+            res = call_with_timeout(args, timeout)
+        elapsed = time.time() - start_time
+        msg = None
+        if res is None:
+            msg = "Test timed out after %.1fs" % (timeout,)
+        elif self.should_fail and not res:
+            msg = "Test failed to raise an error"
+        elif not self.should_fail and res:
+            msg = "Error during test"
+        output = ""
+        if msg is not None or (verbose and capture):
+            if not verbose:
+                output += read_file(log_fname)
+            if capture:
+                output += read_file(stdout_fname)
+        # Do cleanup
+        if keepfiles:
+            output += "Test files kept in %s\n" % (rundir,)
+        else:
+            shutil.rmtree(rundir, ignore_errors=True)
+        return msg, elapsed, output
+
+# Run a process and return its exit code (or None if it was killed
+# because it did not finish within 'timeout' seconds)
+def call_with_timeout(args, timeout, **kwargs):
+    proc = subprocess.Popen(args, **kwargs)
+    end_time = time.time() + timeout
+    while proc.poll() is None:
+        if time.time() > end_time:
+            proc.kill()
+            proc.wait()
+            return None
+        time.sleep(.010)
+    return proc.returncode
+
+def read_file(fname):
+    try:
+        f = open(fname, 'r')
+        data = f.read()
+        f.close()
+    except (IOError, OSError):
+        return ""
+    return data
+
 class TestCase:
-    def __init__(self, fname, dictdir, tempdir, verbose, keepfiles):
+    def __init__(self, fname, dictdir, dict_check):
         self.fname = fname
         self.dictdir = dictdir
-        self.tempdir = tempdir
-        self.verbose = verbose
-        self.keepfiles = keepfiles
+        self.dict_check = dict_check
+        self.runs = []
     def relpath(self, fname, rel='test'):
         if rel == 'dict':
             reldir = self.dictdir
-        elif rel == 'temp':
-            reldir = self.tempdir
         else:
             reldir = os.path.dirname(self.fname)
         return os.path.join(reldir, fname)
@@ -50,12 +152,12 @@ class TestCase:
                     # Multiple tests in same file
                     if not multi_tests:
                         multi_tests = True
-                        self.launch_test(config_fname, dict_fnames,
-                                         gcode_fname, gcode, should_fail)
+                        self.add_run(config_fname, dict_fnames,
+                                     gcode_fname, gcode, should_fail)
                 config_fname = self.relpath(parts[1])
                 if multi_tests:
-                    self.launch_test(config_fname, dict_fnames,
-                                     gcode_fname, gcode, should_fail)
+                    self.add_run(config_fname, dict_fnames,
+                                 gcode_fname, gcode, should_fail)
             elif parts[0] == "DICTIONARY":
                 dict_fnames = [self.relpath(parts[1], 'dict')]
                 for mcu_dict in parts[2:]:
@@ -70,66 +172,90 @@ class TestCase:
                 gcode.append(line.strip())
         f.close()
         if not multi_tests:
-            self.launch_test(config_fname, dict_fnames,
-                             gcode_fname, gcode, should_fail)
-    def launch_test(self, config_fname, dict_fnames, gcode_fname, gcode,
-                    should_fail):
-        gcode_is_temp = False
-        if gcode_fname is None:
-            gcode_fname = self.relpath(TEMP_GCODE_FILE, 'temp')
-            gcode_is_temp = True
-            f = open(gcode_fname, 'w')
-            f.write('\n'.join(gcode + ['']))
-            f.close()
-        elif gcode:
+            self.add_run(config_fname, dict_fnames,
+                         gcode_fname, gcode, should_fail)
+    def add_run(self, config_fname, dict_fnames, gcode_fname, gcode,
+                should_fail):
+        if gcode_fname is not None and gcode:
             raise error("Can't specify both a gcode file and gcode commands")
         if config_fname is None:
             raise error("config file not specified")
         if dict_fnames is None:
             raise error("data dictionary file not specified")
-        # Call klippy
-        sys.stderr.write("    Starting %s (%s)\n" % (
-            self.fname, os.path.basename(config_fname)))
-        args = [ sys.executable, './klippy/klippy.py', config_fname,
-                 '-i', gcode_fname, '-o', TEMP_OUTPUT_FILE, '-v' ]
         for df in dict_fnames:
-            args += ['-d', df]
-        if not self.verbose:
-            args += ['-l', TEMP_LOG_FILE]
-        res = subprocess.call(args)
-        is_fail = (should_fail and not res) or (not should_fail and res)
-        if is_fail:
-            if not self.verbose:
-                self.show_log()
-            if should_fail:
-                raise error("Test failed to raise an error")
-            raise error("Error during test")
-        # Do cleanup
-        if self.keepfiles:
-            return
-        for fname in os.listdir(self.tempdir):
-            if fname.startswith(TEMP_OUTPUT_FILE):
-                os.unlink(fname)
-        if not self.verbose:
-            os.unlink(TEMP_LOG_FILE)
-        else:
-            sys.stderr.write('\n')
-        if gcode_is_temp:
-            os.unlink(gcode_fname)
-    def run(self):
+            self.dict_check.check(df.split('=', 1)[-1])
+        self.runs.append(TestRun(self.fname, config_fname, dict_fnames,
+                                 gcode_fname, list(gcode), should_fail))
+    def get_runs(self):
         try:
             self.parse_test()
         except error as e:
-            return str(e)
+            return str(e), []
+        except Exception:
+            logging.exception("Unhandled exception during test parse")
+            return "internal error", []
+        return "success", self.runs
+
+
+######################################################################
+# Test execution
+######################################################################
+
+class TestRunner:
+    def __init__(self, options):
+        self.tempdir = options.tempdir
+        self.verbose = options.verbose
+        self.keepfiles = options.keepfiles
+        self.jobs = max(1, options.jobs)
+        self.timeout = options.timeout
+        self.failures = []
+    def report(self, tr, msg, elapsed, output):
+        if output:
+            sys.stdout.write(output)
+        status = "ok"
+        if msg is not None:
+            status = "FAILED"
+            self.failures.append((tr.fname, msg))
+        sys.stderr.write("    %s %s (%.2fs)\n" % (status, tr.get_name(),
+                                                 elapsed))
+        if msg is not None:
+            sys.stderr.write("\n\nTest case %s FAILED (%s)!\n\n"
+                             % (tr.fname, msg))
+    def _run_one(self, tr):
+        try:
+            return tr.run(self.tempdir, self.verbose, self.keepfiles, True,
+                          self.timeout)
         except Exception:
             logging.exception("Unhandled exception during test run")
-            return "internal error"
-        return "success"
-    def show_log(self):
-        f = open(TEMP_LOG_FILE, 'r')
-        data = f.read()
-        f.close()
-        sys.stdout.write(data)
+            return "internal error", 0., ""
+    def run_serial(self, runs):
+        for tr in runs:
+            sys.stderr.write("    Starting %s\n" % (tr.get_name(),))
+            try:
+                msg, elapsed, output = tr.run(self.tempdir, self.verbose,
+                                              self.keepfiles, False,
+                                              self.timeout)
+            except Exception:
+                logging.exception("Unhandled exception during test run")
+                msg, elapsed, output = "internal error", 0., ""
+            self.report(tr, msg, elapsed, output)
+            if msg is not None:
+                return
+    def run_parallel(self, runs):
+        # Each run is a separate klippy process, so threads are sufficient
+        pool = multiprocessing.pool.ThreadPool(self.jobs)
+        try:
+            for tr, res in zip(runs, pool.imap(self._run_one, runs)):
+                msg, elapsed, output = res
+                self.report(tr, msg, elapsed, output)
+        finally:
+            pool.close()
+            pool.join()
+    def run(self, runs):
+        if self.jobs > 1:
+            self.run_parallel(runs)
+        else:
+            self.run_serial(runs)
 
 
 ######################################################################
@@ -148,21 +274,47 @@ def main():
                     help="do not remove temporary files")
     opts.add_option("-v", action="store_true", dest="verbose",
                     help="show all output from tests")
+    opts.add_option("-j", "--jobs", type="int", dest="jobs", default=1,
+                    help="number of tests to run in parallel (0 for one"
+                    " per cpu)")
+    opts.add_option("--timeout", type="float", dest="timeout",
+                    default=DEFAULT_TIMEOUT,
+                    help="maximum run time of each test (in seconds)")
     options, args = opts.parse_args()
     if len(args) < 1:
         opts.error("Incorrect number of arguments")
+    if options.jobs <= 0:
+        options.jobs = multiprocessing.cpu_count()
     logging.basicConfig(level=logging.DEBUG)
+    start_time = time.time()
 
-    # Run each test
+    # Build the C helper code once (instead of in each klippy process)
+    chelper.get_ffi()
+
+    # Parse all test cases
+    dict_check = DictPreCheck()
+    runs = []
     for fname in args:
-        tc = TestCase(fname, options.dictdir, options.tempdir, options.verbose,
-                      options.keepfiles)
-        res = tc.run()
+        tc = TestCase(fname, options.dictdir, dict_check)
+        res, tc_runs = tc.get_runs()
         if res != 'success':
             sys.stderr.write("\n\nTest case %s FAILED (%s)!\n\n" % (fname, res))
             sys.exit(-1)
+        runs.extend(tc_runs)
+
+    # Run each test
+    runner = TestRunner(options)
+    runner.run(runs)
+    total_time = time.time() - start_time
+    if runner.failures:
+        sys.stderr.write("\n    %d of %d test runs FAILED (%.1fs):\n" % (
+            len(runner.failures), len(runs), total_time))
+        for fname, msg in runner.failures:
+            sys.stderr.write("      %s: %s\n" % (fname, msg))
+        sys.exit(-1)
 
-    sys.stderr.write("\n    All %d test cases passed\n" % (len(args),))
+    sys.stderr.write("\n    All %d test cases passed (%d runs in %.1fs)\n"
+                     % (len(args), len(runs), total_time))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Check that the C and python message encoders/decoders are identical
+#
+# Copyright (C) 2026  The Klipper developers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import msgproto, serialhdl
+
+# Values near the boundaries of the vlq encoding
+VLQ_EDGES = [0x20, 0x60, 0x1000, 0x3000, 0x80000, 0x180000,
+             0x4000000, 0xc000000]
+
+class error(Exception):
+    pass
+
+def random_int(rnd, minval, maxval):
+    if rnd.random() < .5:
+        v = rnd.choice(VLQ_EDGES + [-e for e in VLQ_EDGES])
+        v += rnd.randrange(-2, 2)
+        if v >= minval and v <= maxval:
+            return v
+    return rnd.randrange(minval, maxval + 1)
+
+def random_param(rnd, t, bufsize, valid):
+    if isinstance(t, msgproto.Enumeration):
+        if valid or rnd.random() < .9:
+            return rnd.choice(sorted(t.enums.keys()))
+        return "not_an_enum"
+    if t.is_dynamic_string:
+        count = rnd.randrange(bufsize + 1)
+        return bytes(bytearray([rnd.randrange(256) for i in range(count)]))
+    if not valid:
+        return random_int(rnd, -(1 << 40), 1 << 40)
+    bits = {2: 8, 3: 16}.get(t.max_length, 32)
+    if t.signed:
+        return random_int(rnd, -(1 << (bits-1)), (1 << (bits-1)) - 1)
+    return random_int(rnd, 0, (1 << bits) - 1)
+
+def build_block(cmd):
+    block = [len(cmd) + msgproto.MESSAGE_MIN, msgproto.MESSAGE_DEST] + cmd
+    block += msgproto.crc16_ccitt(block) + [msgproto.MESSAGE_SYNC]
+    return block
+
+def py_encode(mf, params):
+    try:
+        return mf.encode(params)
+    except Exception as e:
+        return type(e)
+
+class MessageChecker:
+    def __init__(self, dictfile):
+        f = open(dictfile, 'rb')
+        data = f.read()
+        f.close()
+        self.msgparser = msgproto.MessageParser()
+        self.msgparser.process_identify(data, decompress=False)
+        self.decoder = serialhdl.MessageDecoder(self.msgparser)
+        self.ffi_main = self.decoder.ffi_main
+        self.formats = sorted(self.msgparser.messages_by_name.values(),
+                              key=lambda mf: mf.msgid)
+        self.encodes = self.decodes = 0
+    def check_encode(self, mf, params):
+        # The C encoder must produce the same output as the python code
+        # (or refuse to encode the message)
+        expect = py_encode(mf, params)
+        out = mf.get_c_format().encode(params)
+        self.encodes += 1
+        if out is None:
+            if (type(expect) == list
+                and len(expect) <= msgproto.MESSAGE_PAYLOAD_MAX
+                and max(expect) <= 0xff):
+                raise error("C encoder rejected %s %s" % (mf.name, params))
+            return None
+        if out != expect:
+            raise error("Encode mismatch %s %s: %s vs %s" % (
+                mf.name, params, out, expect))
+        return out
+    def check_decode(self, mf, cmd):
+        # The C decoder must produce the same params as the python code
+        block = build_block(cmd)
+        expect = self.msgparser.parse(bytes(bytearray(block)))
+        msg = self.ffi_main.new('uint8_t[]', block)
+        params = self.decoder.parse(msg, len(block))
+        self.decodes += 1
+        if params != expect:
+            raise error("Decode mismatch %s %s: %s vs %s" % (
+                mf.name, cmd, params, expect))
+        return params
+    def check(self, rnd, iterations):
+        for mf in self.formats:
+            if mf.get_c_format() is None:
+                raise error("C helper not available for %s" % (mf.name,))
+            bufs = len([t for t in mf.param_types if t.is_dynamic_string])
+            bufsize = msgproto.MESSAGE_PAYLOAD_MAX - 1
+            if bufs:
+                bufsize = (bufsize - 5 * len(mf.param_types)) // bufs
+            for i in range(iterations):
+                # Round trip of valid parameters
+                params = [random_param(rnd, t, bufsize, True)
+                          for t in mf.param_types]
+                cmd = self.check_encode(mf, params)
+                res = self.check_decode(mf, cmd)
+                for (name, t), v in zip(mf.param_names, params):
+                    rv = res[name]
+                    if isinstance(t, msgproto.Enumeration):
+                        # Multiple enumerations may have the same value
+                        v, rv = t.enums[v], t.enums.get(rv)
+                    if rv != v:
+                        raise error("Round trip mismatch %s %s: %s" % (
+                            mf.name, params, res))
+                # Arbitrary parameters
+                params = [random_param(rnd, t, bufsize + 8, False)
+                          for t in mf.param_types]
+                cmd = self.check_encode(mf, params)
+                if cmd is not None:
+                    self.check_decode(mf, cmd)
+
+def main():
+    usage = "%prog [options] <data dictionary files>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--iterations", type="int", dest="iterations",
+                    default=200, help="random messages per message type")
+    opts.add_option("-s", "--seed", type="int", dest="seed", default=0,
+                    help="random number generator seed")
+    options, args = opts.parse_args()
+    if len(args) < 1:
+        opts.error("Incorrect number of arguments")
+    rnd = random.Random(options.seed)
+    for dictfile in args:
+        mc = MessageChecker(dictfile)
+        try:
+            mc.check(rnd, options.iterations)
+        except error as e:
+            sys.stderr.write("%s: %s\n" % (dictfile, str(e)))
+            sys.exit(-1)
+        sys.stdout.write("%s: %d message types, %d encodes, %d decodes ok\n"
+                         % (os.path.basename(dictfile), len(mc.formats),
+                            mc.encodes, mc.decodes))
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, optparse, socket, fcntl, select, json, errno, time
+import struct
 
 # Set a file-descriptor as non-blocking
 def set_nonblock(fd):
@@ -30,25 +31,84 @@ def webhook_socket_create(uds_filename):
     sys.stderr.write("Connection.\n")
     return sock
 
+# Split socket data into messages.  Returns a list of (json, binary)
+# tuples and any remaining partial data.
+def parse_frames(data):
+    msgs = []
+    while data:
+        if data[:1] == b"\x02":
+            # Binary framing: header, json, then packed data
+            if len(data) < 9:
+                break
+            json_len, bin_len = struct.unpack_from('<II', data, 1)
+            end = 9 + json_len + bin_len
+            if len(data) < end:
+                break
+            msgs.append((data[9:9+json_len], data[9+json_len:end]))
+            data = data[end:]
+            continue
+        pos = data.find(b"\x03")
+        if pos < 0:
+            break
+        msgs.append((data[:pos], None))
+        data = data[pos+1:]
+    return msgs, data
+
+# Expand packed tables in a binary framed message
+def unpack_message(msg, blob):
+    params = msg.get("params", {})
+    for key, value in params.items():
+        if type(value) != dict or "__packed__" not in value:
+            continue
+        meta = value["__packed__"]
+        shape = meta["shape"]
+        width = sum([s or 1 for s in shape])
+        fmt = "<%d%s" % (meta["rows"] * width, meta["type"])
+        vals = list(struct.unpack_from(str(fmt), blob, meta["offset"]))
+        for i in meta.get("int_columns", []):
+            vals[i::width] = [int(v) for v in vals[i::width]]
+        rows = []
+        for i in range(0, len(vals), width):
+            row = []
+            for s in shape:
+                if s:
+                    row.append(vals[i:i+s])
+                    i += s
+                else:
+                    row.append(vals[i])
+                    i += 1
+            rows.append(row)
+        params[key] = rows
+    return msg
+
 class KeyboardReader:
-    def __init__(self, uds_filename):
+    def __init__(self, uds_filename, binary_framing=False):
         self.kbd_fd = sys.stdin.fileno()
         set_nonblock(self.kbd_fd)
         self.webhook_socket = webhook_socket_create(uds_filename)
         self.poll = select.poll()
         self.poll.register(sys.stdin, select.POLLIN | select.POLLHUP)
         self.poll.register(self.webhook_socket, select.POLLIN | select.POLLHUP)
-        self.kbd_data = self.socket_data = ""
+        self.kbd_data = ""
+        self.socket_data = b""
+        if binary_framing:
+            self.send_msg({"id": "info", "method": "info",
+                           "params": {"binary_framing": True}})
     def process_socket(self):
         data = self.webhook_socket.recv(4096)
         if not data:
             sys.stderr.write("Socket closed\n")
             sys.exit(0)
-        parts = data.split('\x03')
-        parts[0] = self.socket_data + parts[0]
-        self.socket_data = parts.pop()
-        for line in parts:
-            sys.stdout.write("GOT: %s\n" % (line,))
+        parts, self.socket_data = parse_frames(self.socket_data + data)
+        for line, blob in parts:
+            if blob is not None:
+                msg = unpack_message(json.loads(line), blob)
+                line = json.dumps(msg, separators=(',', ':')).encode()
+            sys.stdout.write("GOT: %s\n" % (line.decode(),))
+    def send_msg(self, m):
+        cm = json.dumps(m, separators=(',', ':'))
+        sys.stdout.write("SEND: %s\n" % (cm,))
+        self.webhook_socket.send(cm.encode() + b"\x03")
     def process_kbd(self):
         data = os.read(self.kbd_fd, 4096)
         parts = data.split('\n')
@@ -63,9 +123,7 @@ class KeyboardReader:
             except:
                 sys.stderr.write("ERROR: Unable to parse line\n")
                 continue
-            cm = json.dumps(m, separators=(',', ':'))
-            sys.stdout.write("SEND: %s\n" % (cm,))
-            self.webhook_socket.send("%s\x03" % (cm,))
+            self.send_msg(m)
     def run(self):
         while 1:
             res = self.poll.poll(1000.)
@@ -78,11 +136,13 @@ class KeyboardReader:
 def main():
     usage = "%prog [options] <socket filename>"
     opts = optparse.OptionParser(usage)
+    opts.add_option("-b", "--binary", action="store_true", dest="binary",
+                    help="request binary framing of bulk data messages")
     options, args = opts.parse_args()
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
 
-    ml = KeyboardReader(args[0])
+    ml = KeyboardReader(args[0], options.binary)
     ml.run()
 
 if __name__ == '__main__':